@@ -0,0 +1,229 @@
+import math
+import numpy as np
+
+
+# Width of the bins of the diameter histograms, in nm (the bins are centered on whole nanometers):
+DIAMETER_BIN_WIDTH = 1.0
+
+
+class RunningStatistics:
+    """ Count, mean, variance, minimum and maximum of a stream of values, in constant memory.
+
+        Values are added in batches, statistics of separately collected streams are combined with
+        merge, in any order (Chan et al.'s parallel variance update). """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        # Sum of the squared deviations from the mean:
+        self.squared_deviations = 0.0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+
+    def add(self, values):
+        values = np.asarray(values, np.float64).ravel()
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            return
+        batch = RunningStatistics()
+        batch.count = len(values)
+        batch.mean = float(np.mean(values))
+        batch.squared_deviations = float(np.sum((values - batch.mean) ** 2))
+        batch.minimum = float(np.min(values))
+        batch.maximum = float(np.max(values))
+        self.merge(batch)
+
+    def merge(self, other):
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.squared_deviations += other.squared_deviations + delta * delta * self.count * other.count / count
+        self.count = count
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+
+    @property
+    def variance(self):
+        return self.squared_deviations / (self.count - 1) if self.count > 1 else math.nan
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance)
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.mean if self.count > 0 else None,
+            'squared_deviations': self.squared_deviations,
+            'minimum': self.minimum if self.count > 0 else None,
+            'maximum': self.maximum if self.count > 0 else None,
+        }
+
+    @staticmethod
+    def from_dict(data):
+        statistics = RunningStatistics()
+        statistics.count = data['count']
+        if statistics.count > 0:
+            statistics.mean = data['mean']
+            statistics.squared_deviations = data['squared_deviations']
+            statistics.minimum = data['minimum']
+            statistics.maximum = data['maximum']
+        return statistics
+
+
+class FixedBinHistogram:
+    """ Counts of values in bins of a fixed width, bin i is [origin + i * width, origin + (i + 1) * width).
+
+        Only the counts of the range of bins seen so far are kept, so the memory use depends on the
+        range of the values and not on their number. Histograms of the same bins are merged by adding
+        their counts. """
+
+    def __init__(self, bin_width, origin=0.0):
+        self.bin_width = bin_width
+        self.origin = origin
+        # Counts of the bins first_bin, first_bin + 1, ...:
+        self.first_bin = 0
+        self.counts = np.zeros(0, np.int64)
+
+    def add(self, values):
+        values = np.asarray(values, np.float64).ravel()
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            return
+        bins = np.floor((values - self.origin) / self.bin_width).astype(np.int64)
+        first_bin = int(bins.min())
+        self.add_counts(first_bin, np.bincount(bins - first_bin))
+
+    def add_counts(self, first_bin, counts):
+        if len(counts) == 0:
+            return
+        if len(self.counts) == 0:
+            self.first_bin = first_bin
+            self.counts = np.array(counts, np.int64)
+            return
+
+        # Extend the range of bins to cover both:
+        start = min(self.first_bin, first_bin)
+        end = max(self.first_bin + len(self.counts), first_bin + len(counts))
+        if start != self.first_bin or end != self.first_bin + len(self.counts):
+            extended_counts = np.zeros(end - start, np.int64)
+            extended_counts[self.first_bin - start:self.first_bin - start + len(self.counts)] = self.counts
+            self.first_bin = start
+            self.counts = extended_counts
+        self.counts[first_bin - start:first_bin - start + len(counts)] += counts
+
+    def merge(self, other):
+        if other.bin_width != self.bin_width or other.origin != self.origin:
+            raise ValueError('Histograms with different bins can not be merged')
+        self.add_counts(other.first_bin, other.counts)
+
+    @property
+    def total(self):
+        return int(np.sum(self.counts))
+
+    def get_bin_edges(self):
+        return self.origin + self.bin_width * np.arange(self.first_bin, self.first_bin + len(self.counts) + 1)
+
+    def to_dict(self):
+        return {'bin_width': self.bin_width, 'origin': self.origin, 'first_bin': self.first_bin,
+                'counts': self.counts.tolist()}
+
+    @staticmethod
+    def from_dict(data):
+        histogram = FixedBinHistogram(data['bin_width'], data['origin'])
+        histogram.add_counts(data['first_bin'], np.asarray(data['counts'], np.int64))
+        return histogram
+
+
+class ResultAggregate:
+    """ Aggregate statistics of the results of any number of images: the diameter histogram and
+        statistics, hex and non-hex counts, the covered area and the nearest neighbor spacing.
+
+        Images are added one at a time from their exported summary and circle records (see
+        results_export), which are not kept. Aggregates collected separately (eg. in worker processes)
+        are combined with merge, and stored with to_dict. """
+
+    def __init__(self):
+        self.image_count = 0
+        self.circle_count = 0
+        # Circles of classified images, and the hex circles among them:
+        self.classified_count = 0
+        self.hex_count = 0
+        # Covered and total area of the crop areas, in pixels:
+        self.covered_area = 0.0
+        self.total_area = 0.0
+        self.diameter_histogram = FixedBinHistogram(DIAMETER_BIN_WIDTH, -DIAMETER_BIN_WIDTH / 2)
+        self.diameters = RunningStatistics()
+        self.spacings = RunningStatistics()
+
+    def add_image(self, summary, records):
+        nm_per_pixel = summary.get('nm_per_pixel', 1.0)
+        radii = np.asarray(records['r'], np.float64)
+
+        self.image_count += 1
+        self.circle_count += len(radii)
+        if summary['hex'] >= 0:
+            self.classified_count += len(radii)
+            self.hex_count += int(summary['hex'])
+        self.covered_area += float(np.pi * np.sum(radii * radii))
+        self.total_area += float((summary['x1'] - summary['x0']) * (summary['y1'] - summary['y0']))
+
+        diameters = np.asarray(records['diameter_nm'], np.float64)
+        self.diameter_histogram.add(diameters)
+        self.diameters.add(diameters)
+        self.spacings.add(np.asarray(records['nearest_neighbor_distance'], np.float64) * nm_per_pixel)
+
+    def merge(self, other):
+        self.image_count += other.image_count
+        self.circle_count += other.circle_count
+        self.classified_count += other.classified_count
+        self.hex_count += other.hex_count
+        self.covered_area += other.covered_area
+        self.total_area += other.total_area
+        self.diameter_histogram.merge(other.diameter_histogram)
+        self.diameters.merge(other.diameters)
+        self.spacings.merge(other.spacings)
+
+    @property
+    def hex_ratio(self):
+        return self.hex_count / self.classified_count if self.classified_count > 0 else math.nan
+
+    @property
+    def coverage(self):
+        return self.covered_area / self.total_area if self.total_area > 0 else math.nan
+
+    def get_description(self):
+        text = f'{self.image_count} images, {self.circle_count} circles'
+        if self.classified_count > 0:
+            text += f', {self.hex_ratio:.1%} hex'
+        text += f', coverage {self.coverage:.1%}'
+        if self.diameters.count > 0:
+            text += f'\ndiameter {self.diameters.mean:.1f} ± {self.diameters.std:.1f} nm'
+        if self.spacings.count > 0:
+            text += f', spacing {self.spacings.mean:.1f} ± {self.spacings.std:.1f} nm'
+        return text
+
+    def to_dict(self):
+        return {
+            'image_count': self.image_count,
+            'circle_count': self.circle_count,
+            'classified_count': self.classified_count,
+            'hex_count': self.hex_count,
+            'covered_area': self.covered_area,
+            'total_area': self.total_area,
+            'diameter_histogram': self.diameter_histogram.to_dict(),
+            'diameters': self.diameters.to_dict(),
+            'spacings': self.spacings.to_dict(),
+        }
+
+    @staticmethod
+    def from_dict(data):
+        aggregate = ResultAggregate()
+        for name in ('image_count', 'circle_count', 'classified_count', 'hex_count', 'covered_area', 'total_area'):
+            setattr(aggregate, name, data[name])
+        aggregate.diameter_histogram = FixedBinHistogram.from_dict(data['diameter_histogram'])
+        aggregate.diameters = RunningStatistics.from_dict(data['diameters'])
+        aggregate.spacings = RunningStatistics.from_dict(data['spacings'])
+        return aggregate
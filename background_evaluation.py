@@ -0,0 +1,127 @@
+import os
+import queue
+import threading
+
+
+# Evaluations running at the same time, shared by the evaluators of all image windows. More would
+# only compete for the same cores:
+MAX_CONCURRENT_EVALUATIONS = os.cpu_count() or 1
+_evaluation_slots = threading.BoundedSemaphore(MAX_CONCURRENT_EVALUATIONS)
+
+
+class BackgroundEvaluator:
+    """ Runs evaluations of an image in a background thread, so the GUI stays responsive.
+
+        Only the latest request matters: a new request supersedes the pending and the
+        running one, the results of superseded requests are discarded. Results are
+        delivered on the Tk main thread by polling from the given widget.
+
+        Evaluators of different images run in parallel, at most MAX_CONCURRENT_EVALUATIONS
+        at a time. The thread stops when the evaluator is shut down (when its widget is destroyed). """
+
+    POLL_INTERVAL_MS = 30
+
+    def __init__(self, widget, evaluate_function, result_callback, busy_callback=None, error_callback=None):
+        # evaluate_function(*arguments, is_cancelled) runs in the background thread and may return None if cancelled,
+        # result_callback(result), busy_callback(is_busy) and error_callback(exception) are called on the main thread:
+        self.widget = widget
+        self.evaluate_function = evaluate_function
+        self.result_callback = result_callback
+        self.busy_callback = busy_callback
+        self.error_callback = error_callback
+
+        self.condition = threading.Condition()
+        self.generation = 0
+        self.pending_request = None
+        self.results = queue.Queue()
+        self.is_busy = False
+        self.poll_job = None
+        self.is_shut_down = False
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, *arguments):
+        with self.condition:
+            self.generation += 1
+            self.pending_request = (self.generation, arguments)
+            self.condition.notify()
+
+        self.set_busy(True)
+
+    def cancel(self):
+        with self.condition:
+            self.generation += 1
+            self.pending_request = None
+
+        # Results which are already queued are discarded when polled:
+        self.set_busy(False)
+
+    def shutdown(self):
+        """ Stops the background thread after the running evaluation, whose result is discarded. """
+
+        with self.condition:
+            self.is_shut_down = True
+            self.generation += 1
+            self.pending_request = None
+            self.condition.notify()
+
+        if self.poll_job is not None:
+            self.widget.after_cancel(self.poll_job)
+            self.poll_job = None
+
+    def is_current(self, generation):
+        return generation == self.generation
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending_request is None and not self.is_shut_down:
+                    self.condition.wait()
+                if self.is_shut_down:
+                    return
+                generation, arguments = self.pending_request
+                self.pending_request = None
+
+            with _evaluation_slots:
+                # Superseded while waiting for the other evaluators:
+                if not self.is_current(generation):
+                    continue
+
+                try:
+                    result = self.evaluate_function(*arguments, is_cancelled=lambda: not self.is_current(generation))
+                    error = None
+                except Exception as exception:
+                    result = None
+                    error = exception
+
+            if self.is_current(generation):
+                self.results.put((generation, result, error))
+
+    def set_busy(self, is_busy):
+        if is_busy != self.is_busy:
+            self.is_busy = is_busy
+            if self.busy_callback:
+                self.busy_callback(is_busy)
+
+        if is_busy and self.poll_job is None and not self.is_shut_down:
+            self.poll_job = self.widget.after(self.POLL_INTERVAL_MS, self.poll)
+
+    def poll(self):
+        self.poll_job = None
+
+        latest = None
+        while not self.results.empty():
+            latest = self.results.get()
+
+        if latest is not None and self.is_current(latest[0]):
+            generation, result, error = latest
+            self.set_busy(False)
+            if error is not None:
+                if self.error_callback is None:
+                    raise error
+                self.error_callback(error)
+            if result is not None:
+                self.result_callback(result)
+        elif self.is_busy:
+            self.poll_job = self.widget.after(self.POLL_INTERVAL_MS, self.poll)
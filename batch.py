@@ -0,0 +1,385 @@
+import argparse
+import concurrent.futures
+import csv
+import glob
+import json
+import os
+import sys
+import time
+
+import tracing
+from aggregates import ResultAggregate
+from calibration import calibrate_image
+from parameters import read_parameter_file, resolve_parameter_file
+from result_cache import ResultCache, get_default_cache_directory
+from results_export import CIRCLE_COLUMNS, ResultWriter, get_results, read_csv_table, write_csv_table
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp')
+
+
+def find_images(inputs, recursive):
+    """ Expands the given files, directories and glob patterns to a sorted list of image paths. """
+
+    image_paths = []
+    for input_path in inputs:
+        if os.path.isdir(input_path):
+            pattern = os.path.join(input_path, '**', '*') if recursive else os.path.join(input_path, '*')
+            candidates = glob.glob(pattern, recursive=recursive)
+        elif os.path.isfile(input_path):
+            candidates = [input_path]
+        else:
+            candidates = glob.glob(input_path, recursive=True)
+
+        for path in candidates:
+            if os.path.isfile(path) and os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS:
+                image_paths.append(os.path.normpath(path))
+
+    return sorted(set(image_paths))
+
+
+def find_parameter_file(image_path, shared_parameter_file):
+    # A sibling .par file (as saved by the GUI for this image) takes precedence over the shared one:
+    sibling_parameter_file = os.path.splitext(image_path)[0] + '.par'
+    if os.path.exists(sibling_parameter_file):
+        return sibling_parameter_file
+    return shared_parameter_file
+
+
+# Columns of the per-image circle files, the image is identified by the file:
+JOB_CIRCLE_COLUMNS = [column for column in CIRCLE_COLUMNS if column[0] != 'image_index']
+
+
+class BatchJob:
+    def __init__(self, image_path, parameter_file, output_base, autodetect_crop_area, write_overlay, nm_per_pixel=1.0,
+                 cache_directory=None, scale_bar_nm=None):
+        self.image_path = image_path
+        self.parameter_file = parameter_file
+        self.output_base = output_base
+        self.autodetect_crop_area = autodetect_crop_area
+        self.write_overlay = write_overlay
+        self.nm_per_pixel = nm_per_pixel
+        self.cache_directory = cache_directory
+
+        # Length the scale bar in the information panel stands for, the scale of the image is calibrated
+        # from it instead of using nm_per_pixel:
+        self.scale_bar_nm = scale_bar_nm
+
+    @property
+    def summary_path(self):
+        return self.output_base + '.json'
+
+    @property
+    def circles_path(self):
+        return self.output_base + '.csv'
+
+    @property
+    def overlay_path(self):
+        return self.output_base + '_overlay.png'
+
+    def is_done(self):
+        # The summary file is written last, so its existence marks a completed job. Jobs are
+        # redone if the image or its parameters changed after the results were written:
+        if not os.path.exists(self.summary_path):
+            return False
+        summary_time = os.path.getmtime(self.summary_path)
+        return (summary_time >= os.path.getmtime(self.image_path) and
+                summary_time >= os.path.getmtime(self.parameter_file))
+
+    def load_results(self):
+        """ Returns the summary (in the columns of the exported image table) and the circle records
+            written by the job, without processing the image again. """
+
+        with open(self.summary_path, 'r') as infile:
+            job_summary = json.load(infile)
+        records = read_csv_table(self.circles_path, JOB_CIRCLE_COLUMNS)
+
+        x0, y0, x1, y1 = job_summary['crop_area']
+        summary = {
+            'image': job_summary['image'],
+            'detector': job_summary['detector'],
+            'processor': job_summary['processor'],
+            'x0': x0,
+            'y0': y0,
+            'x1': x1,
+            'y1': y1,
+            'nm_per_pixel': job_summary.get('nm_per_pixel', 1.0),
+            'circles': job_summary['circles'],
+            'hex': job_summary['hex'] if job_summary['hex'] is not None else -1,
+            'non_hex': job_summary['non_hex'] if job_summary['non_hex'] is not None else -1,
+            'ratio': job_summary['ratio'] if job_summary['ratio'] is not None else float('nan'),
+            'coverage': job_summary['coverage'],
+            'mean_diameter_nm': job_summary.get('mean_diameter_nm', float('nan')),
+        }
+        return summary, records
+
+
+def create_jobs(image_paths, shared_parameter_file, output_dir, autodetect_crop_area, write_overlay, nm_per_pixel=1.0,
+                cache_directory=None, scale_bar_nm=None):
+    jobs = []
+    missing_parameters = []
+
+    # Mirror the directory structure of the inputs below their common root,
+    # so images with the same name in different directories don't collide:
+    common_root = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in image_paths])
+
+    for image_path in image_paths:
+        parameter_file = find_parameter_file(image_path, shared_parameter_file)
+        if parameter_file is None:
+            missing_parameters.append(image_path)
+            continue
+
+        relative_path = os.path.relpath(os.path.abspath(image_path), common_root)
+        output_base = os.path.join(output_dir, os.path.splitext(relative_path)[0])
+        jobs.append(BatchJob(image_path, parameter_file, output_base, autodetect_crop_area, write_overlay, nm_per_pixel,
+                             cache_directory, scale_bar_nm))
+
+    return jobs, missing_parameters
+
+
+def write_file_atomic(path, write_function, mode='w'):
+    # Write to a temporary file first, so an interrupted run never leaves a partial result behind:
+    temporary_path = path + '.tmp'
+    with open(temporary_path, mode, newline='' if 'b' not in mode else None) as outfile:
+        write_function(outfile)
+    os.replace(temporary_path, path)
+
+
+def init_worker(enable_tracing=False):
+    import cv2
+    # Parallelism comes from the process pool, OpenCV's own threads would only compete for the same cores:
+    cv2.setNumThreads(1)
+    if enable_tracing:
+        tracing.enable()
+
+
+def run_job(job):
+    """ Processes the image of the job, returns the summary and the spans traced in the worker. """
+
+    from image_processor import ImageProcessor
+
+    tracing.clear()
+    start_time = time.perf_counter()
+
+    detector, processor, parameter_values = resolve_parameter_file(
+        read_parameter_file(job.parameter_file),
+        ImageProcessor.get_available_detectors(),
+        ImageProcessor.get_available_processors())
+
+    image_processor = ImageProcessor(job.image_path)
+    if job.cache_directory:
+        image_processor.result_cache = ResultCache(job.cache_directory)
+
+    # The crop area and the scale bar are only detected in the first image of every panel layout of the worker:
+    nm_per_pixel = job.nm_per_pixel
+    scale_bar_pixels = None
+    if job.autodetect_crop_area or job.scale_bar_nm:
+        calibration = calibrate_image(image_processor.grayscale_image)
+        if job.autodetect_crop_area:
+            image_processor.active_crop_area = calibration.crop_area
+        if job.scale_bar_nm:
+            if calibration.scale_bar is None:
+                raise ValueError('no scale bar found in the information panel')
+            nm_per_pixel = calibration.get_nm_per_pixel(job.scale_bar_nm)
+            scale_bar_pixels = calibration.scale_bar.length
+    # Evaluated without ImageProcessor.evaluate, whose timing message would interleave with the progress lines:
+    image_processor.apply_evaluation(image_processor.compute_evaluation(
+        detector, processor, parameter_values, image_processor.active_crop_area))
+
+    os.makedirs(os.path.dirname(job.output_base), exist_ok=True)
+
+    if job.write_overlay:
+        image_processor.result_image.save(job.overlay_path)
+
+    # Circles are written in image coordinates (detection coordinates are relative to the crop area):
+    results, records = get_results(image_processor, nm_per_pixel)
+    write_file_atomic(job.circles_path, lambda outfile: write_csv_table(outfile, JOB_CIRCLE_COLUMNS, records))
+
+    # Statistics of the image to be merged with the other images, without loading their circles again:
+    aggregate = ResultAggregate()
+    aggregate.add_image(results, records)
+
+    good_count = results['hex'] if results['hex'] >= 0 else None
+    summary = {
+        'image': job.image_path,
+        'parameter_file': job.parameter_file,
+        'detector': detector.get_name(),
+        'processor': processor.get_name(),
+        'parameters': parameter_values,
+        'crop_area': [results['x0'], results['y0'], results['x1'], results['y1']],
+        'circles': results['circles'],
+        'hex': good_count,
+        'non_hex': results['non_hex'] if good_count is not None else None,
+        'ratio': results['ratio'] if good_count is not None else None,
+        'coverage': results['coverage'],
+        'nm_per_pixel': nm_per_pixel,
+        'scale_bar_pixels': scale_bar_pixels,
+        'mean_diameter_nm': results['mean_diameter_nm'] if results['circles'] > 0 else None,
+        'seconds': time.perf_counter() - start_time,
+        'aggregate': aggregate.to_dict(),
+    }
+
+    write_file_atomic(job.summary_path, lambda outfile: json.dump(summary, outfile, indent=4))
+
+    return summary, tracing.get_events()
+
+
+def write_summary_table(jobs, filename):
+    columns = ['image', 'detector', 'processor', 'circles', 'hex', 'non_hex', 'ratio', 'coverage', 'seconds']
+
+    def write_rows(outfile):
+        writer = csv.writer(outfile)
+        writer.writerow(columns)
+        for job in jobs:
+            if os.path.exists(job.summary_path):
+                with open(job.summary_path, 'r') as infile:
+                    summary = json.load(infile)
+                writer.writerow([summary.get(column) for column in columns])
+
+    write_file_atomic(filename, write_rows)
+
+
+def aggregate_results(jobs):
+    """ Returns the ResultAggregate of the results of the jobs, merged from the aggregates stored in their
+        summaries (the circles of summaries written without one are loaded instead). """
+
+    aggregate = ResultAggregate()
+    for job in jobs:
+        if not os.path.exists(job.summary_path):
+            continue
+        with open(job.summary_path, 'r') as infile:
+            job_summary = json.load(infile)
+        if 'aggregate' in job_summary:
+            aggregate.merge(ResultAggregate.from_dict(job_summary['aggregate']))
+        elif os.path.exists(job.circles_path):
+            aggregate.add_image(*job.load_results())
+    return aggregate
+
+
+def export_results(jobs, base_path, formats):
+    # The results are loaded and written one image at a time, so the memory use doesn't grow with the batch:
+    with ResultWriter(base_path, formats) as writer:
+        for job in jobs:
+            if os.path.exists(job.summary_path) and os.path.exists(job.circles_path):
+                summary, records = job.load_results()
+                if summary['mean_diameter_nm'] is None:
+                    summary['mean_diameter_nm'] = float('nan')
+                writer.add(summary, records)
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours:d}:{minutes:02d}:{seconds:02d}'
+
+
+def run_batch(jobs, worker_count, progress_stream=sys.stdout, enable_tracing=False):
+    """ Processes the jobs in a process pool, returns the list of (job, error message) of failed jobs.
+
+        With tracing enabled, the spans traced in the workers are collected in the tracing module. """
+
+    failed_jobs = []
+    if len(jobs) == 0:
+        return failed_jobs
+
+    start_time = time.perf_counter()
+    finished_count = 0
+
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=worker_count, initializer=init_worker, initargs=(enable_tracing,)) as executor:
+        futures = {executor.submit(run_job, job): job for job in jobs}
+
+        for future in concurrent.futures.as_completed(futures):
+            job = futures[future]
+            finished_count += 1
+
+            try:
+                summary, events = future.result()
+                tracing.add_events(events)
+                status = f"{summary['circles']} circles ({summary['seconds']:.2f} s)"
+            except Exception as exception:
+                failed_jobs.append((job, str(exception)))
+                status = 'FAILED: ' + str(exception)
+
+            elapsed_time = time.perf_counter() - start_time
+            remaining_time = elapsed_time / finished_count * (len(jobs) - finished_count)
+            print(f'[{finished_count:>{len(str(len(jobs)))}}/{len(jobs)}] '
+                  f'ETA {format_duration(remaining_time)} {job.image_path}: {status}',
+                  file=progress_stream, flush=True)
+
+    return failed_jobs
+
+
+def parse_arguments(arguments=None):
+    parser = argparse.ArgumentParser(
+        description='Process images without the GUI. Every image is processed with the parameters '
+                    'of its sibling .par file (as saved by the GUI), or with the shared parameter file.')
+    parser.add_argument('inputs', nargs='+', help='image files, directories or glob patterns')
+    parser.add_argument('-o', '--output', required=True, help='output directory')
+    parser.add_argument('-p', '--parameters', help='parameter file used for images without a sibling .par file')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('-r', '--recursive', action='store_true', help='search input directories recursively')
+    parser.add_argument('--overwrite', action='store_true', help='reprocess images with existing results')
+    parser.add_argument('--no-overlay', action='store_true', help="don't write annotated overlay images")
+    parser.add_argument('--no-autocrop', action='store_true',
+                        help="process the full image instead of detecting the SEM information panel")
+    parser.add_argument('--nm-per-pixel', type=float, default=1.0,
+                        help='scale of the images, used for the physical diameters (default: 1.0)')
+    parser.add_argument('--scale-bar', metavar='NM', type=float,
+                        help='length of the scale bar in the SEM information panel in nm, the scale of every image '
+                             'is calibrated from the measured length of its scale bar instead of --nm-per-pixel')
+    parser.add_argument('--export', action='append', choices=['npz', 'csv'],
+                        help='also write the circles and summaries of all images to results.npz '
+                             'or results_circles.csv and results_images.csv (can be repeated)')
+    parser.add_argument('--cache', metavar='DIR', nargs='?', const=get_default_cache_directory(),
+                        help='reuse the results of images processed before with the same parameters, stored in DIR '
+                             '(default: the result cache of the GUI)')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='trace the processing stages, write a Chrome trace to FILE and print a summary')
+    return parser.parse_args(arguments)
+
+
+def main(arguments=None):
+    args = parse_arguments(arguments)
+
+    image_paths = find_images(args.inputs, args.recursive)
+    if len(image_paths) == 0:
+        print('No images found.', file=sys.stderr)
+        return 1
+
+    jobs, missing_parameters = create_jobs(
+        image_paths, args.parameters, args.output, not args.no_autocrop, not args.no_overlay, args.nm_per_pixel,
+        args.cache, args.scale_bar)
+
+    for image_path in missing_parameters:
+        print('Skipping ' + image_path + ': no parameter file', file=sys.stderr)
+
+    pending_jobs = jobs if args.overwrite else [job for job in jobs if not job.is_done()]
+    if len(pending_jobs) < len(jobs):
+        print(f'Resuming: {len(jobs) - len(pending_jobs)} of {len(jobs)} images already processed.')
+
+    failed_jobs = run_batch(pending_jobs, max(1, args.jobs), enable_tracing=bool(args.trace))
+
+    if args.trace:
+        tracing.export_chrome_trace(args.trace)
+        print(tracing.format_summary())
+
+    os.makedirs(args.output, exist_ok=True)
+    write_summary_table(jobs, os.path.join(args.output, 'summary.csv'))
+
+    aggregate = aggregate_results(jobs)
+    write_file_atomic(os.path.join(args.output, 'aggregate.json'),
+                      lambda outfile: json.dump(aggregate.to_dict(), outfile, indent=4))
+    print(aggregate.get_description())
+    if args.export:
+        export_results(jobs, os.path.join(args.output, 'results'), args.export)
+
+    for job, error in failed_jobs:
+        print('Failed ' + job.image_path + ': ' + error, file=sys.stderr)
+
+    return 1 if failed_jobs or missing_parameters else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
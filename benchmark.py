@@ -0,0 +1,261 @@
+import argparse
+import glob
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from batch import IMAGE_EXTENSIONS
+from parameters import read_parameter_file, get_default_parameter_values
+from process import get_processor_results
+
+
+STAGES = ['load', 'detect', 'process', 'render']
+
+
+def find_benchmark_cases(examples_dir):
+    """ Returns the (image path, parameter file or None) pairs of the example images. """
+
+    cases = []
+    for image_path in sorted(glob.glob(os.path.join(examples_dir, '*', '*'))):
+        if os.path.splitext(image_path)[1].lower() not in IMAGE_EXTENSIONS:
+            continue
+        parameter_file = os.path.splitext(image_path)[0] + '.par'
+        cases.append((image_path, parameter_file if os.path.exists(parameter_file) else None))
+    return cases
+
+
+def get_case_parameter_values(parameter_file, detector, processor):
+    # Parameters of the .par file override the defaults of the benchmarked combination, so the
+    # tuned values (eg. the radius) are used with every detector and processor that declares them:
+    parameter_values = get_default_parameter_values(detector, processor)
+    if parameter_file is not None:
+        saved_parameter_values = read_parameter_file(parameter_file)['parameters']
+        for key in parameter_values:
+            if key in saved_parameter_values:
+                parameter_values[key] = saved_parameter_values[key]
+    return parameter_values
+
+
+class StageRunner:
+    """ Runs the stages of the processing pipeline of a single image, keeping the outputs for the next stage. """
+
+    def __init__(self, image_path, detector, processor, parameter_values):
+        self.image_path = image_path
+        self.detector = detector
+        self.processor = processor
+        self.parameter_values = parameter_values
+
+        self.image_processor = None
+        self.cropped_img = None
+        self.circles = []
+        self.processor_results = np.zeros(0, np.int64)
+
+    def run_stage(self, stage):
+        from image_processor import ImageProcessor
+
+        if stage == 'load':
+            self.image_processor = ImageProcessor(self.image_path)
+            self.image_processor.autodetect_crop_area()
+            x0, y0, x1, y1 = self.image_processor.active_crop_area
+            self.cropped_img = self.image_processor.grayscale_image[y0:y1, x0:x1]
+        elif stage == 'detect':
+            self.circles = self.detector.evaluate(self.cropped_img, self.parameter_values)
+        elif stage == 'process':
+            self.processor_results = get_processor_results(
+                self.processor.evaluate(self.cropped_img, self.circles, self.parameter_values))[0]
+        elif stage == 'render':
+            self.image_processor.render_result_image(
+                self.processor, self.image_processor.active_crop_area, self.circles, self.processor_results, True, True)
+
+
+def measure_stage(runner, stage, repeats, warmup):
+    """ Returns the wall times of the repeated runs and the peak traced memory of the stage. """
+
+    for _ in range(warmup):
+        runner.run_stage(stage)
+
+    times = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        runner.run_stage(stage)
+        times.append(time.perf_counter() - start_time)
+
+    # Memory is measured in a separate run, tracing would distort the timing. tracemalloc sees
+    # numpy arrays (including the ones returned by OpenCV), but not OpenCV's internal buffers:
+    tracemalloc.start()
+    runner.run_stage(stage)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return times, peak_memory
+
+
+def run_benchmarks(cases, detectors, processors, repeats, warmup, examples_dir, progress_stream=sys.stdout):
+    results = []
+    for image_path, parameter_file in cases:
+        # Images are identified relative to the examples directory, so results of different checkouts are comparable:
+        image_name = os.path.relpath(image_path, examples_dir).replace(os.sep, '/')
+
+        for detector in detectors:
+            for processor in processors:
+                parameter_values = get_case_parameter_values(parameter_file, detector, processor)
+                runner = StageRunner(image_path, detector, processor, parameter_values)
+
+                stage_results = []
+                for stage in STAGES:
+                    times, peak_memory = measure_stage(runner, stage, repeats, warmup)
+                    stage_results.append({
+                        'image': image_name,
+                        'detector': detector.get_name(),
+                        'processor': processor.get_name(),
+                        'stage': stage,
+                        'median_s': statistics.median(times),
+                        'min_s': min(times),
+                        'mean_s': statistics.mean(times),
+                        'peak_bytes': peak_memory,
+                    })
+
+                # Every stage result carries the circle count of the pipeline, to detect changes in the output:
+                for stage_result in stage_results:
+                    stage_result['circles'] = len(runner.circles)
+                results.extend(stage_results)
+
+                if progress_stream:
+                    total_time = sum(result['median_s'] for result in stage_results)
+                    print(f'{image_name} {detector.get_name()}/{processor.get_name()}: '
+                          f'{len(runner.circles)} circles, {total_time * 1000:.1f} ms',
+                          file=progress_stream, flush=True)
+    return results
+
+
+def get_environment():
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'opencv_threads': cv2.getNumThreads(),
+    }
+
+
+def result_key(result):
+    return (result['image'], result['detector'], result['processor'], result['stage'])
+
+
+def compare_with_baseline(results, baseline_results, threshold, min_time=0.001):
+    """ Returns the list of regressions: results whose median time grew by more than the threshold
+        (relative), or whose circle count changed. Stages faster than min_time in both runs are
+        dominated by noise and not compared by time. """
+
+    baseline = {result_key(result): result for result in baseline_results}
+    regressions = []
+    for result in results:
+        key = result_key(result)
+        if key not in baseline:
+            continue
+        baseline_result = baseline[key]
+
+        slowdown = result['median_s'] / baseline_result['median_s'] - 1.0 if baseline_result['median_s'] > 0 else 0.0
+        if slowdown > threshold and max(result['median_s'], baseline_result['median_s']) >= min_time:
+            regressions.append((key, f"{baseline_result['median_s'] * 1000:.2f} ms -> "
+                                     f"{result['median_s'] * 1000:.2f} ms (+{slowdown:.0%})"))
+
+        if result['stage'] == 'detect' and result['circles'] != baseline_result['circles']:
+            regressions.append((key, f"circle count {baseline_result['circles']} -> {result['circles']}"))
+
+    return regressions
+
+
+def print_summary(results, stream=sys.stdout):
+    print(f"{'image':<50} {'detector/processor':<32} " + ' '.join(f'{stage:>9}' for stage in STAGES) + f" {'circles':>8}",
+          file=stream)
+    rows = {}
+    for result in results:
+        rows.setdefault((result['image'], result['detector'] + '/' + result['processor']), {})[result['stage']] = result
+    for (image, combination), stage_results in rows.items():
+        times = ' '.join(f"{stage_results[stage]['median_s'] * 1000:>7.1f}ms" if stage in stage_results else f"{'':>9}"
+                         for stage in STAGES)
+        circles = next(iter(stage_results.values()))['circles']
+        print(f'{image[-50:]:<50} {combination:<32} {times} {circles:>8}', file=stream)
+
+
+def parse_arguments(arguments=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark every detector and processor combination on the example images.')
+    parser.add_argument('--examples', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'examples'),
+                        help='directory of the example images (default: examples next to this script)')
+    parser.add_argument('--filter', help='only benchmark images whose path contains this text')
+    parser.add_argument('--detector', action='append', help='only benchmark these detectors (can be repeated)')
+    parser.add_argument('--processor', action='append', help='only benchmark these processors (can be repeated)')
+    parser.add_argument('-n', '--repeats', type=int, default=5, help='measured runs per stage (default: 5)')
+    parser.add_argument('--warmup', type=int, default=1, help='unmeasured runs per stage before measuring (default: 1)')
+    parser.add_argument('-o', '--output', default='benchmark_results.json', help='results file (default: benchmark_results.json)')
+    parser.add_argument('--baseline', help='baseline results file to compare with')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='allowed slowdown against the baseline in percent (default: 10)')
+    parser.add_argument('--update-baseline', action='store_true', help='store the results as the new baseline')
+    return parser.parse_args(arguments)
+
+
+def main(arguments=None):
+    from image_processor import ImageProcessor
+
+    args = parse_arguments(arguments)
+
+    cases = find_benchmark_cases(args.examples)
+    if args.filter:
+        cases = [case for case in cases if args.filter in case[0]]
+    detectors = [detector for detector in ImageProcessor.get_available_detectors()
+                 if not args.detector or detector.get_name() in args.detector]
+    processors = [processor for processor in ImageProcessor.get_available_processors()
+                  if not args.processor or processor.get_name() in args.processor]
+
+    results = run_benchmarks(cases, detectors, processors, max(1, args.repeats), max(0, args.warmup), args.examples)
+
+    print_summary(results)
+
+    data = {
+        'environment': get_environment(),
+        'repeats': args.repeats,
+        'warmup': args.warmup,
+        'results': results,
+    }
+    with open(args.output, 'w') as outfile:
+        json.dump(data, outfile, indent=4)
+
+    exit_code = 0
+    if args.baseline and os.path.exists(args.baseline) and not args.update_baseline:
+        with open(args.baseline, 'r') as infile:
+            baseline_data = json.load(infile)
+        if baseline_data.get('environment') != data['environment']:
+            print('Warning: the baseline was recorded in a different environment.', file=sys.stderr)
+
+        regressions = compare_with_baseline(results, baseline_data['results'], args.threshold / 100.0)
+        for key, description in regressions:
+            print('REGRESSION ' + ' '.join(key) + ': ' + description, file=sys.stderr)
+        if regressions:
+            exit_code = 1
+        else:
+            print(f'No regressions against {args.baseline} (threshold {args.threshold:g}%).')
+
+    if args.update_baseline:
+        if not args.baseline:
+            print('--update-baseline requires --baseline', file=sys.stderr)
+            return 2
+        with open(args.baseline, 'w') as outfile:
+            json.dump(data, outfile, indent=4)
+
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
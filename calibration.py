@@ -0,0 +1,355 @@
+import threading
+import cv2
+import numpy as np
+import tracing
+
+
+# Lines (rows or columns) of an information panel with at least this fraction of pixels within the
+# tolerance of the panel background are uniform, the panel starts at the uniform line next to the
+# micrograph (and not at the quiet lines between its lines of text):
+BACKGROUND_TOLERANCE = 8
+UNIFORM_LINE_FRACTION = 0.9
+
+# Lines of the micrograph next to a panel have at most this fraction of background pixels on average:
+MAX_MICROGRAPH_BACKGROUND_FRACTION = 0.75
+
+# Panels cover at most this fraction of the image:
+MAX_PANEL_FRACTION = 0.25
+
+# Lines at the edge of the image giving the background of a panel there, and lines of the micrograph
+# checked next to the panel:
+EDGE_LINES = 3
+
+# Pixels of the information panel differing from its background by more than this fraction of the
+# largest difference are foreground (text, lines and the scale bar):
+FOREGROUND_CONTRAST_FRACTION = 0.5
+
+# Panels with less contrast have no scale bar:
+MIN_SCALE_BAR_CONTRAST = 32
+
+# Horizontal runs of foreground shorter than this are text, runs spanning this fraction of the
+# panel width are borders:
+MIN_SCALE_BAR_LENGTH = 16
+MAX_SCALE_BAR_FRACTION = 0.9
+
+# Solid scale bars are filled rectangles at least this many rows tall, the ticks of rulers are at most
+# this wide and at least this many (including the ticks at both ends):
+MIN_SOLID_SCALE_BAR_HEIGHT = 3
+MAX_RULER_TICK_WIDTH = 3
+MIN_RULER_TICKS = 3
+
+# Candidate runs checked for a scale bar, longest first:
+MAX_SCALE_BAR_CANDIDATES = 32
+
+# Different layouts remembered per image size:
+MAX_LAYOUTS_PER_SIZE = 8
+MAX_SCALE_BARS_PER_LAYOUT = 8
+
+
+def get_edge_lines(grayscale_image, edge):
+    """ Returns the lines of the image from the edge ('top', 'bottom', 'left' or 'right') inwards, the
+        first axis of the returned view. """
+
+    if edge == 'top':
+        return grayscale_image
+    if edge == 'bottom':
+        return grayscale_image[::-1]
+    if edge == 'left':
+        return grayscale_image.T
+    return grayscale_image.T[::-1]
+
+
+def get_background_fractions(lines, background):
+    """ Returns the fraction of the pixels of every line within the tolerance of the background. """
+
+    return np.mean(np.abs(lines.astype(np.int16) - int(background)) <= BACKGROUND_TOLERANCE, axis=1)
+
+
+def get_edge_background(lines):
+    return np.median(lines[:EDGE_LINES])
+
+
+def is_panel_border(fractions):
+    """ Returns whether the first of the background fractions is the border line of a panel, uniform
+        with the micrograph (the EDGE_LINES fractions after it) next to it. """
+
+    return bool(fractions[0] >= UNIFORM_LINE_FRACTION and
+                np.mean(fractions[1:EDGE_LINES + 1]) <= MAX_MICROGRAPH_BACKGROUND_FRACTION)
+
+
+def find_panel_size(lines):
+    """ Returns the number of lines of the information panel at the edge the lines start at, 0 if there is
+        none.
+
+        The background of the panel is taken from the lines at the edge, the panel extends to the last
+        uniform line (text lines of the panel are not) followed by micrograph lines. """
+
+    band = lines[:int(len(lines) * MAX_PANEL_FRACTION) + EDGE_LINES]
+    if len(band) <= 2 * EDGE_LINES:
+        return 0
+
+    fractions = get_background_fractions(band, get_edge_background(band))
+    # Mean background fraction of the EDGE_LINES lines after every line:
+    following = np.convolve(fractions, np.ones(EDGE_LINES) / EDGE_LINES, 'valid')[1:]
+    is_border = ((fractions[:-EDGE_LINES] >= UNIFORM_LINE_FRACTION) &
+                 (following <= MAX_MICROGRAPH_BACKGROUND_FRACTION))
+
+    # The lines giving the background don't make a panel on their own:
+    borders = np.flatnonzero(is_border[EDGE_LINES:])
+    if len(borders) == 0:
+        return 0
+    return int(borders[-1]) + EDGE_LINES + 1
+
+
+def get_panel_sizes(image_size, crop_area):
+    # Lines of the panels at the top, bottom, left and right edges:
+    width, height = image_size
+    x0, y0, x1, y1 = crop_area
+    return {'top': y0, 'bottom': height - y1, 'left': x0, 'right': width - x1}
+
+
+def detect_crop_area(grayscale_image):
+    """ Returns the (x0, y0, x1, y1) area of the micrograph without the information panels of SEM images,
+        on any edge of the image. """
+
+    height, width = grayscale_image.shape
+    with tracing.span('detect_crop_area'):
+        sizes = {edge: find_panel_size(get_edge_lines(grayscale_image, edge))
+                 for edge in ('top', 'bottom', 'left', 'right')}
+    return sizes['left'], sizes['top'], width - sizes['right'], height - sizes['bottom']
+
+
+def get_panel_area(image_size, crop_area):
+    """ Returns the (x0, y0, x1, y1) area of the largest strip of the image outside the crop area, the
+        information panel, None if the crop area is the whole image. """
+
+    width, height = image_size
+    x0, y0, x1, y1 = crop_area
+    strips = [(0, 0, width, y0), (0, y1, width, height), (0, 0, x0, height), (x1, 0, width, height)]
+    panel_area = max(strips, key=lambda strip: (strip[2] - strip[0]) * (strip[3] - strip[1]))
+    if (panel_area[2] - panel_area[0]) * (panel_area[3] - panel_area[1]) == 0:
+        return None
+    return panel_area
+
+
+def find_horizontal_runs(mask):
+    """ Returns the rows, starts and ends of all horizontal runs of True pixels of the mask. """
+
+    padded = np.zeros((mask.shape[0], mask.shape[1] + 2), np.int8)
+    padded[:, 1:-1] = mask
+    changes = np.diff(padded, axis=1)
+    # Runs start and end in the same order, row by row:
+    rows, starts = np.nonzero(changes == 1)
+    ends = np.nonzero(changes == -1)[1]
+    return rows, starts, ends
+
+
+class ScaleBar:
+    """ The scale bar of an information panel, a horizontal line or bar from x0 to x1 on row y (its top row). """
+
+    def __init__(self, x0, x1, y, background, threshold):
+        self.x0 = x0
+        self.x1 = x1
+        self.y = y
+
+        # Panel background and the difference to it of the bar pixels:
+        self.background = background
+        self.threshold = threshold
+
+    @property
+    def length(self):
+        return self.x1 - self.x0
+
+    def matches(self, grayscale_image):
+        """ Returns whether the image has the same scale bar, checking only its row. """
+
+        if self.y >= grayscale_image.shape[0] or self.x1 > grayscale_image.shape[1]:
+            return False
+        start = max(self.x0 - 1, 0)
+        end = min(self.x1 + 1, grayscale_image.shape[1])
+        row = grayscale_image[self.y, start:end].astype(np.int16)
+        is_foreground = np.abs(row - self.background) > self.threshold
+
+        # All pixels of the bar and none of the pixels at its ends:
+        bar = is_foreground[self.x0 - start:self.x0 - start + self.length]
+        return bool(np.all(bar) and not (self.x0 > 0 and is_foreground[0]) and
+                    not (self.x1 < grayscale_image.shape[1] and is_foreground[-1]))
+
+
+def is_ruler_ticks(row_mask, x0, x1):
+    """ Returns whether the foreground of the row next to a ruler baseline from x0 to x1 is its ticks, thin
+        runs spaced apart at both of its ends. """
+
+    _, starts, ends = find_horizontal_runs(row_mask[np.newaxis, x0:x1])
+    if len(starts) < MIN_RULER_TICKS or np.any(ends - starts > MAX_RULER_TICK_WIDTH):
+        return False
+    # Glyph stems are about as far apart as they are wide:
+    gaps = starts[1:] - ends[:-1]
+    return bool(starts[0] < MAX_RULER_TICK_WIDTH and ends[-1] > x1 - x0 - MAX_RULER_TICK_WIDTH and
+                np.all(gaps > 2 * MAX_RULER_TICK_WIDTH))
+
+
+def is_scale_bar(mask, y, x0, x1):
+    """ Returns whether the horizontal run of foreground from x0 to x1 on row y of the mask (its top row)
+        is a scale bar: a filled rectangle several rows tall, or the baseline of a ruler with ticks on one
+        side, with no other foreground next to it. Strokes of glyphs have stems attached. """
+
+    height = mask.shape[0]
+    start = max(x0 - 1, 0)
+    end = min(x1 + 1, mask.shape[1])
+
+    def is_bar_row(row):
+        return bool(np.all(mask[row, x0:x1]) and not (start < x0 and mask[row, start]) and
+                    not (end > x1 and mask[row, end - 1]))
+
+    bottom = y
+    while bottom < height and is_bar_row(bottom):
+        bottom += 1
+    is_clear_above = y == 0 or not np.any(mask[y - 1, start:end])
+    is_clear_below = bottom == height or not np.any(mask[bottom, start:end])
+
+    if bottom - y >= MIN_SOLID_SCALE_BAR_HEIGHT and is_clear_above and is_clear_below:
+        return True
+    return bool((is_clear_below and y > 0 and is_ruler_ticks(mask[y - 1], x0, x1)) or
+                (is_clear_above and bottom < height and is_ruler_ticks(mask[bottom], x0, x1)))
+
+
+def find_scale_bar(grayscale_image, crop_area):
+    """ Returns the ScaleBar in the information panel outside the crop area, None if there is none.
+
+        The scale bar is the longest horizontal run of foreground pixels in the panel which doesn't span
+        the panel and is the top row of a solid bar or of the baseline of a ruler, both are measured by
+        their horizontal extent. """
+
+    panel_area = get_panel_area((grayscale_image.shape[1], grayscale_image.shape[0]), crop_area)
+    if panel_area is None:
+        return None
+
+    with tracing.span('find_scale_bar'):
+        px0, py0, px1, py1 = panel_area
+        panel = grayscale_image[py0:py1, px0:px1]
+        background = int(np.median(panel))
+        contrast = np.abs(panel.astype(np.int16) - background)
+        max_contrast = int(contrast.max())
+        if max_contrast < MIN_SCALE_BAR_CONTRAST:
+            return None
+
+        threshold = int(max_contrast * FOREGROUND_CONTRAST_FRACTION)
+        mask = contrast > threshold
+        rows, starts, ends = find_horizontal_runs(mask)
+        lengths = ends - starts
+        candidates = np.flatnonzero((lengths >= MIN_SCALE_BAR_LENGTH) &
+                                    (lengths < MAX_SCALE_BAR_FRACTION * (px1 - px0)))
+
+        # Longest first, top rows first among runs of the same length:
+        candidates = candidates[np.lexsort((rows[candidates], -lengths[candidates]))]
+        for candidate in candidates[:MAX_SCALE_BAR_CANDIDATES]:
+            y, x0, x1 = int(rows[candidate]), int(starts[candidate]), int(ends[candidate])
+            if y > 0 and np.all(mask[y - 1, x0:x1]):
+                continue
+            if is_scale_bar(mask, y, x0, x1):
+                return ScaleBar(px0 + x0, px0 + x1, py0 + y, background, threshold)
+        return None
+
+
+class Calibration:
+    def __init__(self, crop_area, scale_bar):
+        # Area of the micrograph, without the information panel:
+        self.crop_area = crop_area
+
+        # ScaleBar found in the panel, None if there is none:
+        self.scale_bar = scale_bar
+
+    def get_nm_per_pixel(self, scale_bar_nm):
+        """ Returns the scale of the image given the length the scale bar stands for, None without a scale bar. """
+
+        if self.scale_bar is None:
+            return None
+        return scale_bar_nm / self.scale_bar.length
+
+
+class PanelLayout:
+    # Crop area of the images of an instrument, and the scale bars seen in them (one per magnification):
+    def __init__(self, image_size, crop_area):
+        self.image_size = image_size
+        self.crop_area = crop_area
+        self.scale_bars = []
+
+    def has_panel(self):
+        return tuple(self.crop_area) != (0, 0) + tuple(self.image_size)
+
+    def matches(self, grayscale_image):
+        """ Returns whether the crop area is valid for the image, checking only the lines at its borders. """
+
+        if (grayscale_image.shape[1], grayscale_image.shape[0]) != self.image_size:
+            return False
+
+        # Every panel starts with a uniform line next to the micrograph:
+        for edge, size in get_panel_sizes(self.image_size, self.crop_area).items():
+            if size == 0:
+                continue
+            lines = get_edge_lines(grayscale_image, edge)
+            fractions = get_background_fractions(lines[size - 1:size + EDGE_LINES], get_edge_background(lines))
+            if not is_panel_border(fractions):
+                return False
+        return True
+
+
+class LayoutCache:
+    """ Crop areas and scale bars of the images of the instrument layouts seen so far (only layouts
+        with a panel are remembered).
+
+        Images of an instrument have the panel at the same place, and the scale bar at one of a few
+        places. An image is checked against the remembered layouts of its size at a few of its lines,
+        the crop area and the scale bar are only detected in images of new layouts. """
+
+    def __init__(self):
+        # Layouts by image size, most recently used first:
+        self.layouts = {}
+        self.lock = threading.Lock()
+
+    def calibrate(self, grayscale_image):
+        """ Returns the Calibration of the image. """
+
+        image_size = (grayscale_image.shape[1], grayscale_image.shape[0])
+        with self.lock:
+            layouts = list(self.layouts.get(image_size, []))
+
+        layout = next((layout for layout in layouts if layout.matches(grayscale_image)), None)
+        if layout is None:
+            layout = PanelLayout(image_size, detect_crop_area(grayscale_image))
+
+        scale_bar = next((scale_bar for scale_bar in list(layout.scale_bars) if scale_bar.matches(grayscale_image)),
+                         None)
+        if scale_bar is None:
+            scale_bar = find_scale_bar(grayscale_image, layout.crop_area)
+
+        # Images without a panel are detected every time, their layout has no borders to check other images at:
+        if not layout.has_panel():
+            return Calibration(layout.crop_area, scale_bar)
+
+        with self.lock:
+            layouts = self.layouts.setdefault(image_size, [])
+            if layout in layouts:
+                layouts.remove(layout)
+            layouts.insert(0, layout)
+            del layouts[MAX_LAYOUTS_PER_SIZE:]
+
+            if scale_bar is not None:
+                if scale_bar in layout.scale_bars:
+                    layout.scale_bars.remove(scale_bar)
+                layout.scale_bars.insert(0, scale_bar)
+                del layout.scale_bars[MAX_SCALE_BARS_PER_LAYOUT:]
+
+        return Calibration(layout.crop_area, scale_bar)
+
+
+# Layouts seen in this process:
+_layout_cache = LayoutCache()
+
+
+def calibrate_image(grayscale_image):
+    """ Returns the Calibration (crop area and scale bar) of the image, using the layouts of the images
+        calibrated before in this process. """
+
+    return _layout_cache.calibrate(grayscale_image)
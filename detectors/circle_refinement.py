@@ -0,0 +1,175 @@
+import concurrent.futures
+import os
+import cv2
+import numpy as np
+import tracing
+
+
+# Rays along which the edge of every circle is searched, and samples per ray:
+RAY_COUNT = 16
+RAY_SAMPLE_COUNT = 16
+
+# The rays cover this fraction of the radius inside and outside the circle:
+RAY_EXTENT = 0.5
+
+# Rays with a valid edge needed to fit a circle:
+MIN_VALID_RAYS = 6
+
+# Refined circles moving further than these fractions of their radius are kept as detected:
+MAX_CENTER_SHIFT = 0.5
+MAX_RADIUS_CHANGE = 0.4
+
+# Circles refined at once, bounds the memory of the sampled profiles:
+REFINEMENT_CHUNK_SIZE = 1 << 12
+
+# Smoothing of the image before sampling, in pixels:
+REFINEMENT_BLUR_SIGMA = 1.0
+
+# cv2.remap only handles images and maps smaller than this:
+SHRT_MAX = 32767
+
+
+def sample_radial_profiles(img, circles):
+    """ Returns the intensity profiles of the circles along their rays, as a (circles, rays, samples) array,
+        and the radius of every sample as a (circles, samples) array. """
+
+    angles = np.arange(RAY_COUNT) * (2 * np.pi / RAY_COUNT)
+    fractions = np.linspace(1.0 - RAY_EXTENT, 1.0 + RAY_EXTENT, RAY_SAMPLE_COUNT, dtype=np.float32)
+    sample_radii = circles[:, 2, None] * fractions[None, :]
+
+    offsets = sample_radii[:, None, :]
+    map_x = circles[:, 0, None, None] + np.cos(angles).astype(np.float32)[None, :, None] * offsets
+    map_y = circles[:, 1, None, None] + np.sin(angles).astype(np.float32)[None, :, None] * offsets
+
+    if max(img.shape) < SHRT_MAX and len(circles) < SHRT_MAX:
+        # All samples are interpolated by a single remap, with a row of samples per circle:
+        profiles = cv2.remap(img, map_x.reshape(len(circles), -1), map_y.reshape(len(circles), -1),
+                             cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+    else:
+        profiles = sample_bilinear(img, map_x, map_y)
+    return profiles.reshape(len(circles), RAY_COUNT, RAY_SAMPLE_COUNT), sample_radii
+
+
+def sample_bilinear(img, xs, ys):
+    # Bilinear interpolation for images too large for cv2.remap, coordinates outside the image are clamped:
+    height, width = img.shape
+    xs = np.clip(xs, 0, width - 1)
+    ys = np.clip(ys, 0, height - 1)
+    x0 = np.minimum(xs.astype(np.int64), width - 2) if width > 1 else np.zeros(xs.shape, np.int64)
+    y0 = np.minimum(ys.astype(np.int64), height - 2) if height > 1 else np.zeros(ys.shape, np.int64)
+    x1 = np.minimum(x0 + 1, width - 1)
+    y1 = np.minimum(y0 + 1, height - 1)
+    fx = xs - x0
+    fy = ys - y0
+    top = img[y0, x0] * (1 - fx) + img[y0, x1] * fx
+    bottom = img[y1, x0] * (1 - fx) + img[y1, x1] * fx
+    return top * (1 - fy) + bottom * fy
+
+
+def find_edge_radii(profiles, sample_radii):
+    """ Returns the sub-pixel radius of the edge on every ray (the strongest change of intensity in the
+        direction of the circle's contrast) and its strength, 0 for rays without an edge. """
+
+    circle_count, ray_count, sample_count = profiles.shape
+    derivatives = profiles[:, :, 2:] - profiles[:, :, :-2]
+
+    # Circles brighter than their surroundings have falling edges, the others rising edges:
+    is_bright = np.sum(profiles[:, :, -1], axis=1) < np.sum(profiles[:, :, 0], axis=1)
+    derivatives[is_bright] *= -1
+
+    # The peaks and their neighbors are picked from the flat array of the derivatives:
+    strengths = derivatives.reshape(-1, sample_count - 2)
+    peaks = np.argmax(strengths, axis=1)
+    inner_peaks = np.clip(peaks, 1, sample_count - 4)
+    flat_indices = np.arange(len(strengths)) * (sample_count - 2) + inner_peaks
+    flat_strengths = strengths.ravel()
+    before = flat_strengths[flat_indices - 1]
+    peak_strengths = flat_strengths[flat_indices]
+    after = flat_strengths[flat_indices + 1]
+
+    # Parabola through the peak and its neighbors, edges at the ends of the rays are not found:
+    curvature = before - 2 * peak_strengths + after
+    with np.errstate(invalid='ignore', divide='ignore'):
+        peak_offsets = np.clip(np.where(curvature < 0, 0.5 * (before - after) / curvature, 0.0), -0.5, 0.5)
+    weights = np.where((peaks == inner_peaks) & (peak_strengths > 0), peak_strengths, 0.0)
+
+    # The derivative at index i is centered on sample i + 1:
+    sample_step = (sample_radii[:, 1] - sample_radii[:, 0])[:, None]
+    edge_radii = sample_radii[:, 0, None] + (inner_peaks + 1 + peak_offsets).reshape(circle_count, ray_count) * sample_step
+    return edge_radii, weights.reshape(circle_count, ray_count)
+
+
+def fit_circles(circles, edge_radii, weights):
+    """ Returns the circles fitted to the edges found on their rays, and which of the fits are valid.
+
+        For small displacements of the center, the edge radius along a ray at angle a is
+        r + dx cos(a) + dy sin(a), which is fitted by weighted least squares for all circles at once. """
+
+    angles = np.arange(RAY_COUNT) * (2 * np.pi / RAY_COUNT)
+    design = np.stack([np.ones(RAY_COUNT), np.cos(angles), np.sin(angles)], axis=1)
+
+    weights = weights.astype(np.float64)
+    normal_matrices = np.einsum('nk,ki,kj->nij', weights, design, design)
+    right_sides = np.einsum('nk,ki,nk->ni', weights, design, edge_radii.astype(np.float64))
+
+    is_valid = np.count_nonzero(weights > 0, axis=1) >= MIN_VALID_RAYS
+    # Circles without enough edges get a solvable system, their fit is discarded:
+    normal_matrices[~is_valid] = np.eye(3)
+    solution = np.linalg.solve(normal_matrices, right_sides[:, :, None])[:, :, 0]
+
+    radius, dx, dy = solution[:, 0], solution[:, 1], solution[:, 2]
+    fitted = np.c_[circles[:, 0] + dx, circles[:, 1] + dy, radius]
+    is_valid &= ((np.hypot(dx, dy) <= MAX_CENTER_SHIFT * circles[:, 2]) &
+                 (np.abs(radius - circles[:, 2]) <= MAX_RADIUS_CHANGE * circles[:, 2]))
+    return fitted, is_valid
+
+
+def refine_chunk(smoothed, circles, iterations):
+    # Refines the circles in place, returns the number of refined circles:
+    detected = circles[:, :3].copy()
+    current = detected.astype(np.float32)
+    is_refined = np.zeros(len(circles), bool)
+
+    for iteration in range(iterations):
+        profiles, sample_radii = sample_radial_profiles(smoothed, current)
+        edge_radii, weights = find_edge_radii(profiles, sample_radii)
+        fitted, is_valid = fit_circles(current.astype(np.float64), edge_radii, weights)
+
+        # Every iteration has to stay close to the detected circle:
+        is_valid &= ((np.hypot(fitted[:, 0] - detected[:, 0], fitted[:, 1] - detected[:, 1]) <=
+                      MAX_CENTER_SHIFT * detected[:, 2]) &
+                     (np.abs(fitted[:, 2] - detected[:, 2]) <= MAX_RADIUS_CHANGE * detected[:, 2]))
+        current[is_valid] = fitted[is_valid]
+        is_refined |= is_valid
+
+    circles[:, :3] = np.where(is_refined[:, None], current, detected)
+    return int(np.count_nonzero(is_refined))
+
+
+def refine_circles(img, circles, iterations=1, worker_count=None):
+    """ Returns the circles with their centers and radii refined to sub-pixel precision, as a float64
+        array (further columns, eg. band labels, are kept).
+
+        The edge of every circle is located on rays from its center in the smoothed image, and a circle
+        is fitted to the edges. Further iterations sample the rays again around the fitted circle.
+        Circles whose edges are not found keep their detected position and radius. The circles are
+        refined in chunks, in parallel threads. """
+
+    if len(circles) == 0:
+        return circles
+
+    circles = np.array(circles, np.float64).reshape(len(circles), -1)
+    with tracing.span('refine_circles', circles=len(circles)) as span:
+        smoothed = cv2.GaussianBlur(np.asarray(img, np.float32), (0, 0), REFINEMENT_BLUR_SIGMA)
+
+        # cv2.remap and the numpy operations on the chunks release the GIL:
+        chunks = [circles[start:start + REFINEMENT_CHUNK_SIZE] for start in range(0, len(circles), REFINEMENT_CHUNK_SIZE)]
+        if len(chunks) == 1:
+            refined_counts = [refine_chunk(smoothed, chunks[0], iterations)]
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=worker_count or os.cpu_count()) as executor:
+                refined_counts = list(executor.map(lambda chunk: refine_chunk(smoothed, chunk, iterations), chunks))
+
+        span.set(refined=sum(refined_counts))
+
+    return circles
@@ -0,0 +1,240 @@
+import functools
+import cv2
+import numpy as np
+import tracing
+from detectors.detector_opencv_hough import get_radius_range, preprocess_image, remove_duplicate_circles
+
+
+# Largest half width (in pixels) of the local maximum filter finding the candidate centers, the filter
+# gets slow with large windows and the remaining close candidates are few:
+MAX_PEAK_HALF_WINDOW = 16
+
+# Circle centers whose radius is estimated at once, bounds the memory of the sampled rings:
+RADIUS_ESTIMATION_CHUNK_SIZE = 1 << 12
+
+
+def get_ring_kernel(min_radius, max_radius):
+    """ Returns the x and y kernels of the ring of the radius range: the unit vectors pointing away from
+        the center at the pixels whose distance from the center rounds to a radius of the range. """
+
+    half_size = int(np.ceil(max_radius + 0.5))
+    dy, dx = np.mgrid[-half_size:half_size + 1, -half_size:half_size + 1].astype(np.float32)
+    distance = np.hypot(dx, dy)
+    ring = (distance >= min_radius - 0.5) & (distance < max_radius + 0.5) & (distance > 0)
+    kernel_x = np.where(ring, dx / np.maximum(distance, 1), 0).astype(np.float32)
+    kernel_y = np.where(ring, dy / np.maximum(distance, 1), 0).astype(np.float32)
+    return kernel_x, kernel_y
+
+
+@functools.lru_cache(maxsize=16)
+def get_ring_spectra(min_radius, max_radius, dft_height, dft_width):
+    """ Returns the spectra of the ring kernels for transforms of the size, with the center of the kernels
+        at the origin. The images of a session (and the frames of a stack) mostly have the same size, so
+        the spectra are computed once. """
+
+    spectra = []
+    for kernel in get_ring_kernel(min_radius, max_radius):
+        padded = np.zeros((dft_height, dft_width), np.float32)
+        padded[:kernel.shape[0], :kernel.shape[1]] = kernel
+        padded = np.roll(padded, (-(kernel.shape[0] // 2), -(kernel.shape[1] // 2)), axis=(0, 1))
+        spectra.append(cv2.dft(padded))
+    return spectra
+
+
+def get_edge_directions(preprocessed_img, edge_detect_threshold):
+    """ Returns the x and y components of the unit gradient at the edge pixels, zero elsewhere. """
+
+    # The same edges as cv2.HoughCircles finds, from gradients computed once:
+    gradient_x = cv2.Sobel(preprocessed_img, cv2.CV_16S, 1, 0)
+    gradient_y = cv2.Sobel(preprocessed_img, cv2.CV_16S, 0, 1)
+    edges = cv2.Canny(gradient_x, gradient_y, max(1, edge_detect_threshold // 2), edge_detect_threshold)
+
+    # Only the edge pixels are normalized:
+    edge_indices = np.flatnonzero(edges)
+    edge_gradient_x = gradient_x.ravel()[edge_indices].astype(np.float32)
+    edge_gradient_y = gradient_y.ravel()[edge_indices].astype(np.float32)
+    scale = 1.0 / np.maximum(np.hypot(edge_gradient_x, edge_gradient_y), 1.0)
+
+    directions_x = np.zeros(edges.shape, np.float32)
+    directions_y = np.zeros(edges.shape, np.float32)
+    directions_x.ravel()[edge_indices] = edge_gradient_x * scale
+    directions_y.ravel()[edge_indices] = edge_gradient_y * scale
+    return directions_x, directions_y
+
+
+def correlate_ring(directions_x, directions_y, min_radius, max_radius):
+    """ Returns the sum of the edge directions along the ring of the radius range around every pixel,
+        projected on the directions from the pixel, by correlating with the ring kernels in the
+        frequency domain.
+
+        Pixels beyond the image are zero (no edges), the transforms are padded so they don't wrap around. """
+
+    height, width = directions_x.shape
+    kernel_size = 2 * int(np.ceil(max_radius + 0.5)) + 1
+    dft_height = cv2.getOptimalDFTSize(height + kernel_size - 1)
+    dft_width = cv2.getOptimalDFTSize(width + kernel_size - 1)
+    spectrum_x, spectrum_y = get_ring_spectra(min_radius, max_radius, dft_height, dft_width)
+
+    def get_spectrum(img):
+        padded = np.zeros((dft_height, dft_width), np.float32)
+        padded[:height, :width] = img
+        return cv2.dft(padded)
+
+    # Correlation is the product with the conjugate spectrum of the kernel, both components are summed
+    # in the frequency domain, so a single inverse transform is needed:
+    spectrum = cv2.mulSpectrums(get_spectrum(directions_x), spectrum_x, 0, conjB=True)
+    spectrum += cv2.mulSpectrums(get_spectrum(directions_y), spectrum_y, 0, conjB=True)
+    correlation = cv2.idft(spectrum, flags=cv2.DFT_SCALE | cv2.DFT_REAL_OUTPUT)
+    return correlation[:height, :width]
+
+
+def find_peaks(accumulator, min_value, min_center_distance):
+    """ Returns the (x, y) coordinates and values of the local maxima of the accumulator above min_value,
+        no two closer than min_center_distance (the higher one is kept). """
+
+    # Maxima of square neighborhoods inscribed in the minimal distance are the candidates, computed for
+    # the whole accumulator at once (square kernels are much faster to dilate with than round ones):
+    half_size = max(1, min(int(min_center_distance / np.sqrt(2)), MAX_PEAK_HALF_WINDOW))
+    dilated = cv2.dilate(accumulator, np.ones((2 * half_size + 1, 2 * half_size + 1), np.uint8))
+    ys, xs = np.nonzero((accumulator >= dilated) & (accumulator >= min_value))
+    values = accumulator[ys, xs]
+    if len(values) == 0:
+        return np.zeros((0, 2)), values
+
+    # Candidates closer than the minimal distance are resolved by value:
+    points = np.c_[xs, ys].astype(np.float64)
+    keep = remove_duplicate_circles(points, values, min_center_distance, np.arange(len(points)))
+    return points[keep], values[keep]
+
+
+def estimate_radii(points, directions_x, directions_y, radii):
+    """ Returns the index of the radius with the most edge support around each point. """
+
+    height, width = directions_x.shape
+    # Edges a pixel off the sampled ring count as well:
+    directions_x = cv2.blur(directions_x, (3, 3)).ravel()
+    directions_y = cv2.blur(directions_y, (3, 3)).ravel()
+
+    radius_indices = np.zeros(len(points), np.int64)
+    for start in range(0, len(points), RADIUS_ESTIMATION_CHUNK_SIZE):
+        centers = np.around(points[start:start + RADIUS_ESTIMATION_CHUNK_SIZE]).astype(np.int64)
+        supports = np.zeros((len(centers), len(radii)), np.float32)
+        for index, radius in enumerate(radii):
+            angles = np.linspace(0, 2 * np.pi, max(8, int(np.ceil(2 * np.pi * radius))), endpoint=False)
+            cos, sin = np.cos(angles).astype(np.float32), np.sin(angles).astype(np.float32)
+            xs = np.clip(centers[:, 0, None] + np.around(radius * cos).astype(np.int64)[None, :], 0, width - 1)
+            ys = np.clip(centers[:, 1, None] + np.around(radius * sin).astype(np.int64)[None, :], 0, height - 1)
+            indices = ys * width + xs
+            projections = directions_x[indices] * cos + directions_y[indices] * sin
+            supports[:, index] = np.abs(np.mean(projections, axis=1))
+        radius_indices[start:start + len(centers)] = np.argmax(supports, axis=1)
+    return radius_indices
+
+
+def find_circles_fixed_radius(preprocessed_img, edge_detect_threshold, vote_threshold, min_radius, max_radius,
+                              min_center_distance):
+    """ Detects circles with radii in a narrow range by the edge support along rings of the range.
+
+        The support of a center is the sum over the edge pixels at a distance in the radius range of
+        their gradient direction projected on the direction from the center, so the edges of a circle
+        add up (with the sign of its contrast, bright and dark circles are both found) and other edges
+        mostly cancel. It is computed for all centers at once as a correlation with a ring kernel, by
+        FFT, in memory independent of the number of edges. vote_threshold is the minimal fraction of
+        the (mean) perimeter supporting a center. Returns a float Nx3 array of circles, ordered by
+        decreasing support. """
+
+    radii = np.arange(min_radius, max_radius + 1)
+
+    with tracing.span('fixed_radius_support', radii=len(radii)):
+        directions_x, directions_y = get_edge_directions(preprocessed_img, edge_detect_threshold)
+        support = np.abs(correlate_ring(directions_x, directions_y, int(radii[0]), int(radii[-1])))
+
+        # Normalized by the perimeter, the threshold means the same at every radius:
+        support /= 2 * np.pi * np.mean(radii)
+
+    with tracing.span('fixed_radius_peaks') as span:
+        points, values = find_peaks(support, vote_threshold, min_center_distance)
+        circle_radii = radii[estimate_radii(points, directions_x, directions_y, radii)]
+        circles = np.c_[points, circle_radii].astype(np.float32)
+        span.set(circles=len(circles))
+
+    return circles[np.argsort(-values, kind='stable')]
+
+
+class FixedRadiusDetector:
+    # Version of the results, increased when the same parameters give different results (see result_cache):
+    VERSION = 2
+
+    # Parameters which only affect preprocess(), preprocessed images can be reused while these don't change:
+    PREPROCESSING_PARAMETERS = ['Blur', 'Thresholding area', 'Thresholding subtraction']
+
+    def __init__(self):
+        pass
+
+    @staticmethod
+    def get_name():
+        return "Fixed-Radius"
+
+    @staticmethod
+    def get_parameter_list():
+        return [
+            ['Edge detect threshold', 0, 200, 120],
+            # Minimal fraction of the perimeter voting for a circle:
+            ['Vote threshold %', 1, 100, 25],
+            ['Radius', 0, 100, 10],
+            ['Radius tolerance %', 0, 100, 10],
+            [r'Center distance (% of Radius)', 200, 800, 100],
+            ['Blur', 0, 15, 3],
+            ['Thresholding area', 0, 151, 0],
+            ['Thresholding subtraction', 0, 100, 4],
+            # Iterations of the sub-pixel refinement of the circles, 0 keeps whole pixels:
+            ['Refinement iterations', 0, 5, 0],
+        ]
+
+    @staticmethod
+    def scale_parameters(parameters, scale):
+        # Parameters for detecting the same circles on an image resized by the scale:
+        scaled_parameters = dict(parameters)
+        scaled_parameters['Radius'] = max(1, round(parameters['Radius'] * scale))
+        scaled_parameters['Blur'] = round(parameters['Blur'] * scale)
+        if parameters['Thresholding area'] > 0:
+            scaled_parameters['Thresholding area'] = max(3, round(parameters['Thresholding area'] * scale))
+        return scaled_parameters
+
+    @staticmethod
+    def get_min_scale(parameters):
+        # Below this scale the circles are too small to be detected reliably:
+        return min(1.0, 4.0 / max(1, parameters['Radius']))
+
+    @staticmethod
+    def preprocess(img, parameters):
+        return preprocess_image(
+            img,
+            parameters['Blur'],
+            parameters['Thresholding area'],
+            parameters['Thresholding subtraction'])
+
+    @staticmethod
+    def evaluate_preprocessed(preprocessed_img, parameters):
+        if len(preprocessed_img) == 0:
+            return []
+
+        min_radius, max_radius = get_radius_range(parameters['Radius'], parameters['Radius tolerance %'])
+        circles = find_circles_fixed_radius(
+            preprocessed_img,
+            parameters['Edge detect threshold'],
+            parameters['Vote threshold %'] / 100.0,
+            min_radius,
+            max_radius,
+            min_radius * parameters[r'Center distance (% of Radius)'] / 100.0)
+
+        if len(circles) == 0:
+            return []
+
+        return np.uint16(np.around(circles))
+
+    @staticmethod
+    def evaluate(img, parameters):
+        if len(img) == 0:
+            return []
+        return FixedRadiusDetector.evaluate_preprocessed(FixedRadiusDetector.preprocess(img, parameters), parameters)
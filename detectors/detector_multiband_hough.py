@@ -0,0 +1,155 @@
+import concurrent.futures
+import os
+import cv2
+import numpy as np
+import tracing
+from detectors.detector_opencv_hough import (
+    circle_edge_support,
+    detect_circles,
+    get_radius_range,
+    preprocess_image,
+    remove_duplicate_circles,
+)
+
+
+# Number of radius bands of the detector, bands with a radius of 0 are disabled:
+BAND_COUNT = 3
+
+
+def find_circles_multiband(preprocessed_img, edge_detect_threshold, bands, center_distance_mult, tile_size=0,
+                           worker_count=None):
+    """ Detects the circles of every (band number, radius, radius tolerance %, circle threshold) band
+        on the same preprocessed image, in parallel threads.
+
+        Circles of different bands closer than the larger of their bands' minimal center distances
+        are resolved by keeping the circle with more edge support. Returns a Nx4 array of
+        (x, y, r, band number). """
+
+    def detect_band(band):
+        band_number, radius, radius_tolerance, circle_threshold = band
+        min_radius, max_radius = get_radius_range(radius, radius_tolerance)
+        min_center_distance = min_radius * center_distance_mult
+        with tracing.span('detect_band', band=band_number, radius=radius, radius_tolerance=radius_tolerance) as span:
+            circles = detect_circles(
+                preprocessed_img, edge_detect_threshold, circle_threshold, min_radius, max_radius, min_center_distance,
+                tile_size)
+            span.set(circles=len(circles))
+        return circles, min_center_distance
+
+    # cv2.HoughCircles releases the GIL, so the bands are processed in parallel threads:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=worker_count or os.cpu_count()) as executor:
+        band_results = list(executor.map(detect_band, bands))
+
+    circles = np.concatenate([np.zeros((0, 3), np.float32)] + [circles for circles, distance in band_results])
+    band_numbers = np.repeat([band[0] for band in bands], [len(circles) for circles, distance in band_results])
+    min_center_distances = np.repeat([distance for circles, distance in band_results],
+                                     [len(circles) for circles, distance in band_results])
+
+    if len(bands) > 1 and len(circles) > 1:
+        with tracing.span('resolve_band_overlaps', circles=len(circles)):
+            edges = cv2.Canny(preprocessed_img, max(1, edge_detect_threshold // 2), edge_detect_threshold)
+            scores = circle_edge_support(edges, circles)
+            keep = remove_duplicate_circles(circles, scores, min_center_distances, band_numbers)
+            circles = circles[keep]
+            band_numbers = band_numbers[keep]
+
+    return np.c_[circles, band_numbers]
+
+
+def get_bands(parameters):
+    # The enabled (band number, radius, radius tolerance %, circle threshold) bands of the parameters:
+    bands = []
+    for band in range(1, BAND_COUNT + 1):
+        radius = parameters[f'Band {band} radius']
+        if radius > 0:
+            bands.append((band, radius, parameters[f'Band {band} radius tolerance %'],
+                          parameters[f'Band {band} circle threshold']))
+    return bands
+
+
+class MultiBandHoughDetector:
+    # Version of the results, increased when the same parameters give different results (see result_cache):
+    VERSION = 1
+
+    # Parameters which only affect preprocess(), preprocessed images can be reused while these don't change:
+    PREPROCESSING_PARAMETERS = ['Blur', 'Thresholding area', 'Thresholding subtraction']
+
+    def __init__(self):
+        pass
+
+    @staticmethod
+    def get_name():
+        return "OpenCV-Hough-Multiband"
+
+    @staticmethod
+    def get_parameter_list():
+        parameters = [['Edge detect threshold', 0, 200, 120]]
+        default_radii = [10, 20, 0]
+        for band in range(1, BAND_COUNT + 1):
+            parameters += [
+                [f'Band {band} radius', 0, 100, default_radii[band - 1]],
+                [f'Band {band} radius tolerance %', 0, 100, 10],
+                [f'Band {band} circle threshold', 1, 10, 4],
+            ]
+        parameters += [
+            [r'Center distance (% of Radius)', 200, 800, 100],
+            ['Blur', 0, 15, 3],
+            ['Thresholding area', 0, 151, 0],
+            ['Thresholding subtraction', 0, 100, 4],
+            ['Tile size', 0, 4096, 0],
+            # Iterations of the sub-pixel refinement of the circles, 0 keeps whole pixels:
+            ['Refinement iterations', 0, 5, 0],
+        ]
+        return parameters
+
+    @staticmethod
+    def scale_parameters(parameters, scale):
+        # Parameters for detecting the same circles on an image resized by the scale:
+        scaled_parameters = dict(parameters)
+        for band in range(1, BAND_COUNT + 1):
+            if parameters[f'Band {band} radius'] > 0:
+                scaled_parameters[f'Band {band} radius'] = max(1, round(parameters[f'Band {band} radius'] * scale))
+        scaled_parameters['Blur'] = round(parameters['Blur'] * scale)
+        if parameters['Thresholding area'] > 0:
+            scaled_parameters['Thresholding area'] = max(3, round(parameters['Thresholding area'] * scale))
+        if parameters.get('Tile size', 0) > 0:
+            scaled_parameters['Tile size'] = max(1, round(parameters['Tile size'] * scale))
+        return scaled_parameters
+
+    @staticmethod
+    def get_min_scale(parameters):
+        # The smallest band limits the downscaling:
+        radii = [band[1] for band in get_bands(parameters)]
+        return min(1.0, 4.0 / max(1, min(radii, default=1)))
+
+    @staticmethod
+    def preprocess(img, parameters):
+        return preprocess_image(
+            img,
+            parameters['Blur'],
+            parameters['Thresholding area'],
+            parameters['Thresholding subtraction'])
+
+    @staticmethod
+    def evaluate_preprocessed(preprocessed_img, parameters):
+        bands = get_bands(parameters)
+        if len(preprocessed_img) == 0 or len(bands) == 0:
+            return []
+
+        circles = find_circles_multiband(
+            preprocessed_img,
+            parameters['Edge detect threshold'],
+            bands,
+            parameters[r'Center distance (% of Radius)'] / 100.0,
+            parameters.get('Tile size', 0))
+
+        if len(circles) == 0:
+            return []
+
+        return np.uint16(np.around(circles))
+
+    @staticmethod
+    def evaluate(img, parameters):
+        if len(img) == 0:
+            return []
+        return MultiBandHoughDetector.evaluate_preprocessed(MultiBandHoughDetector.preprocess(img, parameters), parameters)
@@ -1,6 +1,251 @@
+import concurrent.futures
+import os
 import cv2
 import numpy as np
+from scipy import spatial
 from helpers import nearest_odd
+import tracing
+
+
+def preprocess_image(img, blur, threshold_area, threshold_subtraction):
+    preprocessed_img = img
+
+    if blur > 0:
+        with tracing.span('median_blur', kernel=nearest_odd(blur)):
+            preprocessed_img = cv2.medianBlur(preprocessed_img, nearest_odd(blur))
+
+    if threshold_area > 0:
+        with tracing.span('adaptive_threshold', block_size=nearest_odd(threshold_area)):
+            preprocessed_img = cv2.adaptiveThreshold(
+                preprocessed_img,
+                255,
+                cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                cv2.THRESH_BINARY,
+                nearest_odd(threshold_area),
+                threshold_subtraction)
+
+    return preprocessed_img
+
+
+def get_radius_range(radius, radius_tolerance):
+    radius_tolerance_abs = radius * radius_tolerance / 100.0
+    min_radius = max(1, round(radius - radius_tolerance_abs))
+    max_radius = max(1, round(radius + radius_tolerance_abs))
+    return min_radius, max_radius
+
+
+def hough_circles(preprocessed_img, edge_detect_threshold, circle_threshold, min_radius, max_radius, min_center_distance):
+    """ Returns the circles found by cv2.HoughCircles as a float Nx3 array, ordered by decreasing accumulator value. """
+
+    with tracing.span('hough_circles', width=preprocessed_img.shape[1], height=preprocessed_img.shape[0],
+                      min_radius=min_radius, max_radius=max_radius) as span:
+        circles = cv2.HoughCircles(
+            preprocessed_img,
+            cv2.HOUGH_GRADIENT,
+            1,
+            min_center_distance,
+            param1=edge_detect_threshold,
+            param2=circle_threshold,
+            minRadius=min_radius,
+            maxRadius=max_radius)
+        span.set(circles=0 if circles is None else circles.shape[1])
+
+    if circles is None:
+        return np.zeros((0, 3), np.float32)
+
+    return circles[0, :]
+
+
+def circle_edge_support(edges, circles, sample_count=64):
+    """ Returns the fraction of the perimeter of each circle that lies on an edge pixel.
+
+        This is the quantity the Hough accumulator votes for, so it is used to compare
+        detections which come from different accumulators (eg. from different tiles). """
+
+    if len(circles) == 0:
+        return np.zeros(0)
+
+    angles = np.linspace(0, 2 * np.pi, sample_count, endpoint=False)
+    xs = np.around(circles[:, 0, None] + circles[:, 2, None] * np.cos(angles)[None, :]).astype(np.int64)
+    ys = np.around(circles[:, 1, None] + circles[:, 2, None] * np.sin(angles)[None, :]).astype(np.int64)
+
+    height, width = edges.shape[:2]
+    inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+    on_edge = edges[np.clip(ys, 0, height - 1), np.clip(xs, 0, width - 1)] > 0
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.nan_to_num((on_edge & inside).sum(axis=1) / inside.sum(axis=1))
+
+
+def remove_duplicate_circles(circles, scores, min_center_distance, groups):
+    """ Removes circles closer than min_center_distance to a higher scoring circle of another group.
+
+        Circles of the same group were already separated by the detector, so only
+        pairs of different groups are checked. min_center_distance can also be given
+        per circle, then the larger distance of a pair applies. Returns the mask of kept circles. """
+
+    keep = np.ones(len(circles), bool)
+    if len(circles) < 2:
+        return keep
+
+    min_center_distances = np.broadcast_to(np.asarray(min_center_distance, np.float64), (len(circles),))
+    tree = spatial.cKDTree(circles[:, :2])
+    pairs = tree.query_pairs(np.max(min_center_distances), output_type='ndarray')
+    pairs = pairs[groups[pairs[:, 0]] != groups[pairs[:, 1]]]
+    if not np.isscalar(min_center_distance):
+        distances = np.hypot(*(circles[pairs[:, 0], :2] - circles[pairs[:, 1], :2]).T)
+        pairs = pairs[distances <= np.maximum(min_center_distances[pairs[:, 0]], min_center_distances[pairs[:, 1]])]
+    if len(pairs) == 0:
+        return keep
+
+    # Resolve the conflicts starting from the strongest circles:
+    pair_scores = np.maximum(scores[pairs[:, 0]], scores[pairs[:, 1]])
+    for i, j in pairs[np.argsort(-pair_scores, kind='stable')]:
+        if keep[i] and keep[j]:
+            if scores[i] >= scores[j]:
+                keep[j] = False
+            else:
+                keep[i] = False
+
+    return keep
+
+
+def get_tiles(width, height, tile_size, halo):
+    """ Returns the (core, outer) areas of the tiles covering the image.
+
+        The cores partition the image, the outer area extends the core by the halo
+        (within the image) so circles near the core's border are fully visible. """
+
+    tiles = []
+    for y0 in range(0, height, tile_size):
+        for x0 in range(0, width, tile_size):
+            x1 = min(x0 + tile_size, width)
+            y1 = min(y0 + tile_size, height)
+            core = (x0, y0, x1, y1)
+            outer = (max(0, x0 - halo), max(0, y0 - halo), min(width, x1 + halo), min(height, y1 + halo))
+            tiles.append((core, outer))
+    return tiles
+
+
+def get_tile_halo(max_radius, min_center_distance):
+    # A circle centered on the border of a tile's core has to be fully visible, along with any
+    # circle which could suppress it (closer than the minimal distance) and that circle's perimeter.
+    # A few additional pixels cover the support of the edge detection kernels:
+    return int(np.ceil(min_center_distance + 2 * max_radius)) + 4
+
+
+def get_tile_size(tile_size, halo):
+    # Tiles much smaller than their halo would mostly process overlapping areas:
+    return max(int(tile_size), 8 * halo)
+
+
+def find_circles_tiled(preprocessed_img, edge_detect_threshold, circle_threshold, min_radius, max_radius, min_center_distance,
+                       tile_size, worker_count=None):
+    height, width = preprocessed_img.shape[:2]
+    halo = get_tile_halo(max_radius, min_center_distance)
+    tiles = get_tiles(width, height, tile_size, halo)
+
+    def detect_tile(tile):
+        (cx0, cy0, cx1, cy1), (ox0, oy0, ox1, oy1) = tile
+        circles = hough_circles(
+            preprocessed_img[oy0:oy1, ox0:ox1],
+            edge_detect_threshold,
+            circle_threshold,
+            min_radius,
+            max_radius,
+            min_center_distance)
+        circles = circles + np.array([ox0, oy0, 0], np.float32)
+
+        # Keep the circles owned by the tile, others are found in the tile containing their center:
+        owned = ((circles[:, 0] >= cx0) & (circles[:, 0] < cx1) &
+                 (circles[:, 1] >= cy0) & (circles[:, 1] < cy1))
+        return circles[owned]
+
+    # cv2.HoughCircles releases the GIL, so the tiles are processed in parallel threads:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=worker_count or os.cpu_count()) as executor:
+        tile_circles = list(executor.map(detect_tile, tiles))
+
+    circles = np.concatenate(tile_circles) if len(tile_circles) > 0 else np.zeros((0, 3), np.float32)
+    groups = np.repeat(np.arange(len(tile_circles)), [len(c) for c in tile_circles])
+
+    # Remove duplicates along the seams, using the same edge map as cv2.HoughCircles to score the circles:
+    with tracing.span('remove_seam_duplicates', tiles=len(tiles), circles=len(circles)):
+        edges = cv2.Canny(preprocessed_img, max(1, edge_detect_threshold // 2), edge_detect_threshold)
+        scores = circle_edge_support(edges, circles)
+        keep = remove_duplicate_circles(circles, scores, min_center_distance, groups)
+
+    return circles[keep]
+
+
+def get_preprocessing_margin(blur, threshold_area):
+    # Distance up to which preprocessing (median blur, adaptive threshold) is affected by the image's border:
+    margin = nearest_odd(blur) // 2 if blur > 0 else 0
+    if threshold_area > 0:
+        margin += nearest_odd(threshold_area) // 2
+    return margin
+
+
+def find_circles_in_regions(
+        img,
+        edge_detect_threshold,
+        circle_threshold,
+        radius,
+        radius_tolerance,
+        center_distance_mult,
+        blur,
+        threshold_area,
+        threshold_subtraction,
+        regions,
+        kept_circles,
+        worker_count=None):
+    """ Detects the circles centered in the regions (x0, y0, x1, y1) of the image and merges them with
+        the kept circles, which were detected earlier. Every region is processed with a margin around it,
+        so the result matches detecting on the whole image. Newly detected circles too close to a kept
+        circle are dropped. """
+
+    min_radius, max_radius = get_radius_range(radius, radius_tolerance)
+    min_center_distance = min_radius * center_distance_mult
+    margin = get_tile_halo(max_radius, min_center_distance) + get_preprocessing_margin(blur, threshold_area)
+
+    height, width = img.shape[:2]
+
+    def detect_region(region):
+        x0, y0, x1, y1 = region
+        ox0, oy0, ox1, oy1 = max(0, x0 - margin), max(0, y0 - margin), min(width, x1 + margin), min(height, y1 + margin)
+        preprocessed_img = preprocess_image(img[oy0:oy1, ox0:ox1], blur, threshold_area, threshold_subtraction)
+        circles = hough_circles(
+            preprocessed_img,
+            edge_detect_threshold,
+            circle_threshold,
+            min_radius,
+            max_radius,
+            min_center_distance)
+
+        # Keep the circles owned by the region, scored by their edge support like the circles of tiles:
+        owned = ((circles[:, 0] + ox0 >= x0) & (circles[:, 0] + ox0 < x1) &
+                 (circles[:, 1] + oy0 >= y0) & (circles[:, 1] + oy0 < y1))
+        circles = circles[owned]
+        edges = cv2.Canny(preprocessed_img, max(1, edge_detect_threshold // 2), edge_detect_threshold)
+        scores = circle_edge_support(edges, circles)
+        return circles + np.array([ox0, oy0, 0], np.float32), scores
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=worker_count or os.cpu_count()) as executor:
+        region_results = list(executor.map(detect_region, regions))
+
+    # The kept circles are preferred, they were detected seeing all of their surroundings:
+    kept_circles = np.asarray(kept_circles, np.float32).reshape(-1, 3)
+    circles = np.concatenate([kept_circles] + [circles for circles, scores in region_results])
+    scores = np.concatenate([np.full(len(kept_circles), np.inf)] + [scores for circles, scores in region_results])
+    groups = np.repeat(np.arange(len(region_results) + 1),
+                       [len(kept_circles)] + [len(circles) for circles, scores in region_results])
+
+    keep = remove_duplicate_circles(circles, scores, min_center_distance, groups)
+    circles = circles[keep]
+
+    if len(circles) == 0:
+        return []
+
+    return np.uint16(np.around(circles))
 
 
 def find_circles(
@@ -12,47 +257,65 @@ def find_circles(
         center_distance_mult,
         blur,
         threshold_area,
-        threshold_subtraction):
+        threshold_subtraction,
+        tile_size=0):
 
     if len(img) == 0:
         return []
 
-    preprocessed_img = img
+    preprocessed_img = preprocess_image(img, blur, threshold_area, threshold_subtraction)
 
-    if blur > 0:
-        preprocessed_img = cv2.medianBlur(preprocessed_img, nearest_odd(blur))
+    return find_circles_in_preprocessed_image(
+        preprocessed_img, edge_detect_threshold, circle_threshold, radius, radius_tolerance, center_distance_mult, tile_size)
 
-    if threshold_area > 0:
-        preprocessed_img = cv2.adaptiveThreshold(
-            preprocessed_img,
-            255,
-            cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-            cv2.THRESH_BINARY,
-            nearest_odd(threshold_area),
-            threshold_subtraction)
 
-    radius_tolerance_abs = radius * radius_tolerance / 100.0
-    min_radius = max(1, round(radius - radius_tolerance_abs))
-    max_radius = max(1, round(radius + radius_tolerance_abs))
+def find_circles_in_preprocessed_image(
+        preprocessed_img,
+        edge_detect_threshold,
+        circle_threshold,
+        radius,
+        radius_tolerance,
+        center_distance_mult,
+        tile_size=0):
+
+    if len(preprocessed_img) == 0:
+        return []
+
+    min_radius, max_radius = get_radius_range(radius, radius_tolerance)
     min_center_distance = min_radius * center_distance_mult
 
-    circles = cv2.HoughCircles(
-        preprocessed_img,
-        cv2.HOUGH_GRADIENT,
-        1,
-        min_center_distance,
-        param1=edge_detect_threshold,
-        param2=circle_threshold,
-        minRadius=min_radius,
-        maxRadius=max_radius)
+    circles = detect_circles(
+        preprocessed_img, edge_detect_threshold, circle_threshold, min_radius, max_radius, min_center_distance, tile_size)
 
-    if circles is None:
+    if len(circles) == 0:
         return []
 
-    return np.uint16(np.around(circles[0, :]))
+    return np.uint16(np.around(circles))
+
+
+def detect_circles(preprocessed_img, edge_detect_threshold, circle_threshold, min_radius, max_radius, min_center_distance,
+                   tile_size=0):
+    """ Returns the circles of the preprocessed image as a float Nx3 array, tiled if the image is larger than the tile size. """
+
+    height, width = preprocessed_img.shape[:2]
+    if tile_size > 0:
+        tile_size = get_tile_size(tile_size, get_tile_halo(max_radius, min_center_distance))
+
+    if tile_size > 0 and (width > tile_size or height > tile_size):
+        return find_circles_tiled(
+            preprocessed_img, edge_detect_threshold, circle_threshold, min_radius, max_radius, min_center_distance, tile_size)
+
+    return hough_circles(
+        preprocessed_img, edge_detect_threshold, circle_threshold, min_radius, max_radius, min_center_distance)
 
 
 class OpenCVHoughDetector:
+    # Version of the results, increased when the same parameters give different results (see result_cache):
+    VERSION = 1
+
+    # Parameters which only affect preprocess(), preprocessed images can be reused while these don't change:
+    PREPROCESSING_PARAMETERS = ['Blur', 'Thresholding area', 'Thresholding subtraction']
+
     def __init__(self):
         pass
 
@@ -71,11 +334,41 @@ class OpenCVHoughDetector:
             ['Blur', 0, 15, 3],
             ['Thresholding area', 0, 151, 0],
             ['Thresholding subtraction', 0, 100, 4],
+            # Minimal tile size for multi-core detection of large images, 0 disables tiling:
+            ['Tile size', 0, 4096, 0],
+            # Iterations of the sub-pixel refinement of the circles, 0 keeps whole pixels:
+            ['Refinement iterations', 0, 5, 0],
         ]
 
     @staticmethod
-    def evaluate(img, parameters):
-        return find_circles(
+    def scale_parameters(parameters, scale):
+        # Parameters for detecting the same circles on an image resized by the scale:
+        scaled_parameters = dict(parameters)
+        scaled_parameters['Radius'] = max(1, round(parameters['Radius'] * scale))
+        scaled_parameters['Blur'] = round(parameters['Blur'] * scale)
+        if parameters['Thresholding area'] > 0:
+            scaled_parameters['Thresholding area'] = max(3, round(parameters['Thresholding area'] * scale))
+        if parameters.get('Tile size', 0) > 0:
+            scaled_parameters['Tile size'] = max(1, round(parameters['Tile size'] * scale))
+        return scaled_parameters
+
+    @staticmethod
+    def get_min_scale(parameters):
+        # Below this scale the circles are too small to be detected reliably:
+        return min(1.0, 4.0 / max(1, parameters['Radius']))
+
+    @staticmethod
+    def get_margin(parameters):
+        # Distance from the border of an image within which detections depend on the pixels beyond the border:
+        min_radius, max_radius = get_radius_range(parameters['Radius'], parameters['Radius tolerance %'])
+        min_center_distance = min_radius * parameters[r'Center distance (% of Radius)'] / 100.0
+        # Preprocessing near the border also depends on the pixels beyond it, as in find_circles_in_regions:
+        return (get_tile_halo(max_radius, min_center_distance) +
+                get_preprocessing_margin(parameters['Blur'], parameters['Thresholding area']))
+
+    @staticmethod
+    def update_circles(img, parameters, kept_circles, regions):
+        return find_circles_in_regions(
             img,
             parameters['Edge detect threshold'],
             parameters['Circle threshold'],
@@ -84,5 +377,32 @@ class OpenCVHoughDetector:
             parameters[r'Center distance (% of Radius)'] / 100.0,
             parameters['Blur'],
             parameters['Thresholding area'],
-            parameters['Thresholding subtraction']
+            parameters['Thresholding subtraction'],
+            regions,
+            kept_circles)
+
+    @staticmethod
+    def preprocess(img, parameters):
+        return preprocess_image(
+            img,
+            parameters['Blur'],
+            parameters['Thresholding area'],
+            parameters['Thresholding subtraction'])
+
+    @staticmethod
+    def evaluate_preprocessed(preprocessed_img, parameters):
+        return find_circles_in_preprocessed_image(
+            preprocessed_img,
+            parameters['Edge detect threshold'],
+            parameters['Circle threshold'],
+            parameters['Radius'],
+            parameters['Radius tolerance %'],
+            parameters[r'Center distance (% of Radius)'] / 100.0,
+            parameters.get('Tile size', 0)
         )
+
+    @staticmethod
+    def evaluate(img, parameters):
+        if len(img) == 0:
+            return []
+        return OpenCVHoughDetector.evaluate_preprocessed(OpenCVHoughDetector.preprocess(img, parameters), parameters)
@@ -0,0 +1,70 @@
+import math
+import numpy as np
+import cv2
+
+
+# Largest zoom (display pixels per image pixel):
+MAX_DISPLAY_SCALE = 16.0
+
+
+class DisplayPyramid:
+    """ Downscaled copies of an image (level i is scaled by 1/2^i) for displaying it at any scale.
+
+        The visible part of the image is rendered from the smallest level which is still at least as
+        large as the display, so the cost of rendering depends on the size of the view and not on the
+        size of the image. Levels are created on first use. """
+
+    def __init__(self, image):
+        self.levels = [np.asarray(image)]
+
+    @property
+    def width(self):
+        return self.levels[0].shape[1]
+
+    @property
+    def height(self):
+        return self.levels[0].shape[0]
+
+    @property
+    def nbytes(self):
+        return sum(level.nbytes for level in self.levels)
+
+    def get_level(self, level):
+        while len(self.levels) <= level:
+            previous_level = self.levels[-1]
+            size = (max(1, previous_level.shape[1] // 2), max(1, previous_level.shape[0] // 2))
+            self.levels.append(cv2.resize(previous_level, size, interpolation=cv2.INTER_AREA))
+        return self.levels[level]
+
+    def choose_level(self, scale):
+        # The smallest level not smaller than the display, levels below 1 pixel are not created:
+        if scale >= 1.0:
+            return 0
+        max_level = max(0, int(math.log2(max(1, min(self.width, self.height)))))
+        return min(int(math.floor(math.log2(1.0 / scale))), max_level)
+
+    def render(self, origin, scale, view_size):
+        """ Returns the view of the image from origin (image coordinates of the top left corner of
+            the view) scaled by scale, as an array of view_size (width, height). Parts of the view
+            outside the image are black. """
+
+        level = self.choose_level(scale)
+        level_image = self.get_level(level)
+        level_scale = 0.5 ** level
+
+        # Maps the view pixels to the pixels of the level (pixel centers are at integer coordinates),
+        # only the pixels of the view are computed:
+        step = level_scale / scale
+        view_to_level = np.array([
+            [step, 0.0, level_scale * (origin[0] + 0.5 / scale) - 0.5],
+            [0.0, step, level_scale * (origin[1] + 0.5 / scale) - 0.5]])
+
+        # Zoomed in image pixels are shown as squares:
+        interpolation = cv2.INTER_NEAREST if scale > 1.0 else cv2.INTER_LINEAR
+        return cv2.warpAffine(level_image, view_to_level, tuple(view_size),
+                              flags=interpolation | cv2.WARP_INVERSE_MAP, borderMode=cv2.BORDER_CONSTANT)
+
+
+def image_to_view(xs, ys, origin, scale):
+    # View coordinates of image coordinates, matching DisplayPyramid.render:
+    return (xs + 0.5 - origin[0]) * scale - 0.5, (ys + 0.5 - origin[1]) * scale - 0.5
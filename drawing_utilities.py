@@ -1,7 +1,15 @@
+import functools
+import numpy as np
+import cv2
 import PIL
+import PIL.Image
 import PIL.ImageDraw
 import PIL.ImageFont
 
+# Upper bound for the number of pixel coordinates generated at once when drawing many circles:
+DRAW_CHUNK_SIZE = 1 << 22
+
+
 def rect_around(x, y, size, offset_x, offset_y):
     x1 = int(x) - int(size) + int(offset_x)
     y1 = int(y) - int(size) + int(offset_y)
@@ -9,41 +17,166 @@ def rect_around(x, y, size, offset_x, offset_y):
     y2 = int(y) + int(size) + int(offset_y)
     return [x1, y1, x2, y2]
 
+
+@functools.lru_cache(maxsize=None)
+def get_font(size):
+    try:
+        return PIL.ImageFont.truetype("cour.ttf", size)
+    except OSError:
+        # Courier is not available outside Windows:
+        try:
+            return PIL.ImageFont.load_default(size)
+        except TypeError:
+            # Pillow < 10.1 only has the default bitmap font, of a fixed size:
+            return PIL.ImageFont.load_default()
+
+
+@functools.lru_cache(maxsize=256)
+def get_text_bbox(text, font_size):
+    draw = PIL.ImageDraw.Draw(PIL.Image.new('1', (1, 1)))
+    return draw.multiline_textbbox((0, 0), text=text, font=get_font(font_size))
+
+
+@functools.lru_cache(maxsize=None)
+def circle_outline_offsets(radius):
+    # Pixel offsets of a one pixel wide circle outline, relative to the center:
+    mask = np.zeros((2 * radius + 1, 2 * radius + 1), np.uint8)
+    cv2.circle(mask, (radius, radius), radius, 1, 1)
+    dy, dx = np.nonzero(mask)
+    return dx - radius, dy - radius
+
+
+@functools.lru_cache(maxsize=None)
+def square_offsets(size):
+    # Pixel offsets of a filled (2*size+1)x(2*size+1) square, relative to the center:
+    dy, dx = np.mgrid[-size:size + 1, -size:size + 1]
+    return dx.ravel(), dy.ravel()
+
+
+def draw_shapes(pixels, width, height, centers_x, centers_y, offsets, color):
+    """ Sets the pixels of the shape (given by its pixel offsets) around every center to the color.
+
+        pixels is the image as a flat array of pixel values, color the value of one pixel. """
+
+    dx, dy = offsets
+    extent = max(int(np.max(np.abs(dx))), int(np.max(np.abs(dy))))
+
+    # Shapes fully inside the image don't need clipping, their pixels are addressed by flat
+    # offsets. Ordering them by position keeps the writes close to each other in memory:
+    interior = ((centers_x >= extent) & (centers_x < width - extent) &
+                (centers_y >= extent) & (centers_y < height - extent))
+    interior_centers = np.sort(centers_y[interior] * width + centers_x[interior])
+    flat_offsets = dy * width + dx
+
+    chunk_size = max(1, DRAW_CHUNK_SIZE // len(dx))
+    for chunk_start in range(0, len(interior_centers), chunk_size):
+        indices = interior_centers[chunk_start:chunk_start + chunk_size, None] + flat_offsets[None, :]
+        pixels[indices.ravel()] = color
+
+    border = ~interior
+    for chunk_start in range(0, np.count_nonzero(border), chunk_size):
+        xs = (centers_x[border][chunk_start:chunk_start + chunk_size, None] + dx[None, :]).ravel()
+        ys = (centers_y[border][chunk_start:chunk_start + chunk_size, None] + dy[None, :]).ravel()
+        inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+        pixels[ys[inside] * width + xs[inside]] = color
+
+
+def as_pixel_value(color):
+    # A color as a single value of the void pixel type used by draw_shapes:
+    return np.array([color], np.uint8).view(np.dtype((np.void, len(color))))[0]
+
+
 def draw_circles_on_image(img, active_image_area, circles, draw_perimeters, circle_classes = None, circle_class_colors = [(255, 0, 0), (0, 255, 0)]):
-    result_image = img
-
-    if len(circles) > 0:
-        # draw cirlces on image:
-        draw = PIL.ImageDraw.Draw(result_image)
-
-        offset_x, offset_y, dummy1, dummy2 = active_image_area
-
-        for index, circle in enumerate(circles):
-            circle_class = circle_classes[index] if circle_classes is not None else 0
-            color = circle_class_colors[circle_class]
-            center_x = circle[0]
-            center_y = circle[1]
-            radius = circle[2]
-            if draw_perimeters:
-                # draw the outer circle
-                draw.ellipse(rect_around(center_x, center_y, radius, offset_x,
-                                              offset_y), fill=None, outline=color, width=1)
-            # draw the center of the circle
-            center_point_size = 1
-            draw.rectangle(rect_around(center_x, center_y, center_point_size,
-                                       offset_x, offset_y), fill=color, outline=None, width=1)
+    """ Draws the circles onto the image, all circles of a class and radius at once.
+
+        The image is expected as a HxWx3 RGB numpy array (modified in place), PIL images are also accepted. """
+
+    if len(circles) == 0:
+        return
+
+    if isinstance(img, PIL.Image.Image):
+        buffer = np.array(img)
+        draw_circles_on_image(buffer, active_image_area, circles, draw_perimeters, circle_classes, circle_class_colors)
+        img.paste(PIL.Image.fromarray(buffer))
+        return
+
+    height, width = img.shape[:2]
+
+    # View the image as a flat array of whole pixels, so each pixel is written by a single assignment:
+    pixels = img.reshape(-1).view(np.dtype((np.void, img.shape[2])))
+
+    offset_x, offset_y, dummy1, dummy2 = active_image_area
+
+    circles = np.asarray(circles)
+    centers_x = np.around(circles[:, 0].astype(np.float64)).astype(np.int64) + int(offset_x)
+    centers_y = np.around(circles[:, 1].astype(np.float64)).astype(np.int64) + int(offset_y)
+    radii = np.around(circles[:, 2].astype(np.float64)).astype(np.int64)
+
+    if circle_classes is None or len(circle_classes) != len(circles):
+        circle_classes = np.zeros(len(circles), np.int64)
+    circle_classes = np.asarray(circle_classes)
+
+    for circle_class in np.unique(circle_classes):
+        color = as_pixel_value(circle_class_colors[int(circle_class)])
+        in_class = circle_classes == circle_class
+
+        if draw_perimeters:
+            # draw the outer circles
+            class_radii = radii[in_class]
+            for radius in np.unique(class_radii):
+                in_group = np.flatnonzero(in_class)[class_radii == radius]
+                draw_shapes(pixels, width, height, centers_x[in_group], centers_y[in_group],
+                            circle_outline_offsets(int(radius)), color)
+
+        # draw the centers of the circles
+        center_point_size = 1
+        draw_shapes(pixels, width, height, centers_x[in_class], centers_y[in_class],
+                    square_offsets(center_point_size), color)
+
+
+def draw_circle_masks(size, circles):
+    """ Returns the masks (uint8 arrays of the (width, height) size, 1 where drawn) of the outlines
+        and of the center points of the circles, drawn the same way as by draw_circles_on_image. """
+
+    width, height = size
+    perimeter_mask = np.zeros((height, width), np.uint8)
+    center_mask = np.zeros((height, width), np.uint8)
+    if len(circles) == 0:
+        return perimeter_mask, center_mask
+
+    circles = np.asarray(circles)
+    centers_x = np.around(circles[:, 0].astype(np.float64)).astype(np.int64)
+    centers_y = np.around(circles[:, 1].astype(np.float64)).astype(np.int64)
+    radii = np.around(circles[:, 2].astype(np.float64)).astype(np.int64)
+
+    for radius in np.unique(radii):
+        in_group = radii == radius
+        draw_shapes(perimeter_mask.reshape(-1), width, height, centers_x[in_group], centers_y[in_group],
+                    circle_outline_offsets(int(radius)), 1)
+    draw_shapes(center_mask.reshape(-1), width, height, centers_x, centers_y, square_offsets(1), 1)
+    return perimeter_mask, center_mask
+
 
 def draw_info_text_on_image(img, info_text):
-    draw = PIL.ImageDraw.Draw(img)
+    """ Draws the info text panel to the bottom left corner of the image (RGB numpy array or PIL image). """
 
-    font = PIL.ImageFont.truetype("cour.ttf", 20)
-    text_size = draw.multiline_textbbox((0, 0), text=info_text, font=font)
+    font_size = 20
+    text_size = get_text_bbox(info_text, font_size)
 
     padding = 5
 
-    pos_x = padding
-    pos_y = img.height - text_size[3] - padding
+    # Render only the panel, then copy it to the image:
+    panel_width = text_size[2] + padding + padding
+    panel_height = text_size[3] + padding + padding
+    panel = PIL.Image.new('RGB', (panel_width, panel_height), (255, 255, 255))
+    PIL.ImageDraw.Draw(panel).multiline_text((padding, padding), info_text, font=get_font(font_size), fill=(0, 0, 0))
+
+    if isinstance(img, PIL.Image.Image):
+        img.paste(panel, (0, img.height - panel_height))
+        return
 
-    draw.rectangle([0, pos_y - padding, text_size[2] + padding + padding,
-                    img.height], fill=(255, 255, 255), outline=None, width=1)
-    draw.multiline_text((pos_x, pos_y), info_text, font=font, fill=(0, 0, 0))
\ No newline at end of file
+    height, width = img.shape[:2]
+    panel_array = np.asarray(panel)
+    visible_height = min(panel_height, height)
+    visible_width = min(panel_width, width)
+    img[height - visible_height:, :visible_width] = panel_array[panel_height - visible_height:, :visible_width]
@@ -0,0 +1,117 @@
+import os
+import re
+import threading
+import numpy as np
+import PIL.Image
+
+from image_source import ImageSource, map_tiff_page, read_tiff_pages, reduce_to_8_bits, rgb_to_grayscale
+
+
+TIFF_EXTENSIONS = ('.tif', '.tiff')
+
+
+def natural_sort_key(path):
+    # Numbered file names sort by their numbers (frame_2 before frame_10):
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', path)]
+
+
+def convert_to_grayscale(img):
+    """ Converts a grayscale or RGB image of 8 or 16 bits to the 8 bit grayscale plane used for detection. """
+
+    if img.ndim == 3:
+        return rgb_to_grayscale(img[:, :, :3])
+    return reduce_to_8_bits(img)
+
+
+class TiffStackSource:
+    """ The pages of a multi-frame TIFF file as frames, read one at a time.
+
+        Uncompressed pages are memory mapped, other pages are decoded by PIL from a file kept open
+        by the source. Only the page directory is read up front, so the memory use doesn't depend on
+        the number of frames. """
+
+    def __init__(self, path):
+        self.path = path
+
+        # Pages which can't be memory mapped are None, pages is None if the file is left to PIL:
+        self.pages = read_tiff_pages(path)
+        if self.pages is not None:
+            self.frame_count = len(self.pages)
+        else:
+            with PIL.Image.open(path) as image:
+                self.frame_count = getattr(image, 'n_frames', 1)
+
+        # Decoder of the pages which aren't memory mapped, created on first use. Seeking to the next
+        # page of an open file is cheap, so frames read in order are not searched from the start:
+        self.decoder = None
+        self.decoder_lock = threading.Lock()
+
+    def __len__(self):
+        return self.frame_count
+
+    def get_frame_name(self, index):
+        return f'{self.path}[{index}]'
+
+    def read_frame(self, index):
+        """ Returns the 8 bit grayscale image of the frame (read only, may be memory mapped). """
+
+        if not 0 <= index < self.frame_count:
+            raise IndexError(f'Frame {index} out of range, {self.path} has {self.frame_count} frames')
+
+        page = self.pages[index] if self.pages is not None else None
+        if page is not None:
+            mapped_image = map_tiff_page(self.path, page)
+            if mapped_image.ndim == 2 and mapped_image.dtype == np.uint8:
+                return mapped_image
+            return convert_to_grayscale(mapped_image)
+
+        with self.decoder_lock:
+            if self.decoder is None:
+                self.decoder = PIL.Image.open(self.path)
+            self.decoder.seek(index)
+            image = self.decoder
+            if image.mode not in ('L', 'RGB', 'I;16', 'I;16B', 'I;16L'):
+                image = image.convert('RGB')
+            img = np.asarray(image)
+
+        return convert_to_grayscale(img)
+
+    def close(self):
+        with self.decoder_lock:
+            if self.decoder is not None:
+                self.decoder.close()
+                self.decoder = None
+
+
+class ImageSequenceSource:
+    """ A sequence of image files as frames, read one at a time. """
+
+    def __init__(self, paths):
+        self.paths = list(paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def get_frame_name(self, index):
+        return self.paths[index]
+
+    def read_frame(self, index):
+        """ Returns the 8 bit grayscale image of the frame (read only, may be memory mapped). """
+
+        return ImageSource(self.paths[index]).grayscale_image
+
+    def close(self):
+        pass
+
+
+def open_frame_source(image_paths):
+    """ Returns the frame source of the image paths: the pages of a single TIFF file with more than
+        one page, otherwise the images as a sequence in natural order (frame_2 before frame_10). """
+
+    if len(image_paths) == 1 and os.path.splitext(image_paths[0])[1].lower() in TIFF_EXTENSIONS:
+        source = TiffStackSource(image_paths[0])
+        if len(source) > 1:
+            return source
+        source.close()
+
+    return ImageSequenceSource(sorted(image_paths, key=natural_sort_key))
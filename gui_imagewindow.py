@@ -1,21 +1,45 @@
+import os.path
 import numpy as np
+import PIL.Image
 import tkinter as tk
 import tkinter.filedialog
 import tkinter.messagebox
 
-from helpers import convert_image_pil_to_tk, set_entry_text
+from helpers import convert_image_pil_to_tk, convert_mask_to_tk_bitmap, set_entry_text
 from custom_widgets import ToggleButton
 from histogram import show_histogram
+from aggregates import ResultAggregate
 from image_processor import ImageProcessor
+from background_evaluation import BackgroundEvaluator
+from display_pyramid import DisplayPyramid, MAX_DISPLAY_SCALE
+import tracing
+from results_export import ResultWriter, get_results
 
 
 class ImageFrame(tk.Frame):
+    """ Shows an image with zoom (mouse wheel) and pan (dragging with the right or middle button).
+
+        The image is rendered from a display pyramid and only the visible part of it is rendered.
+        The results are separate layers above it: transparent bitmaps of the circles of every class
+        (tagged 'perimeters' or 'centers' and 'class<N>'), returned by layer_callback(origin, scale,
+        view_size) as (class, perimeter mask, center mask) tuples, and the info panel (tagged 'info').
+        Showing, hiding and recoloring the layers doesn't render anything. Crop area and measurement
+        input is in image coordinates. """
+
+    # Zoom change of a mouse wheel step:
+    ZOOM_STEP = 1.25
+
+    # Color of the classes which are not highlighted:
+    DIMMED_COLOR = (128, 128, 128)
+
     def __init__(self, window, width, height):
         tk.Frame.__init__(self, window)
 
-        self.display_scale = 1.0
+        self.image_width = width
+        self.image_height = height
 
         # Scale to fit display
+        self.display_scale = 1.0
         screenw = self.winfo_screenwidth() * 0.75
         screenh = self.winfo_screenheight() * 0.75
         screenwscale = screenw / width
@@ -24,18 +48,34 @@ class ImageFrame(tk.Frame):
         if screenscale < 1.0:
             self.display_scale = screenscale
 
+        # View: size of the canvas, image coordinates of its top left corner, and the zoom relative
+        # to the scale fitting the whole image into the canvas:
+        self.view_size = (max(1, int(width * self.display_scale)), max(1, int(height * self.display_scale)))
+        self.origin = (0.0, 0.0)
+        self.zoom = 1.0
+
         # Create image canvas:
-        self.canvas = tk.Canvas(self, width=int(width * self.display_scale), height=int(height * self.display_scale))
+        self.canvas = tk.Canvas(self, width=self.view_size[0], height=self.view_size[1], highlightthickness=0)
         self.canvas.pack(expand=tk.YES, fill=tk.BOTH)
         self.canvas.pack_propagate(0)
 
         self.canvas.bind("<Button-1>", self.mouse_down)
         self.canvas.bind("<Motion>", self.mouse_move)
         self.canvas.bind("<Configure>", self.on_resize)
-
+        self.canvas.bind("<MouseWheel>", self.mouse_wheel)
+        self.canvas.bind("<Button-4>", self.mouse_wheel)
+        self.canvas.bind("<Button-5>", self.mouse_wheel)
+        for button in (2, 3):
+            self.canvas.bind(f"<ButtonPress-{button}>", self.pan_start)
+            self.canvas.bind(f"<B{button}-Motion>", self.pan_move)
+
+        # Input points, in image coordinates:
         self.input_top_left = (0, 0)
         self.input_bottom_right = (width, height)
 
+        # Canvas position and view origin at the start of panning:
+        self.pan_start_position = None
+
         self.measurement_line = None
         self.measurement_label = None
         self.scale_factor = 1.0
@@ -51,79 +91,191 @@ class ImageFrame(tk.Frame):
         self.crop_area_changed_callback = None
         self.measurement_finished_callback = None
 
-        # Create crop rectangle
+        # Returns the layers of the view, called with the origin, scale and size of the view:
+        self.layer_callback = None
+        self.layer_images = []
+
+        # Colors of the classes of the layers, the class shown in its color while the others are dimmed
+        # (None if all classes are shown in their colors), and the hidden tags:
+        self.class_colors = [(255, 0, 0), (0, 255, 0)]
+        self.highlighted_class = None
+        self.hidden_tags = set()
+
+        # Info panel, in the bottom left corner of the view:
+        self.info_background = self.canvas.create_rectangle(0, 0, 0, 0, fill='white', outline='', tags=('info',))
+        self.info_text = self.canvas.create_text(0, 0, text='', anchor=tk.SW, fill='black', font=('Courier', 14),
+                                                 tags=('info',))
+
+        # Create crop rectangle (the crop area is kept in image coordinates):
+        self.crop_area = (0, 0, width, height)
         self.crop_rectangle = self.canvas.create_rectangle(0, 0, 0, 0, outline='blue', width=3)
         self.update_crop_rectangle()
 
-        self.image = None
+        self.pyramid = None
         self.image_object = None
+        self.converted_image = None
+
+    def get_fit_scale(self):
+        return min(self.view_size[0] / self.image_width, self.view_size[1] / self.image_height)
+
+    def set_view(self, zoom, origin):
+        fit_scale = self.get_fit_scale()
+        self.zoom = min(max(zoom, 1.0), max(1.0, MAX_DISPLAY_SCALE / fit_scale))
+        self.display_scale = fit_scale * self.zoom
+
+        # Images smaller than the canvas are shown at the top left, larger ones can't be moved out of it:
+        visible_width = self.view_size[0] / self.display_scale
+        visible_height = self.view_size[1] / self.display_scale
+        self.origin = (min(max(origin[0], 0.0), max(0.0, self.image_width - visible_width)),
+                       min(max(origin[1], 0.0), max(0.0, self.image_height - visible_height)))
+        self.update_view()
+
+    def to_image_coords(self, x, y):
+        return (self.origin[0] + x / self.display_scale, self.origin[1] + y / self.display_scale)
+
+    def to_canvas_coords(self, x, y):
+        return ((x - self.origin[0]) * self.display_scale, (y - self.origin[1]) * self.display_scale)
 
     def on_resize(self, event):
-        if self.image:
-            wscale = event.width / self.image.width
-            hscale = event.height / self.image.height
+        self.view_size = (max(1, event.width), max(1, event.height))
+        self.set_view(self.zoom, self.origin)
+
+    def mouse_wheel(self, event):
+        zoom_in = event.num == 4 or event.delta > 0
+        factor = self.ZOOM_STEP if zoom_in else 1.0 / self.ZOOM_STEP
+
+        # The image point under the cursor stays in place:
+        x, y = self.to_image_coords(event.x, event.y)
+        zoom = self.zoom * factor
+        display_scale = self.get_fit_scale() * zoom
+        self.set_view(zoom, (x - event.x / display_scale, y - event.y / display_scale))
 
-            display_scale = min(wscale, hscale)
-            incremental_scale = display_scale / self.display_scale
-            self.display_scale = display_scale
+    def pan_start(self, event):
+        self.pan_start_position = (event.x, event.y, self.origin)
 
-            # rescale all the objects
-            self.canvas.scale("all", 0, 0, incremental_scale, incremental_scale)
-            self.update_image_object()
+    def pan_move(self, event):
+        if self.pan_start_position:
+            start_x, start_y, start_origin = self.pan_start_position
+            self.set_view(self.zoom, (start_origin[0] - (event.x - start_x) / self.display_scale,
+                                      start_origin[1] - (event.y - start_y) / self.display_scale))
 
     def get_active_crop_area(self):
-        x0, y0, x1, y1 = self.canvas.coords(self.crop_rectangle)
-        return (int(x0 / self.display_scale),
-                int(y0 / self.display_scale),
-                int(x1 / self.display_scale),
-                int(y1 / self.display_scale))
+        x0, y0, x1, y1 = self.crop_area
+        return (int(x0), int(y0), int(x1), int(y1))
 
     def set_active_crop_area(self, crop_area):
-        self.set_active_crop_area_display_coords((
-                           crop_area[0] * self.display_scale,
-                           crop_area[1] * self.display_scale,
-                           crop_area[2] * self.display_scale,
-                           crop_area[3] * self.display_scale))
-
-    # Sets the active crop area in display coordinates (for internal use)
-    def set_active_crop_area_display_coords(self, crop_area):
-        self.canvas.coords(self.crop_rectangle,
-                           crop_area[0],
-                           crop_area[1],
-                           crop_area[2],
-                           crop_area[3])
-        self.canvas.tag_raise(self.crop_rectangle)
+        self.crop_area = tuple(crop_area)
+        self.update_overlay_items()
 
-    # image expected as PIL image
+    # image expected as RGB numpy array or PIL image
     def set_image(self, image):
-        self.image = image
-        self.update_image_object()
+        self.pyramid = DisplayPyramid(np.asarray(image)) if image is not None else None
+        self.update_view()
+
+    def update_view(self):
+        """ Renders the visible part of the image and the result layers, eg. after the view changed. """
+
+        if self.pyramid:
+            with tracing.span('render_view', width=self.view_size[0], height=self.view_size[1]):
+                view_image = PIL.Image.fromarray(self.pyramid.render(self.origin, self.display_scale, self.view_size))
+
+                # The photo image is updated in place while the size of the view doesn't change:
+                if self.converted_image and (self.converted_image.width(), self.converted_image.height()) == view_image.size:
+                    self.converted_image.paste(view_image)
+                else:
+                    self.converted_image = convert_image_pil_to_tk(view_image)
+                    if self.image_object:
+                        self.canvas.delete(self.image_object)
+                    self.image_object = self.canvas.create_image(0, 0, image=self.converted_image, anchor=tk.NW)
+                    self.canvas.tag_lower(self.image_object)
+
+        self.update_layers()
+        self.update_overlay_items()
+
+    def update_layers(self):
+        """ Renders the result layers of the view again, eg. after the results changed. """
+
+        self.canvas.delete('layer')
+        self.layer_images = []
+        if not self.layer_callback:
+            return
 
-    def update_image_object(self):
-        if self.image_object:
-            self.canvas.delete(self.image_object)
+        with tracing.span('render_layers'):
+            for circle_class, perimeter_mask, center_mask in self.layer_callback(self.origin, self.display_scale, self.view_size):
+                for kind, mask in (('perimeters', perimeter_mask), ('centers', center_mask)):
+                    tags = ('layer', kind, f'class{circle_class}')
+                    bitmap = convert_mask_to_tk_bitmap(mask, self.get_layer_color(circle_class))
+                    state = tk.HIDDEN if self.hidden_tags.intersection(tags) else tk.NORMAL
+                    self.canvas.create_image(0, 0, image=bitmap, anchor=tk.NW, tags=tags, state=state)
+                    self.layer_images.append((circle_class, bitmap))
 
-        if self.image:
-            scaled_image = self.image.resize((int(self.image.width * self.display_scale),
-                                              int(self.image.height * self.display_scale)))
-            self.converted_image = convert_image_pil_to_tk(scaled_image)
-            self.image_object = self.canvas.create_image(0, 0, image=self.converted_image, anchor=tk.NW)
+        if self.image_object:
+            self.canvas.tag_raise('layer', self.image_object)
+
+    def get_layer_color(self, circle_class):
+        if self.highlighted_class is not None and circle_class != self.highlighted_class:
+            color = self.DIMMED_COLOR
+        else:
+            color = self.class_colors[circle_class % len(self.class_colors)]
+        return '#%02x%02x%02x' % tuple(color)
+
+    def update_layer_colors(self):
+        for circle_class, bitmap in self.layer_images:
+            bitmap.configure(foreground=self.get_layer_color(circle_class))
+
+    def set_class_colors(self, class_colors):
+        self.class_colors = list(class_colors)
+        self.update_layer_colors()
+
+    def set_highlighted_class(self, highlighted_class):
+        self.highlighted_class = highlighted_class
+        self.update_layer_colors()
+
+    def set_tag_visible(self, tag, visible):
+        # Shows or hides the layers of a tag (eg. 'perimeters', 'class1' or 'info'):
+        if visible:
+            self.hidden_tags.discard(tag)
+        else:
+            self.hidden_tags.add(tag)
+        for item in self.canvas.find_withtag(tag):
+            tags = self.canvas.gettags(item)
+            self.canvas.itemconfigure(item, state=tk.HIDDEN if self.hidden_tags.intersection(tags) else tk.NORMAL)
+
+    def set_info_text(self, text):
+        self.canvas.itemconfigure(self.info_text, text=text)
+        self.update_info_panel()
+
+    def update_info_panel(self):
+        # The panel stays in the bottom left corner of the view:
+        padding = 5
+        self.canvas.coords(self.info_text, padding, self.view_size[1] - padding)
+        x0, y0, x1, y1 = self.canvas.bbox(self.info_text) or (0, 0, 0, 0)
+        has_text = bool(self.canvas.itemcget(self.info_text, 'text'))
+        self.canvas.coords(self.info_background, *((0, y0 - padding, x1 + padding, self.view_size[1]) if has_text else (0, 0, 0, 0)))
+        self.canvas.tag_raise(self.info_background)
+        self.canvas.tag_raise(self.info_text)
+
+    def update_overlay_items(self):
+        # The crop rectangle and the measurement line follow the view:
+        self.canvas.coords(self.crop_rectangle,
+                           *self.to_canvas_coords(*self.crop_area[:2]),
+                           *self.to_canvas_coords(*self.crop_area[2:]))
+        self.canvas.tag_raise(self.crop_rectangle)
 
-            self.canvas.tag_raise(self.crop_rectangle)
+        if self.measurement_line:
+            self.update_measurement_line()
 
-            if self.measurement_line:
-                self.canvas.tag_raise(self.measurement_line)
-                self.canvas.tag_raise(self.measurement_label)
+        self.update_info_panel()
 
     def update_crop_rectangle(self):
-        self.set_active_crop_area_display_coords(self.input_top_left + self.input_bottom_right)
+        self.set_active_crop_area(self.input_top_left + self.input_bottom_right)
 
         if self.crop_area_changed_callback:
             self.crop_area_changed_callback()
 
     def update_measurement_line(self):
-        top_left = np.array(self.input_top_left)
-        bottom_right = np.array(self.input_bottom_right)
+        top_left = np.array(self.to_canvas_coords(*self.input_top_left))
+        bottom_right = np.array(self.to_canvas_coords(*self.input_bottom_right))
         input_vector = bottom_right - top_left
         mid_position = (bottom_right + top_left) / 2.0
         offset_vector = np.array([-input_vector[1], input_vector[0]])
@@ -132,34 +284,32 @@ class ImageFrame(tk.Frame):
         label_position = mid_position + offset_vector
 
         if not self.measurement_line:
-            self.measurement_line = self.canvas.create_line(self.input_top_left[0],
-                                                            self.input_top_left[1],
-                                                            self.input_bottom_right[0],
-                                                            self.input_bottom_right[1],
-                                                            fill='yellow',
-                                                            width=3)
+            self.measurement_line = self.canvas.create_line(*top_left, *bottom_right, fill='yellow', width=3)
             self.measurement_label = self.canvas.create_text(label_position[0],
                                                              label_position[1],
                                                              fill='yellow')
 
-        self.canvas.coords(self.measurement_line,
-                           self.input_top_left[0],
-                           self.input_top_left[1],
-                           self.input_bottom_right[0],
-                           self.input_bottom_right[1])
+        self.canvas.coords(self.measurement_line, *top_left, *bottom_right)
 
-        self.canvas.itemconfigure(self.measurement_label, text=str(
-            int(self.scale_factor * np.linalg.norm(input_vector))) + ' nm')
+        # The length is measured in image pixels:
+        measured_length = np.linalg.norm(np.array(self.input_bottom_right) - np.array(self.input_top_left))
+        self.canvas.itemconfigure(self.measurement_label, text=str(int(self.scale_factor * measured_length)) + ' nm')
         self.canvas.coords(self.measurement_label,
                            label_position[0],
                            label_position[1])
 
         self.canvas.tag_raise(self.measurement_line)
+        self.canvas.tag_raise(self.measurement_label)
+
+    def get_input_point(self, event):
+        # Image coordinates of the event, limited to the image:
+        x, y = self.to_image_coords(event.x, event.y)
+        return (min(max(x, 0), self.image_width), min(max(y, 0), self.image_height))
 
     def mouse_down(self, event):
         if 'Point1' in self.input_mode:
-            self.input_top_left = (event.x, event.y)
-            self.input_bottom_right = (event.x, event.y)
+            self.input_top_left = self.get_input_point(event)
+            self.input_bottom_right = self.input_top_left
 
         if self.input_mode == 'CropPoint1':
             self.update_crop_rectangle()
@@ -173,20 +323,13 @@ class ImageFrame(tk.Frame):
         elif self.input_mode == 'MeasurePoint2':
             if self.measurement_finished_callback:
                 input_vector = np.array(self.input_bottom_right) - np.array(self.input_top_left)
-                self.measurement_finished_callback(np.linalg.norm(input_vector) / self.display_scale)
+                self.measurement_finished_callback(np.linalg.norm(input_vector))
                 self.measurement_finished_callback = None
             self.input_mode = 'None'
 
     def mouse_move(self, event):
         if 'Point2' in self.input_mode:
-            x, y = event.x, event.y
-
-            # Limit input area to image size:
-            if self.image:
-                x = min(x, self.image.size[0])
-                y = min(y, self.image.size[1])
-
-            self.input_bottom_right = (x, y)
+            self.input_bottom_right = self.get_input_point(event)
 
         if self.input_mode == 'MeasurePoint2':
             self.update_measurement_line()
@@ -254,6 +397,9 @@ class MeasurementWindow(tk.Toplevel):
 
 
 class ImageWindow(tk.Toplevel):
+    # Delay after a preview evaluation before the full resolution pass is started:
+    FULL_RESOLUTION_DELAY_MS = 400
+
     def __init__(self, image_path, title):
         tk.Toplevel.__init__(self)
 
@@ -281,6 +427,18 @@ class ImageWindow(tk.Toplevel):
             command=self.button_toggled)
         self.info_button.pack(side=tk.LEFT)
 
+        self.background_button = ToggleButton(
+            self.button_frame,
+            text="Background",
+            width=12,
+            default_state=False,
+            command=self.button_toggled)
+        self.background_button.pack(side=tk.LEFT)
+
+        # Shows one class in its color and the others dimmed, cycling through the classes:
+        self.highlight_button = tk.Button(self.button_frame, text="Highlight", width=12, command=self.highlight_next_class)
+        self.highlight_button.pack(side=tk.LEFT)
+
         self.histogram_button = tk.Button(
             self.button_frame,
             text="Histogram",
@@ -297,56 +455,195 @@ class ImageWindow(tk.Toplevel):
         self.save_button = tk.Button(self.button_frame, text="Save", width=12, command=self.save_image)
         self.save_button.pack(side=tk.LEFT)
 
+        self.export_button = tk.Button(self.button_frame, text="Export", width=12, command=self.export_results)
+        self.export_button.pack(side=tk.LEFT)
+
+        # Evaluation status (busy indicator and latency of the last evaluation):
+        self.status_label = tk.Label(self.button_frame, text='', anchor=tk.W)
+        self.status_label.pack(side=tk.LEFT, padx=5)
+
+        # Memory used by the image (decoded image data and memory mapped file):
+        self.memory_label = tk.Label(self.button_frame, text='', anchor=tk.E)
+        self.memory_label.pack(side=tk.RIGHT, padx=5)
+
         self.on_button_toggle_callback = None
 
+        # Called with the window and the result when an evaluation has finished:
+        self.evaluation_finished_callback = None
+
         self.scale_factor = 1.0  # nm/px ratio
 
-        # Create image processor:
+        # Pending full resolution pass of progressive evaluation and its timer job:
+        self.full_resolution_request = None
+        self.full_resolution_job = None
+
+        # Create image processor, the results are drawn by the image frame only where they are visible:
         self.image_processor = ImageProcessor(image_path)
+        self.image_processor.render_result_images = False
+
+        # Evaluations run in a background thread, a new evaluation supersedes the running one:
+        self.evaluator = BackgroundEvaluator(
+            self,
+            self.image_processor.compute_evaluation,
+            self.on_evaluation_finished,
+            self.on_evaluation_busy_changed,
+            self.on_evaluation_failed)
+
+        # The evaluator's thread keeps the image processor alive until it is stopped:
+        self.bind('<Destroy>', self.on_destroy)
 
         # Create image frame:
         width, height = self.image_processor.get_image_size()
         self.frame = ImageFrame(self, width, height)
         self.frame.pack(fill=tk.BOTH, expand=True)
         self.frame.crop_area_changed_callback = self.on_crop_area_changed
+        self.frame.layer_callback = self.image_processor.render_result_layers
         self.image_processor.autodetect_crop_area()
         self.frame.set_active_crop_area(self.image_processor.active_crop_area)
 
-        self.update_result_image()
-
-    def evaluate(self, detector, processor, parameters):
-        self.image_processor.evaluate(detector, processor, parameters)
-        self.update_result_image()
+        self.update_base_image()
+
+    def evaluate(self, detector, processor, parameters, progressive=False):
+        # A new evaluation replaces the pending full resolution pass of the previous one:
+        self.cancel_full_resolution_pass()
+
+        crop_area = self.image_processor.active_crop_area
+        preview_level = 0
+        if progressive:
+            preview_level = self.image_processor.choose_preview_level(detector, parameters, crop_area)
+            if preview_level > 0:
+                self.full_resolution_request = (detector, processor, parameters, crop_area, 0)
+
+        self.evaluator.submit(detector, processor, parameters, crop_area, preview_level)
+
+    def cancel_full_resolution_pass(self):
+        self.full_resolution_request = None
+        if self.full_resolution_job:
+            self.after_cancel(self.full_resolution_job)
+            self.full_resolution_job = None
+
+    def start_full_resolution_pass(self):
+        self.full_resolution_job = None
+        if self.full_resolution_request:
+            self.evaluator.submit(*self.full_resolution_request)
+            self.full_resolution_request = None
+
+    def on_evaluation_finished(self, result):
+        self.image_processor.apply_evaluation(result)
+        if self.image_processor.draw_background:
+            # The background depends on the parameters:
+            self.update_base_image()
+        else:
+            self.update_result_image()
+        if result.preview_level > 0:
+            self.status_label.config(
+                text=f'Preview (1/{2 ** result.preview_level}) in {result.elapsed_time:.3f} s')
+
+            # Process the full resolution image if the parameters don't change for a while:
+            if self.full_resolution_request:
+                self.full_resolution_job = self.after(self.FULL_RESOLUTION_DELAY_MS, self.start_full_resolution_pass)
+        else:
+            self.status_label.config(text=f'Evaluated in {result.elapsed_time:.3f} s')
+
+        if self.evaluation_finished_callback:
+            self.evaluation_finished_callback(self, result)
+
+    def on_evaluation_failed(self, error):
+        self.cancel_full_resolution_pass()
+        self.status_label.config(text=f'Evaluation failed: {error}')
+
+    def on_destroy(self, event):
+        # The binding of the window also gets the events of its children:
+        if event.widget is self:
+            self.cancel_full_resolution_pass()
+            self.evaluator.shutdown()
+
+    def on_evaluation_busy_changed(self, is_busy):
+        if is_busy:
+            self.status_label.config(text='Evaluating...')
+            self.config(cursor='watch')
+        else:
+            self.config(cursor='')
 
     def update_result_image(self):
-        self.image_processor.update_result_image()
-        self.frame.set_image(self.image_processor.result_image)
+        # Only the result layers are drawn again, the displayed image is kept:
+        self.frame.set_class_colors(self.image_processor.get_class_colors())
+        self.frame.set_info_text(self.image_processor.get_info_text())
+        self.frame.update_layers()
+        self.update_memory_label()
+
+    def update_base_image(self):
+        image_processor = self.image_processor
+        self.frame.set_image(image_processor.render_base_image(
+            image_processor.processor, image_processor.active_crop_area, image_processor.parameters,
+            image_processor.draw_background))
+        self.update_memory_label()
+
+    def update_memory_label(self):
+        resident_bytes, mapped_bytes = self.image_processor.get_memory_usage()
+        if self.frame.pyramid:
+            resident_bytes += self.frame.pyramid.nbytes
+        text = f'Memory: {resident_bytes / 2 ** 20:.1f} MB'
+        if mapped_bytes > 0:
+            text += f' (+{mapped_bytes / 2 ** 20:.1f} MB mapped)'
+        self.memory_label.config(text=text)
 
     def button_toggled(self, button, button_is_pressed):
         button_id = button.config('text')[-1]
 
         if button_id == "Perimeter":
+            # Only the visibility of the layers changes:
             self.image_processor.draw_perimeters = button_is_pressed
-            self.update_result_image()
+            self.frame.set_tag_visible('perimeters', button_is_pressed)
 
         if button_id == "Info":
             self.image_processor.draw_info_text = button_is_pressed
-            self.update_result_image()
+            self.frame.set_tag_visible('info', button_is_pressed)
+
+        if button_id == "Background":
+            self.image_processor.draw_background = button_is_pressed
+            self.update_base_image()
 
         if button_id == "Histogram":
             if len(self.image_processor.circles) > 0:
-                # Display histogram:
-                diameters_in_nm = list(
-                    2 * int(circle[2] * self.scale_factor)
-                    for circle
-                    in self.image_processor.circles)
-                show_histogram(diameters_in_nm)
+                # Display histogram, from the aggregate of the results:
+                aggregate = ResultAggregate()
+                aggregate.add_image(*get_results(self.image_processor, self.scale_factor))
+                show_histogram(aggregate.diameter_histogram, aggregate.get_description())
+
+    def highlight_next_class(self):
+        # None (all classes in their colors), then every class in turn:
+        class_count = len(self.image_processor.get_class_colors())
+        highlighted_class = self.frame.highlighted_class
+        if highlighted_class is None:
+            highlighted_class = 0
+        elif highlighted_class + 1 < class_count:
+            highlighted_class += 1
+        else:
+            highlighted_class = None
+        self.frame.set_highlighted_class(highlighted_class)
 
     def save_image(self):
-        if self.frame.image:
-            file_types = [("JPEG", "*.jpg"), ("PNG", "*.png"), ("All Files", "*")]
-            file_path = tkinter.filedialog.asksaveasfilename(defaultextension=".jpg", filetypes=file_types)
-            self.frame.image.save(file_path)
+        file_types = [("JPEG", "*.jpg"), ("PNG", "*.png"), ("All Files", "*")]
+        file_path = tkinter.filedialog.asksaveasfilename(defaultextension=".jpg", filetypes=file_types)
+        if file_path:
+            # The full resolution result image is only rendered for saving:
+            self.image_processor.update_result_image()
+            self.image_processor.result_image.save(file_path)
+            self.image_processor.result_image = None
+
+    def export_results(self):
+        if self.image_processor.detector is None or self.image_processor.processor is None:
+            return
+
+        file_types = [("NumPy archive", "*.npz"), ("CSV tables", "*.csv")]
+        file_path = tkinter.filedialog.asksaveasfilename(defaultextension=".npz", filetypes=file_types)
+        if file_path:
+            # CSV results are written to <name>_images.csv and <name>_circles.csv:
+            base_path, extension = os.path.splitext(file_path)
+            summary, records = get_results(self.image_processor, self.scale_factor)
+            with ResultWriter(base_path, ['csv' if extension.lower() == '.csv' else 'npz']) as writer:
+                writer.add(summary, records)
 
     def change_scale_lenght(self, scale_factor):
         self.scale_factor = scale_factor
@@ -366,4 +663,7 @@ class ImageWindow(tk.Toplevel):
         self.frame.set_roi()
 
     def on_crop_area_changed(self):
+        # A running evaluation of the previous crop area is outdated:
+        self.cancel_full_resolution_pass()
+        self.evaluator.cancel()
         self.image_processor.set_active_crop_area(self.frame.get_active_crop_area())
@@ -4,9 +4,12 @@ from custom_widgets import ToggleButton
 import tkinter as tk
 from tkinter import ttk
 import tkinter.filedialog
-import json
 import math
 import os.path
+import tracing
+from parameters import read_parameter_file, write_parameter_file
+from result_cache import ResultCache, get_default_cache_directory
+from gui_summary_window import SummaryWindow
 
 
 class MainWindow(tk.Tk):
@@ -18,12 +21,19 @@ class MainWindow(tk.Tk):
         self.image_windows = {}
         self.active_image_window = None
 
+        # Summary of the images evaluated together with "Evaluate all", None while not shown:
+        self.summary_window = None
+
         self.auto_evaluate = False
+        self.progressive_evaluation = False
 
         # Load available algorithms:
         self.available_processors = ImageProcessor.get_available_processors()
         self.available_detectors = ImageProcessor.get_available_detectors()
 
+        # Results of earlier evaluations, shared by the image windows and kept across sessions:
+        self.result_cache = ResultCache(get_default_cache_directory())
+
         # Timer job for triggering auto evaluation:
         self.parameter_changed_job = None
 
@@ -60,20 +70,36 @@ class MainWindow(tk.Tk):
 
         open_button = tk.Button(button_frame, text="Open image", width=12, command=self.open_file)
         process_button = tk.Button(button_frame, text='Evaluate image', width=12, command=self.evaluate)
+        process_all_button = tk.Button(button_frame, text='Evaluate all', width=12, command=self.evaluate_all)
         auto_eval_button = ToggleButton(
             button_frame,
             text='Auto evaluation',
             width=12,
             default_state=False,
             command=self.toggle_auto_eval)
+        progressive_button = ToggleButton(
+            button_frame,
+            text='Progressive',
+            width=12,
+            default_state=False,
+            command=self.toggle_progressive_evaluation)
+        tracing_button = ToggleButton(
+            button_frame,
+            text='Tracing',
+            width=12,
+            default_state=False,
+            command=self.toggle_tracing)
         save_button = tk.Button(button_frame, text="Save parameters", width=12, command=self.save_parameters)
         load_button = tk.Button(button_frame, text="Load parameters", width=12, command=self.load_parameters)
 
         open_button.grid(row=0, column=0, pady=2, padx=2, sticky=tk.W)
         process_button.grid(row=0, column=1, pady=2, padx=2, sticky=tk.W)
-        auto_eval_button.grid(row=0, column=2, pady=2, padx=2, sticky=tk.W)
-        save_button.grid(row=0, column=3, pady=2, padx=2, sticky=tk.W)
-        load_button.grid(row=0, column=4, pady=2, padx=2, sticky=tk.W)
+        process_all_button.grid(row=0, column=2, pady=2, padx=2, sticky=tk.W)
+        auto_eval_button.grid(row=0, column=3, pady=2, padx=2, sticky=tk.W)
+        progressive_button.grid(row=0, column=4, pady=2, padx=2, sticky=tk.W)
+        tracing_button.grid(row=0, column=5, pady=2, padx=2, sticky=tk.W)
+        save_button.grid(row=0, column=6, pady=2, padx=2, sticky=tk.W)
+        load_button.grid(row=0, column=7, pady=2, padx=2, sticky=tk.W)
 
         self.parameter_widgets = {}
         self.update_parameters_gui()
@@ -99,7 +125,9 @@ class MainWindow(tk.Tk):
         if self.auto_evaluate:
             if self.parameter_changed_job:
                 self.after_cancel(self.parameter_changed_job)
-            self.parameter_changed_job = self.after(500, self.trigger_auto_evaluate)
+            # Short delay only to coalesce slider movements, evaluations run in the background
+            # and a newer evaluation supersedes the running one:
+            self.parameter_changed_job = self.after(100, self.trigger_auto_evaluate)
 
     def trigger_auto_evaluate(self):
         self.parameter_changed_job = None
@@ -155,7 +183,41 @@ class MainWindow(tk.Tk):
     def evaluate(self):
         if self.active_image_window:
             parameter_values = self.get_parameter_values()
-            self.active_image_window.evaluate(self.get_active_detector(), self.get_active_processor(), parameter_values)
+            self.active_image_window.evaluate(
+                self.get_active_detector(),
+                self.get_active_processor(),
+                parameter_values,
+                self.progressive_evaluation)
+
+    def get_open_image_windows(self):
+        # Closed windows are forgotten:
+        self.image_windows = {path: window for path, window in self.image_windows.items() if window.winfo_exists()}
+        return list(self.image_windows.values())
+
+    def evaluate_all(self):
+        """ Evaluates all open images with the current algorithms and parameters, in parallel. The results
+            are shown in the image windows as they finish and collected in the summary window. """
+
+        image_windows = self.get_open_image_windows()
+        if not image_windows:
+            return
+
+        detector = self.get_active_detector()
+        processor = self.get_active_processor()
+        parameter_values = self.get_parameter_values()
+
+        if self.summary_window is None or not self.summary_window.winfo_exists():
+            self.summary_window = SummaryWindow(self)
+        self.summary_window.start(
+            [window.image_processor.image_path for window in image_windows], detector, processor, parameter_values)
+        for image_window in image_windows:
+            image_window.evaluation_finished_callback = self.on_image_window_evaluated
+            image_window.evaluate(detector, processor, parameter_values)
+
+    def on_image_window_evaluated(self, image_window, result):
+        # Previews are not summarized, the full resolution result follows:
+        if result.preview_level == 0 and self.summary_window is not None and self.summary_window.winfo_exists():
+            self.summary_window.add_result(image_window.image_processor.image_path, result, image_window.scale_factor)
 
     def get_parameter_values(self):
         parameter_values = {}
@@ -168,8 +230,43 @@ class MainWindow(tk.Tk):
         if self.auto_evaluate:
             self.evaluate()
 
+    def toggle_progressive_evaluation(self, button, is_pressed):
+        # Show a downscaled preview first, then the full resolution result once the parameters settle:
+        self.progressive_evaluation = is_pressed
+
+    def toggle_tracing(self, button, is_pressed):
+        # Record the processing stages while pressed, show the recorded spans when released:
+        if is_pressed:
+            tracing.clear()
+            tracing.enable()
+        else:
+            tracing.disable()
+            self.show_trace_summary(tracing.get_events())
+
+    def show_trace_summary(self, events):
+        window = tk.Toplevel(self)
+        window.title('Trace summary')
+
+        text = tk.Text(window, width=80, height=20, font='TkFixedFont')
+        text.insert(tk.END, tracing.format_summary(events) if events else 'No spans recorded.')
+        text.configure(state=tk.DISABLED)
+        text.grid(row=0, column=0, sticky=tk.NSEW)
+
+        def save_trace():
+            filename = tk.filedialog.asksaveasfilename(
+                parent=window, defaultextension='.json', filetypes=[('Chrome trace', '*.json')])
+            if filename:
+                tracing.export_chrome_trace(filename, events)
+
+        save_button = tk.Button(window, text='Save trace', width=12, command=save_trace, state=tk.NORMAL if events else tk.DISABLED)
+        save_button.grid(row=1, column=0, pady=2, padx=2, sticky=tk.W)
+
+        window.rowconfigure(0, weight=1)
+        window.columnconfigure(0, weight=1)
+
     def create_image_window(self, image_path):
         image_window = ImageWindow(image_path, image_path)
+        image_window.image_processor.result_cache = self.result_cache
         image_window.geometry('+%d+%d' % (self.winfo_x() + self.winfo_width() + 10, self.winfo_y()))
         image_window.bind("<FocusIn>", self.on_image_window_focus)
         return image_window
@@ -186,45 +283,35 @@ class MainWindow(tk.Tk):
     def save_parameters(self):
         filename = self.get_parameter_file_name()
         if filename != '':
-            with open(filename, 'w') as outfile:
-                parameter_values = self.get_parameter_values()
-                data = {
-                    'detector': self.get_active_detector().get_name(),
-                    'processor': self.get_active_processor().get_name(),
-                    'parameters': parameter_values
-                }
-                json.dump(data, outfile, indent=4)
+            write_parameter_file(
+                filename,
+                self.get_active_detector(),
+                self.get_active_processor(),
+                self.get_parameter_values())
 
     def load_parameters(self):
         filename = self.get_parameter_file_name()
         if filename != '' and os.path.exists(filename):
-            with open(filename, 'r') as infile:
-                data = json.load(infile)
-
-                if 'detector' in data:
-                    detector_name = data['detector']
-                    detector_entry_values = self.detector_entry["values"]
-                    if detector_name in detector_entry_values:
-                        detector_index = detector_entry_values.index(detector_name)
-                        self.detector_entry.current(detector_index)
-
-                processor_name = None
-                if 'processor' in data:
-                    processor_name = data['processor']
-                # Process old version of saved parameters where 'processors' were called 'classifiers':
-                elif 'classifier' in data:      
-                    processor_name = data['classifier']
-                    
-                if processor_name is not None:
-                    processor_entry_values = self.processor_entry["values"]
-                    if processor_name in processor_entry_values:
-                        processor_index = processor_entry_values.index(processor_name)
-                        self.processor_entry.current(processor_index)
-
-                self.update_parameters_gui()
-
-                parameter_values = data['parameters']
-
-                for key, widget in self.parameter_widgets.items():
-                    if key in parameter_values:
-                        widget.set(parameter_values[key])
+            data = read_parameter_file(filename)
+
+            if 'detector' in data:
+                detector_name = data['detector']
+                detector_entry_values = self.detector_entry["values"]
+                if detector_name in detector_entry_values:
+                    detector_index = detector_entry_values.index(detector_name)
+                    self.detector_entry.current(detector_index)
+
+            if 'processor' in data:
+                processor_name = data['processor']
+                processor_entry_values = self.processor_entry["values"]
+                if processor_name in processor_entry_values:
+                    processor_index = processor_entry_values.index(processor_name)
+                    self.processor_entry.current(processor_index)
+
+            self.update_parameters_gui()
+
+            parameter_values = data['parameters']
+
+            for key, widget in self.parameter_widgets.items():
+                if key in parameter_values:
+                    widget.set(parameter_values[key])
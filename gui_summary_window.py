@@ -0,0 +1,130 @@
+import math
+import tkinter as tk
+from tkinter import ttk
+import tkinter.filedialog
+
+from results_export import IMAGE_COLUMNS, calculate_image_summary, write_csv_table
+
+
+class SummaryWindow(tk.Toplevel):
+    """ Table of the summaries of the images evaluated together, with a row of totals.
+
+        Rows are added for the images when the evaluation starts and filled in as their results
+        arrive, in any order. Later results of the same images replace them, as long as they were
+        evaluated with the same algorithms and parameters. """
+
+    # Displayed columns: (summary column, heading, format):
+    COLUMNS = [
+        ('image', 'Image', '{}'),
+        ('circles', 'Circles', '{:d}'),
+        ('hex', 'HEX', '{:d}'),
+        ('non_hex', 'N-HEX', '{:d}'),
+        ('ratio', 'Ratio', '{:.1%}'),
+        ('coverage', 'Coverage', '{:.1%}'),
+        ('mean_diameter_nm', 'Diameter (nm)', '{:.1f}'),
+    ]
+
+    TOTAL_ROW = 'total'
+
+    def __init__(self, parent):
+        tk.Toplevel.__init__(self, parent)
+        self.title('Summary')
+
+        self.table = ttk.Treeview(self, columns=[column[0] for column in self.COLUMNS] + ['seconds'], show='headings')
+        for name, heading, value_format in self.COLUMNS + [('seconds', 'Time (s)', '{:.2f}')]:
+            self.table.heading(name, text=heading)
+            self.table.column(name, width=320 if name == 'image' else 90, anchor=tk.W if name == 'image' else tk.E)
+        self.table.tag_configure('total', font=('TkDefaultFont', 9, 'bold'))
+
+        scrollbar = ttk.Scrollbar(self, orient=tk.VERTICAL, command=self.table.yview)
+        self.table.configure(yscrollcommand=scrollbar.set)
+
+        self.status_label = tk.Label(self, text='', anchor=tk.W)
+        self.save_button = tk.Button(self, text='Save table', width=12, command=self.save_table)
+
+        self.table.grid(row=0, column=0, columnspan=2, sticky=tk.NSEW)
+        scrollbar.grid(row=0, column=2, sticky=tk.NS)
+        self.status_label.grid(row=1, column=0, sticky=tk.W, padx=2)
+        self.save_button.grid(row=1, column=1, pady=2, padx=2, sticky=tk.E)
+        self.rowconfigure(0, weight=1)
+        self.columnconfigure(0, weight=1)
+
+        # Summaries of the finished images (None while pending) and their evaluation times, by image path:
+        self.summaries = {}
+        self.seconds = {}
+
+        # Algorithms and parameters of the summarized evaluations:
+        self.evaluation = None
+
+    def start(self, image_paths, detector, processor, parameters):
+        """ Clears the table and adds a pending row for every image. """
+
+        self.evaluation = (detector, processor, dict(parameters))
+        self.table.delete(*self.table.get_children())
+        self.summaries = {image_path: None for image_path in image_paths}
+        self.seconds = {}
+        for image_path in image_paths:
+            self.table.insert('', tk.END, iid=image_path, values=[image_path] + [''] * len(self.COLUMNS))
+        self.table.insert('', tk.END, iid=self.TOTAL_ROW, tags=('total',))
+        self.update_totals()
+
+    def add_result(self, image_path, result, nm_per_pixel=1.0):
+        if image_path not in self.summaries or (result.detector, result.processor, result.parameters) != self.evaluation:
+            return
+
+        crop_area = tuple(int(coordinate) for coordinate in result.crop_area)
+        summary = calculate_image_summary(
+            image_path, result.detector.get_name(), result.processor.get_name(), crop_area, result.circles,
+            result.processor_results, nm_per_pixel)
+        self.summaries[image_path] = summary
+        self.seconds[image_path] = result.elapsed_time
+        self.table.item(image_path, values=self.format_row(summary, result.elapsed_time))
+        self.update_totals()
+
+    def format_row(self, summary, seconds):
+        values = []
+        for name, heading, value_format in self.COLUMNS:
+            value = summary[name]
+            # Unclassified images have no hex counts:
+            is_missing = (isinstance(value, float) and math.isnan(value)) or (name in ('hex', 'non_hex') and value < 0)
+            values.append('' if is_missing else value_format.format(value))
+        return values + ['{:.2f}'.format(seconds)]
+
+    def get_total_summary(self, summaries):
+        circle_count = sum(summary['circles'] for summary in summaries)
+        classified = [summary for summary in summaries if summary['hex'] >= 0]
+        good_count = sum(summary['hex'] for summary in classified)
+        classified_count = sum(summary['circles'] for summary in classified)
+        areas = [(summary['x1'] - summary['x0']) * (summary['y1'] - summary['y0']) for summary in summaries]
+        diameter_sum = sum(summary['mean_diameter_nm'] * summary['circles'] for summary in summaries if summary['circles'] > 0)
+        return {
+            'image': f'Total ({len(summaries)} of {len(self.summaries)} images)',
+            'circles': circle_count,
+            'hex': good_count if classified else -1,
+            'non_hex': classified_count - good_count if classified else -1,
+            'ratio': good_count / classified_count if classified_count > 0 else math.nan,
+            # Coverage of the total area, the images are weighted by their area:
+            'coverage': sum(summary['coverage'] * area for summary, area in zip(summaries, areas)) / sum(areas)
+                        if sum(areas) > 0 else math.nan,
+            'mean_diameter_nm': diameter_sum / circle_count if circle_count > 0 else math.nan,
+        }
+
+    def update_totals(self):
+        summaries = [summary for summary in self.summaries.values() if summary is not None]
+        total = self.get_total_summary(summaries)
+        self.table.item(self.TOTAL_ROW, values=self.format_row(total, sum(self.seconds.values())))
+
+        pending_count = len(self.summaries) - len(summaries)
+        self.status_label.config(text=f'Evaluating {pending_count} images...' if pending_count > 0 else 'Done')
+
+    def save_table(self):
+        summaries = [summary for summary in self.summaries.values() if summary is not None]
+        if not summaries:
+            return
+
+        file_path = tkinter.filedialog.asksaveasfilename(
+            parent=self, defaultextension='.csv', filetypes=[('CSV table', '*.csv')])
+        if file_path:
+            table = {name: [summary[name] for summary in summaries] for name, dtype in IMAGE_COLUMNS}
+            with open(file_path, 'w', newline='') as outfile:
+                write_csv_table(outfile, IMAGE_COLUMNS, table)
@@ -1,6 +1,8 @@
 # from tkinter import *
+import tkinter as tk
 from PIL import Image, ImageTk
 import cv2
+import numpy as np
 
 
 def convert_image_opencv_to_tk(opencv_image):
@@ -27,6 +29,21 @@ def convert_image_pil_to_tk(pil_image):
     return img_tk
 
 
+# XBM notation of every byte value:
+XBM_BYTES = np.array(['0x%02x,' % value for value in range(256)])
+
+
+def convert_mask_to_tk_bitmap(mask, foreground):
+    """ Converts a mask (numpy array, nonzero where set) to a Tk bitmap image, which is transparent
+        where the mask is not set. The color of the bitmap can be changed without converting it again. """
+
+    height, width = mask.shape
+    packed_rows = np.packbits(mask != 0, axis=1, bitorder='little')
+    data = (f'#define mask_width {width}\n#define mask_height {height}\n' +
+            'static unsigned char mask_bits[] = {' + ''.join(XBM_BYTES[packed_rows.ravel()].tolist()) + '};')
+    return tk.BitmapImage(data=data, foreground=foreground)
+
+
 def nearest_odd(number):
     return number + (number % 2) - 1
 
@@ -1,17 +1,24 @@
-import numpy as np
 import matplotlib.pyplot as plt
 
 
-def show_histogram(data):
-    plt.close()
+# The histogram is shown in the same figure every time:
+HISTOGRAM_FIGURE = 'Histogram of circle diameters'
 
-    bins = np.arange(min(data), max(data) + 1.5) - 0.5
 
-    n, bins, patches = plt.hist(data, bins=bins)
+def show_histogram(histogram, description=''):
+    """ Shows the counts of a FixedBinHistogram of diameters (see aggregates), with the description below the title. """
 
-    plt.xlabel('Diameter (nm)')
-    plt.ylabel('Count')
-    plt.title(r'Histogram of circle diameters')
-    plt.grid(True)
+    figure = plt.figure(HISTOGRAM_FIGURE)
+    figure.clear()
+    axes = figure.add_subplot()
 
+    axes.stairs(histogram.counts, histogram.get_bin_edges(), fill=True)
+
+    axes.set_xlabel('Diameter (nm)')
+    axes.set_ylabel('Count')
+    axes.set_title(HISTOGRAM_FIGURE + ('\n' + description if description else ''))
+    axes.grid(True)
+
+    figure.tight_layout()
+    figure.canvas.draw_idle()
     plt.show(block=False)
@@ -1,13 +1,60 @@
 import cv2
+import math
 import time
+import numpy as np
+import PIL.Image
 
 from process import process_image
-from helpers import convert_image_opencv_to_pil
+from image_source import ImageSource
+from result_cache import hash_file
+from calibration import detect_crop_area
+from incremental_detection import Detection, update_detection
+import tracing
 from processors.classifiers.classification_brightness import BrightnessClassifier, BrightnessClassifierAdaptive
 from processors.classifiers.classification_distance import DistanceClassifier
+from processors.classifiers.classification_hexatic import HexaticOrderClassifier
 from processors.none_processor import NoneProcessor
 from detectors.detector_opencv_hough import OpenCVHoughDetector
-from drawing_utilities import draw_circles_on_image
+from detectors.detector_multiband_hough import MultiBandHoughDetector
+from detectors.detector_fixed_radius import FixedRadiusDetector
+from drawing_utilities import draw_circles_on_image, draw_circle_masks
+from display_pyramid import image_to_view
+from processors.classifiers.classification_common import get_info_text
+
+
+# Colors of the circle classes drawn by the processors, and of the circles of processors which don't draw them:
+CLASS_COLORS = [(255, 0, 0), (0, 255, 0)]
+UNCLASSIFIED_COLOR = (50, 50, 255)
+
+
+class EvaluationResult:
+    def __init__(self, detector, processor, crop_area, circles, processor_results, result_image, elapsed_time,
+                 preview_level=0, processing_time=0.0, processed_pixels=0, detection=None, processor_metrics=None,
+                 parameters=None):
+        self.detector = detector
+        self.processor = processor
+        self.crop_area = crop_area
+        self.circles = circles
+        self.processor_results = processor_results
+        self.result_image = result_image
+        self.elapsed_time = elapsed_time
+
+        # Per-circle metrics of the processor (dict of arrays, eg. brightness):
+        self.processor_metrics = processor_metrics if processor_metrics is not None else {}
+
+        # Full resolution parameters of the evaluation:
+        self.parameters = parameters
+
+        # Pyramid level the image was processed at (0 is full resolution, each level halves the size):
+        self.preview_level = preview_level
+
+        # Duration of detection and processing without rendering, and the number of processed pixels:
+        self.processing_time = processing_time
+        self.processed_pixels = processed_pixels
+
+        # Full resolution detection, to be updated when the crop area changes:
+        self.detection = detection
+
 
 class ImageProcessor:
     def __init__(self, image_path):
@@ -16,10 +63,16 @@ class ImageProcessor:
         # Display configuration options:
         self.draw_perimeters = True
         self.draw_info_text = True
+        # Show the background the processor compares the circles to (if it has one) instead of the image:
+        self.draw_background = False
+        # Render the result image on every evaluation, views drawing the results with render_result_layers turn it off:
+        self.render_result_images = True
 
-        # Image processing results:
+        # Image processing results (classes and per-circle metrics of the processor as numpy arrays):
         self.circles = []
-        self.processor_results = []
+        self.processor_results = np.zeros(0, np.int64)
+        self.processor_metrics = {}
+        self.parameters = None
 
         self.load_image(image_path)
 
@@ -31,78 +84,264 @@ class ImageProcessor:
         self.detector = None
         self.processor = None
 
+        # Progressive evaluation: previews are processed on a downscaled image, at the
+        # largest resolution estimated to finish within the latency budget:
+        self.preview_latency_budget = 0.1
+        # Measured processing time per pixel, None until the first evaluation:
+        self.seconds_per_pixel = None
+
+        # Full resolution results are looked up in and stored to the result cache, if set:
+        self.result_cache = None
+
     @staticmethod
     def get_available_processors():
-        return [BrightnessClassifier, BrightnessClassifierAdaptive, DistanceClassifier, NoneProcessor]
+        return [BrightnessClassifier, BrightnessClassifierAdaptive, DistanceClassifier, HexaticOrderClassifier, NoneProcessor]
 
     @staticmethod
     def get_available_detectors():
-        return [OpenCVHoughDetector]
+        return [OpenCVHoughDetector, MultiBandHoughDetector, FixedRadiusDetector]
 
     def load_image(self, image_path):
         self.image_path = image_path
-        self.image = cv2.imread(image_path)
-        self.grayscale_image = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
+        with tracing.span('load_image', image=image_path) as span:
+            # Only the grayscale plane used for detection is loaded, color is decoded when drawing:
+            self.image_source = ImageSource(image_path)
+            self.grayscale_image = self.image_source.grayscale_image
+            span.set(width=self.grayscale_image.shape[1], height=self.grayscale_image.shape[0],
+                     memory_mapped=self.image_source.is_memory_mapped)
+
+        # Downscaled grayscale images (level i is scaled by 1/2^i), created on first use:
+        self.pyramid = [self.grayscale_image]
+
+        self.result_image = None
+
+        # Last full resolution detection, reused for evaluating a changed crop area:
+        self.detection = None
+
+    def get_image_hash(self):
+        # Hash of the content of the image file, identifying the image in the result cache:
+        return hash_file(self.image_path)
+
+    def get_pyramid_level(self, level):
+        while len(self.pyramid) <= level:
+            self.pyramid.append(cv2.pyrDown(self.pyramid[-1]))
+        return self.pyramid[level]
+
+    def choose_preview_level(self, detector, parameters, crop_area):
+        """ Returns the pyramid level for a preview evaluation of the crop area, 0 if no preview is needed. """
+
+        if not hasattr(detector, 'scale_parameters'):
+            return 0
+
+        x0, y0, x1, y1 = crop_area
+        pixels = (x1 - x0) * (y1 - y0)
+
+        # Without measurements, aim for a preview of about one megapixel:
+        seconds_per_pixel = self.seconds_per_pixel if self.seconds_per_pixel is not None else self.preview_latency_budget / 1e6
+
+        min_scale = detector.get_min_scale(parameters) if hasattr(detector, 'get_min_scale') else 0.0
+        max_level = int(math.floor(-math.log2(min_scale))) if min_scale > 0.0 else 8
+
+        level = 0
+        while level < max_level and seconds_per_pixel * pixels / 4 ** level > self.preview_latency_budget:
+            level += 1
+        return level
 
     def evaluate(self, detector, processor, parameters):
-        start_time = time.perf_counter()
+        result = self.compute_evaluation(detector, processor, parameters, self.active_crop_area)
+        self.apply_evaluation(result)
 
-        self.detector = detector
-        self.processor = processor
+        print('Evaluated in ' + str(result.elapsed_time) + ' seconds')
 
-        # Get cropped area:
-        x0, y0, x1, y1 = self.active_crop_area
-        cropped_img = self.grayscale_image[y0:y1, x0:x1]
+    def compute_evaluation(self, detector, processor, parameters, crop_area, preview_level=0, is_cancelled=None):
+        """ Runs the detector and the processor on the crop area and renders the result image.
+
+            With a preview level > 0 the image is processed at that level of the image pyramid, with
+            the parameters scaled to match, and the circles are scaled back to full resolution.
 
-        # Process cropped image:
-        self.circles, self.processor_results = process_image(
-            cropped_img,
-            self.detector,
-            parameters,
-            self.processor,
-            parameters)
+            Doesn't modify the state of the image processor, so it can run in a background thread,
+            the result is applied with apply_evaluation. Returns None if is_cancelled() returns True
+            between the processing stages. """
 
-        # Update result image:
-        self.update_result_image()
+        with tracing.span('evaluate', image=self.image_path, preview_level=preview_level):
+            start_time = time.perf_counter()
 
-        print('Evaluated in ' + str(time.perf_counter() - start_time) + ' seconds')
+            scale = 0.5 ** preview_level
+            detector_parameters = parameters
+            processor_parameters = parameters
+            if preview_level > 0:
+                detector_parameters = detector.scale_parameters(parameters, scale)
+                if hasattr(processor, 'scale_parameters'):
+                    processor_parameters = processor.scale_parameters(parameters, scale)
+
+            # Get cropped area:
+            x0, y0, x1, y1 = (int(coordinate * scale) for coordinate in crop_area)
+            cropped_img = self.get_pyramid_level(preview_level)[y0:y1, x0:x1]
+
+            # Full resolution results of the same image, crop area, algorithms and parameters are reused:
+            cache_key = None
+            processing_results = None
+            if preview_level == 0 and self.result_cache is not None:
+                cache_key = self.result_cache.make_key(
+                    self.get_image_hash(), crop_area, detector, processor, parameters)
+                processing_results = self.result_cache.get(cache_key)
+            processed_pixels = cropped_img.shape[0] * cropped_img.shape[1] if processing_results is None else 0
+
+            if processing_results is None:
+                # Only the changed parts of the crop area are detected again if the detection is up to date otherwise:
+                circles = None
+                if preview_level == 0:
+                    circles = update_detection(cropped_img, self.detection, detector, detector_parameters, crop_area)
+
+                # Process cropped image:
+                processing_results = process_image(
+                    cropped_img, detector, detector_parameters, processor, processor_parameters, is_cancelled, circles)
+                if processing_results is None or (is_cancelled and is_cancelled()):
+                    return None
+                # Updated detections depend on the evaluations before, only detections from scratch are stored:
+                if cache_key is not None and circles is None:
+                    self.result_cache.put(cache_key, *processing_results)
+
+            circles, processor_results, processor_metrics = processing_results
+            processing_time = time.perf_counter() - start_time
+
+            detection = Detection(detector, detector_parameters, crop_area, circles) if preview_level == 0 else None
+
+            if preview_level > 0 and len(circles) > 0:
+                # Scale the coordinates and radii, further columns (eg. band labels) are kept. Refined
+                # circles stay sub-pixel:
+                is_whole_pixels = np.issubdtype(np.asarray(circles).dtype, np.integer)
+                circles = np.array(circles, np.float64)
+                circles[:, :3] /= scale
+                if is_whole_pixels:
+                    circles = np.uint16(np.around(circles))
+
+            # Render result image (views drawing the results themselves don't need it):
+            result_image = None
+            if self.render_result_images:
+                result_image = self.render_result_image(
+                    processor, crop_area, circles, processor_results, self.draw_perimeters, self.draw_info_text,
+                    parameters, self.draw_background)
+
+            return EvaluationResult(detector, processor, crop_area, circles, processor_results, result_image,
+                                    time.perf_counter() - start_time, preview_level, processing_time,
+                                    processed_pixels, detection, processor_metrics,
+                                    parameters)
+
+    def apply_evaluation(self, result):
+        self.detector = result.detector
+        self.processor = result.processor
+        self.active_crop_area = result.crop_area
+        self.circles = result.circles
+        self.processor_results = result.processor_results
+        self.processor_metrics = result.processor_metrics
+        self.parameters = result.parameters
+        self.result_image = result.result_image
+
+        if result.detection is not None:
+            self.detection = result.detection
+
+        if result.processed_pixels > 0:
+            self.seconds_per_pixel = result.processing_time / result.processed_pixels
 
     def set_active_crop_area(self, active_crop_area):
         self.active_crop_area = active_crop_area
         self.circles = []
-        self.processor_results = []
+        self.processor_results = np.zeros(0, np.int64)
+        self.processor_metrics = {}
 
     def autodetect_crop_area(self):
-        # Calculate image derivative in vertical direction:
-        dy_image = abs(cv2.Sobel(self.grayscale_image, cv2.CV_64F, 0, 1))
+        self.active_crop_area = detect_crop_area(self.grayscale_image)
 
-        # For each row, calculate sum of derivatives, this gives a
-        # heuristic for the total change in brightness in vertical direction across row:
-        dy_rows = list(sum(row) for row in dy_image)
-        image_size = self.get_image_size()
+    def update_result_image(self):
+        self.result_image = self.render_result_image(
+            self.processor, self.active_crop_area, self.circles, self.processor_results, self.draw_perimeters, self.draw_info_text,
+            self.parameters, self.draw_background)
 
-        # Set the bottom border to the row where the total derivative first hits a very low
-        # value (ignoring the first row where the derivative will be zero). We assume this is
-        # where the uniformly colored information panel in the SEM image starts. :
-        bottom_border = image_size[1]
-        for rownum in range(1, len(dy_rows)):
-            if dy_rows[rownum] < image_size[0]:
-                bottom_border = rownum
-                break
+    def render_result_image(self, processor, crop_area, circles, processor_results, draw_perimeters, draw_info_text,
+                            parameters=None, draw_background=False):
+        with tracing.span('render_result_image', circles=len(circles)):
+            # Processors draw onto a new RGB image as a numpy array:
+            result_image = self.render_base_image(processor, crop_area, parameters, draw_background)
 
-        self.active_crop_area = (0, 0, image_size[0], bottom_border)
+            if processor is not None and hasattr(processor, 'update_result_image') and callable(processor.update_result_image):
+                draw_parameters = {
+                    'draw_perimeters' : draw_perimeters,
+                    'draw_info_text' : draw_info_text
+                    }
+                processor.update_result_image(result_image, crop_area, circles, processor_results, draw_parameters)
+            else:
+                draw_circles_on_image(result_image, crop_area, circles, draw_perimeters, None, [UNCLASSIFIED_COLOR])
 
-    def update_result_image(self):
-        self.result_image = convert_image_opencv_to_pil(self.image)
-        
-        if self.processor is not None and hasattr(self.processor, 'update_result_image') and callable(self.processor.update_result_image):
-            draw_parameters = {
-                'draw_perimeters' : self.draw_perimeters, 
-                'draw_info_text' : self.draw_info_text
-                }
-            self.processor.update_result_image(self.result_image, self.active_crop_area, self.circles, self.processor_results, draw_parameters)
-        else:
-            draw_circles_on_image(self.result_image, self.active_crop_area, self.circles, self.draw_perimeters, None, [(50, 50, 255)])
+            return PIL.Image.fromarray(result_image)
+
+    def render_base_image(self, processor, crop_area, parameters=None, draw_background=False):
+        """ Returns a new RGB image of the image without the results: the image itself, or the background
+            the processor compared the circles to within the crop area. """
+
+        base_image = self.image_source.create_rgb_image()
+        if draw_background and parameters is not None and hasattr(processor, 'get_background_image'):
+            x0, y0, x1, y1 = (int(coordinate) for coordinate in crop_area)
+            background = processor.get_background_image(self.grayscale_image[y0:y1, x0:x1], parameters)
+            base_image[y0:y1, x0:x1] = background[:, :, None]
+        return base_image
+
+    def has_classes(self):
+        # Processors drawing their results draw the circles by class, other circles are drawn in a single color:
+        processor = self.processor
+        return processor is not None and hasattr(processor, 'update_result_image') and callable(processor.update_result_image)
+
+    def get_class_colors(self):
+        return list(CLASS_COLORS) if self.has_classes() else [UNCLASSIFIED_COLOR]
+
+    def get_info_text(self):
+        if not self.has_classes():
+            return ''
+        x0, y0, x1, y1 = self.active_crop_area
+        return get_info_text(self.circles, self.processor_results, (x1 - x0) * (y1 - y0))
+
+    def render_result_layers(self, origin, scale, view_size):
+        """ Returns the circles of the last evaluation in a view of the image (showing the image from origin,
+            in image coordinates, scaled by scale, see DisplayPyramid) as masks of view_size (width, height):
+            a (class, perimeter mask, center mask) tuple for every class. Only the circles in the view are drawn. """
+
+        circles = np.asarray(self.circles)
+        view_width, view_height = view_size
+
+        with tracing.span('render_result_layers', circles=len(circles)) as span:
+            if len(circles) == 0:
+                return []
+
+            x0, y0 = self.active_crop_area[:2]
+            xs, ys = image_to_view(circles[:, 0] + x0, circles[:, 1] + y0, origin, scale)
+            radii = circles[:, 2] * scale
+            is_visible = ((xs + radii >= -1) & (xs - radii <= view_width) &
+                          (ys + radii >= -1) & (ys - radii <= view_height))
+            view_circles = np.c_[xs, ys, radii][is_visible]
+            span.set(visible_circles=len(view_circles))
+
+            # Circles are of class 0 if they are not classified:
+            classes = np.zeros(len(circles), np.int64)
+            if self.has_classes() and len(self.processor_results) == len(circles):
+                classes = np.asarray(self.processor_results)
+            view_classes = classes[is_visible]
+
+            layers = []
+            for circle_class in range(len(self.get_class_colors())):
+                perimeter_mask, center_mask = draw_circle_masks(view_size, view_circles[view_classes == circle_class])
+                layers.append((circle_class, perimeter_mask, center_mask))
+            return layers
 
     def get_image_size(self):
-        return (len(self.image[0]), len(self.image))
+        return self.image_source.get_size()
+
+    def get_memory_usage(self):
+        """ Returns the bytes held in memory for the image (decoded image, pyramid and result image)
+            and the bytes of the memory mapped image file. """
+
+        resident_bytes, mapped_bytes = self.image_source.get_memory_usage()
+        resident_bytes += sum(level.nbytes for level in self.pyramid[1:])
+        if self.result_image is not None:
+            # PIL stores RGB images with 4 bytes per pixel:
+            resident_bytes += self.result_image.width * self.result_image.height * 4
+        return resident_bytes, mapped_bytes
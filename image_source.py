@@ -0,0 +1,237 @@
+import os
+import struct
+import numpy as np
+import cv2
+import PIL.Image
+
+
+# Rows converted at once when reducing a memory mapped image to 8 bits, bounds the temporary memory:
+CONVERSION_CHUNK_ROWS = 256
+
+# TIFF tags used to locate the pixel data of uncompressed images:
+TIFF_IMAGE_WIDTH = 256
+TIFF_IMAGE_LENGTH = 257
+TIFF_BITS_PER_SAMPLE = 258
+TIFF_COMPRESSION = 259
+TIFF_PHOTOMETRIC_INTERPRETATION = 262
+TIFF_STRIP_OFFSETS = 273
+TIFF_SAMPLES_PER_PIXEL = 277
+TIFF_STRIP_BYTE_COUNTS = 279
+TIFF_PLANAR_CONFIGURATION = 284
+TIFF_TILE_WIDTH = 322
+TIFF_SAMPLE_FORMAT = 339
+
+TIFF_FIELD_TYPES = {
+    1: 'B',  # BYTE
+    3: 'H',  # SHORT
+    4: 'I',  # LONG
+    16: 'Q',  # LONG8
+}
+
+
+class TiffPage:
+    """ Location and layout of the pixel data of an uncompressed TIFF page stored in one contiguous block. """
+
+    def __init__(self, offset, width, height, samples_per_pixel, dtype):
+        self.offset = offset
+        self.width = width
+        self.height = height
+        self.samples_per_pixel = samples_per_pixel
+        self.dtype = dtype
+
+    @property
+    def shape(self):
+        if self.samples_per_pixel == 1:
+            return (self.height, self.width)
+        return (self.height, self.width, self.samples_per_pixel)
+
+
+def read_tiff_tags(infile, byte_order, offset):
+    # Returns the tags of the image file directory at the offset (as tuples of values) and the offset of the next one:
+    infile.seek(offset)
+    entry_count, = struct.unpack(byte_order + 'H', infile.read(2))
+    entries = infile.read(entry_count * 12)
+    next_offset, = struct.unpack(byte_order + 'I', infile.read(4))
+
+    tags = {}
+    for index in range(entry_count):
+        tag, field_type, count, value = struct.unpack_from(byte_order + 'HHI4s', entries, index * 12)
+        if field_type not in TIFF_FIELD_TYPES:
+            continue
+        value_format = byte_order + str(count) + TIFF_FIELD_TYPES[field_type]
+        value_size = struct.calcsize(value_format)
+        if value_size > 4:
+            # The value doesn't fit in the entry, the entry holds its offset:
+            position = infile.tell()
+            infile.seek(struct.unpack(byte_order + 'I', value)[0])
+            value = infile.read(value_size)
+            infile.seek(position)
+        tags[tag] = struct.unpack(value_format, value[:value_size])
+
+    return tags, next_offset
+
+
+def get_tiff_page(tags, byte_order):
+    """ Returns the TiffPage of the tags, or None if the page can't be memory mapped. """
+
+    compression = tags.get(TIFF_COMPRESSION, (1,))[0]
+    samples_per_pixel = tags.get(TIFF_SAMPLES_PER_PIXEL, (1,))[0]
+    bits_per_sample = set(tags.get(TIFF_BITS_PER_SAMPLE, (1,)))
+    photometric = tags.get(TIFF_PHOTOMETRIC_INTERPRETATION, (1,))[0]
+    sample_format = set(tags.get(TIFF_SAMPLE_FORMAT, (1,)))
+
+    # Only uncompressed, interleaved, unsigned 8 or 16 bit grayscale (black is zero) or RGB strips:
+    if (compression != 1 or TIFF_TILE_WIDTH in tags or sample_format != {1} or
+            tags.get(TIFF_PLANAR_CONFIGURATION, (1,))[0] != 1 or
+            len(bits_per_sample) != 1 or bits_per_sample.isdisjoint((8, 16)) or
+            (samples_per_pixel, photometric) not in ((1, 1), (3, 2))):
+        return None
+
+    width = tags[TIFF_IMAGE_WIDTH][0]
+    height = tags[TIFF_IMAGE_LENGTH][0]
+    dtype = np.dtype(np.uint8) if bits_per_sample == {8} else np.dtype(byte_order + 'u2')
+
+    # The strips have to follow each other without gaps to be mapped as a single array:
+    strip_offsets = tags[TIFF_STRIP_OFFSETS]
+    strip_byte_counts = tags[TIFF_STRIP_BYTE_COUNTS]
+    for index in range(1, len(strip_offsets)):
+        if strip_offsets[index] != strip_offsets[index - 1] + strip_byte_counts[index - 1]:
+            return None
+    if sum(strip_byte_counts) < width * height * samples_per_pixel * dtype.itemsize:
+        return None
+
+    return TiffPage(strip_offsets[0], width, height, samples_per_pixel, dtype)
+
+
+def read_tiff_pages(path):
+    """ Returns the TiffPage (or None if it can't be memory mapped) of every page of a TIFF file,
+        or None if the file is not a classic TIFF file. """
+
+    with open(path, 'rb') as infile:
+        header = infile.read(8)
+        if len(header) < 8 or header[:2] not in (b'II', b'MM'):
+            return None
+        byte_order = '<' if header[:2] == b'II' else '>'
+        magic, offset = struct.unpack(byte_order + 'HI', header[2:])
+        if magic != 42:
+            # BigTIFF and other variants are left to the decoder:
+            return None
+
+        pages = []
+        visited_offsets = set()
+        try:
+            while offset != 0 and offset not in visited_offsets:
+                visited_offsets.add(offset)
+                tags, offset = read_tiff_tags(infile, byte_order, offset)
+                pages.append(get_tiff_page(tags, byte_order))
+        except (struct.error, KeyError, IndexError):
+            return None
+        return pages
+
+
+def map_tiff_page(path, page):
+    return np.memmap(path, dtype=page.dtype, mode='r', offset=page.offset, shape=page.shape)
+
+
+def reduce_to_8_bits(img):
+    """ Converts a 16 bit image to 8 bits (the same way as cv2.imread does) in chunks of rows,
+        so a memory mapped image is never read into memory as a whole. """
+
+    if img.dtype == np.uint8:
+        return np.array(img)
+    result = np.empty(img.shape, np.uint8)
+    for row in range(0, img.shape[0], CONVERSION_CHUNK_ROWS):
+        result[row:row + CONVERSION_CHUNK_ROWS] = img[row:row + CONVERSION_CHUNK_ROWS] >> 8
+    return result
+
+
+def rgb_to_grayscale(img):
+    # Converted in chunks of rows, so a memory mapped image is never read into memory as a whole:
+    result = np.empty(img.shape[:2], np.uint8)
+    for row in range(0, img.shape[0], CONVERSION_CHUNK_ROWS):
+        chunk = img[row:row + CONVERSION_CHUNK_ROWS]
+        if chunk.dtype != np.uint8:
+            chunk = chunk >> 8
+        result[row:row + CONVERSION_CHUNK_ROWS] = cv2.cvtColor(np.ascontiguousarray(chunk, np.uint8), cv2.COLOR_RGB2GRAY)
+    return result
+
+
+class ImageSource:
+    """ An image file, loaded as the 8 bit grayscale plane used for detection.
+
+        The color image is only decoded when requested (for drawing result images), grayscale files
+        have no color image at all. Uncompressed TIFF files are memory mapped instead of read. """
+
+    def __init__(self, path):
+        self.path = path
+
+        # Memory mapped pixel data of uncompressed TIFF files (None if the file was decoded):
+        self.mapped_image = None
+
+        # Decoded RGB image of color files, created on first use:
+        self.color_image = None
+
+        pages = read_tiff_pages(path) if os.path.splitext(path)[1].lower() in ('.tif', '.tiff') else None
+        if pages and pages[0] is not None:
+            self.mapped_image = map_tiff_page(path, pages[0])
+            self.is_color = self.mapped_image.ndim == 3
+            if self.is_color:
+                self.grayscale_image = rgb_to_grayscale(self.mapped_image)
+            elif self.mapped_image.dtype == np.uint8:
+                # The mapped file is the grayscale plane itself:
+                self.grayscale_image = self.mapped_image
+            else:
+                self.grayscale_image = reduce_to_8_bits(self.mapped_image)
+                # Not needed any more, the color image is created from the grayscale plane:
+                self.mapped_image = None
+        else:
+            # The header tells if the file has color, without decoding the pixel data:
+            with PIL.Image.open(path) as header_image:
+                self.is_color = header_image.mode not in ('1', 'L', 'LA', 'I', 'I;16', 'I;16B', 'I;16L', 'F')
+            self.grayscale_image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+
+        if self.grayscale_image is None:
+            raise ValueError('Unable to read image ' + path)
+
+    @property
+    def is_memory_mapped(self):
+        return self.mapped_image is not None
+
+    def get_size(self):
+        return (self.grayscale_image.shape[1], self.grayscale_image.shape[0])
+
+    def get_color_image(self):
+        """ Returns the RGB image of a color file (read only, may be memory mapped), None for grayscale files. """
+
+        if not self.is_color:
+            return None
+        if self.color_image is None:
+            if self.mapped_image is not None and self.mapped_image.dtype == np.uint8:
+                return self.mapped_image
+            if self.mapped_image is not None:
+                self.color_image = reduce_to_8_bits(self.mapped_image)
+            else:
+                self.color_image = cv2.cvtColor(cv2.imread(self.path, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+        return self.color_image
+
+    def create_rgb_image(self):
+        """ Returns a new RGB image to draw on. """
+
+        color_image = self.get_color_image()
+        if color_image is None:
+            return cv2.cvtColor(self.grayscale_image, cv2.COLOR_GRAY2RGB)
+        return np.array(color_image)
+
+    def release_color_image(self):
+        self.color_image = None
+
+    def get_memory_usage(self):
+        """ Returns the bytes of decoded image data held in memory and the bytes of the memory mapped file. """
+
+        resident_bytes = 0
+        if not isinstance(self.grayscale_image, np.memmap):
+            resident_bytes += self.grayscale_image.nbytes
+        if self.color_image is not None:
+            resident_bytes += self.color_image.nbytes
+        mapped_bytes = self.mapped_image.nbytes if self.mapped_image is not None else 0
+        return resident_bytes, mapped_bytes
@@ -0,0 +1,103 @@
+import numpy as np
+import tracing
+
+
+# Above this fraction of newly exposed area a full detection is not slower than an incremental one:
+MAX_EXPOSED_FRACTION = 0.5
+
+
+class Detection:
+    """ Circles detected on a crop area of an image, kept to update the detection when the crop area changes. """
+
+    def __init__(self, detector, parameters, crop_area, circles):
+        self.detector = detector
+        self.parameters = get_detector_parameters(detector, parameters)
+        self.crop_area = tuple(crop_area)
+
+        # Circles in image coordinates (with the further columns of the detector, eg. band labels):
+        self.circles = np.array(circles, np.float64).reshape(len(circles), -1) if len(circles) > 0 else np.zeros((0, 3))
+        self.circles[:, :2] += crop_area[:2]
+
+    def matches(self, detector, parameters):
+        return detector is self.detector and get_detector_parameters(detector, parameters) == self.parameters
+
+
+def get_detector_parameters(detector, parameters):
+    # Processor parameters don't affect the detection:
+    return {parameter[0]: parameters[parameter[0]] for parameter in detector.get_parameter_list() if parameter[0] in parameters}
+
+
+def get_area_size(area):
+    x0, y0, x1, y1 = area
+    return max(0, x1 - x0) * max(0, y1 - y0)
+
+
+def get_incremental_regions(previous_area, area, margin):
+    """ Returns the area of the new crop area where the previous detection can be kept, and the regions
+        (partitioning the rest of the new crop area) where circles have to be detected again.
+
+        Where the crop area grew, the circles of the previous detection closer than the margin to its
+        border are detected again, since they were detected without seeing their surroundings. Where
+        the crop area shrank, the previous circles are only filtered. """
+
+    px0, py0, px1, py1 = previous_area
+    x0, y0, x1, y1 = area
+
+    kept_area = (
+        x0 if x0 >= px0 else px0 + margin,
+        y0 if y0 >= py0 else py0 + margin,
+        x1 if x1 <= px1 else px1 - margin,
+        y1 if y1 <= py1 else py1 - margin)
+    kx0, ky0, kx1, ky1 = kept_area
+    if kx0 >= kx1 or ky0 >= ky1:
+        return None, [area]
+
+    regions = [
+        (x0, y0, x1, ky0),  # top
+        (x0, ky1, x1, y1),  # bottom
+        (x0, ky0, kx0, ky1),  # left
+        (kx1, ky0, x1, ky1),  # right
+    ]
+    return kept_area, [region for region in regions if get_area_size(region) > 0]
+
+
+def update_detection(img, detection, detector, parameters, crop_area):
+    """ Returns the circles of the crop area (relative to it, like the detector's result) by updating the
+        previous detection, or None if the detection has to be done from scratch.
+
+        img is the cropped image. """
+
+    if detection is None or not detection.matches(detector, parameters):
+        return None
+
+    margin = detector.get_margin(parameters) if hasattr(detector, 'get_margin') else None
+    if margin is None:
+        # Without knowing the margin, only shrinking can be handled (as a filter):
+        margin = max(img.shape)
+
+    kept_area, regions = get_incremental_regions(detection.crop_area, crop_area, margin)
+    if kept_area is None:
+        return None
+
+    exposed_area = sum(get_area_size(region) for region in regions)
+    if exposed_area > MAX_EXPOSED_FRACTION * get_area_size(crop_area):
+        return None
+    if len(regions) > 0 and not hasattr(detector, 'update_circles'):
+        return None
+
+    with tracing.span('update_detection', regions=len(regions), exposed_pixels=exposed_area) as span:
+        kx0, ky0, kx1, ky1 = kept_area
+        circles = detection.circles
+        kept = ((circles[:, 0] >= kx0) & (circles[:, 0] < kx1) &
+                (circles[:, 1] >= ky0) & (circles[:, 1] < ky1))
+        kept_circles = circles[kept].copy()
+        kept_circles[:, :2] -= crop_area[:2]
+        span.set(kept_circles=len(kept_circles))
+
+        if len(regions) == 0:
+            return np.uint16(np.around(kept_circles)) if len(kept_circles) > 0 else []
+
+        # Regions relative to the cropped image:
+        x0, y0 = crop_area[:2]
+        regions = [(rx0 - x0, ry0 - y0, rx1 - x0, ry1 - y0) for rx0, ry0, rx1, ry1 in regions]
+        return detector.update_circles(img, parameters, kept_circles, regions)
@@ -0,0 +1,510 @@
+import argparse
+import concurrent.futures
+import csv
+import importlib
+import itertools
+import math
+import os
+import random
+import sys
+import time
+
+import numpy as np
+from scipy import spatial
+
+from parameters import read_parameter_file, write_parameter_file, resolve_parameter_file
+
+
+class ParameterRange:
+    """ Range of integer values of a swept parameter (inclusive), sampled with the given step on grids. """
+
+    def __init__(self, name, start, end, step):
+        self.name = name
+        self.start = int(start)
+        self.end = int(end)
+        self.step = max(1, int(step))
+
+    def grid_values(self):
+        values = list(range(self.start, self.end + 1, self.step))
+        if values[-1] != self.end:
+            values.append(self.end)
+        return values
+
+    def random_value(self, rng):
+        return rng.randint(self.start, self.end)
+
+
+def get_declared_ranges(detector, processor):
+    ranges = {}
+    for parameter in detector.get_parameter_list() + processor.get_parameter_list():
+        if parameter[0] not in ranges:
+            ranges[parameter[0]] = (parameter[1], parameter[2])
+    return ranges
+
+
+def parse_parameter_range(text, declared_ranges):
+    """ Parses a parameter range given as "name", "name=start:end" or "name=start:end:step".
+
+        Without an explicit range the declared range of the parameter is used, without
+        a step the range is split into about 10 grid points. """
+
+    name, separator, range_text = text.partition('=')
+    name = name.strip()
+    if name not in declared_ranges:
+        raise ValueError('Unknown parameter: ' + name)
+
+    start, end = declared_ranges[name]
+    step = None
+    if separator:
+        values = [int(value) for value in range_text.split(':')]
+        start, end = values[0], values[1]
+        if len(values) > 2:
+            step = values[2]
+
+    if step is None:
+        step = max(1, math.ceil((end - start) / 9))
+
+    return ParameterRange(name, start, end, step)
+
+
+def grid_points(parameter_ranges):
+    names = [parameter_range.name for parameter_range in parameter_ranges]
+    for values in itertools.product(*(parameter_range.grid_values() for parameter_range in parameter_ranges)):
+        yield dict(zip(names, values))
+
+
+def random_points(parameter_ranges, count, rng):
+    for _ in range(count):
+        yield {parameter_range.name: parameter_range.random_value(rng) for parameter_range in parameter_ranges}
+
+
+def refine_ranges(parameter_ranges, best_point, points_per_parameter):
+    # Zoom in around the best point: the new range spans two grid steps of the previous one:
+    refined_ranges = []
+    for parameter_range in parameter_ranges:
+        center = best_point[parameter_range.name]
+        half_span = parameter_range.step
+        start = max(parameter_range.start, center - half_span)
+        end = min(parameter_range.end, center + half_span)
+        step = max(1, math.ceil((end - start) / max(1, points_per_parameter - 1)))
+        refined_ranges.append(ParameterRange(parameter_range.name, start, end, step))
+    return refined_ranges
+
+
+class Trial:
+    def __init__(self, point, parameter_values):
+        self.point = point
+        self.parameter_values = parameter_values
+
+        # Measurements for each image, filled in by evaluate_trial:
+        self.measurements = None
+        self.seconds = 0.0
+        self.error = None
+        self.score = None
+
+
+# Objectives score the trials, higher is better. measure() runs in the worker processes for every
+# trial and image and returns a dict of numbers, score_trials() ranks all measured trials. The
+# base measurements (circles, hex, coverage) are always available.
+
+class HexRatioObjective:
+    @staticmethod
+    def get_name():
+        return 'hex-ratio'
+
+    def measure(self, image_index, circles, classification, crop_area):
+        return {}
+
+    def score_trials(self, trials):
+        scores = []
+        for trial in trials:
+            circle_count = sum(measurement['circles'] for measurement in trial.measurements)
+            hex_count = sum(measurement['hex'] for measurement in trial.measurements)
+            scores.append(hex_count / circle_count if circle_count > 0 else 0.0)
+        return scores
+
+
+class CountStabilityObjective:
+    """ Prefers parameters where the circle count doesn't change when the parameters are slightly changed.
+
+        A stable count is a sign that the detection is not at the edge of finding noise or losing
+        particles. The neighbors of a trial are its nearest trials in the normalized parameter space. """
+
+    def __init__(self, neighbor_count=None):
+        self.neighbor_count = neighbor_count
+
+    @staticmethod
+    def get_name():
+        return 'count-stability'
+
+    def measure(self, image_index, circles, classification, crop_area):
+        return {}
+
+    def score_trials(self, trials):
+        if len(trials) < 2:
+            return [0.0] * len(trials)
+
+        names = sorted(trials[0].point)
+        points = np.array([[trial.point[name] for name in names] for trial in trials], np.float64)
+        spans = points.max(axis=0) - points.min(axis=0)
+        points /= np.where(spans > 0, spans, 1.0)
+
+        counts = np.array([[measurement['circles'] for measurement in trial.measurements] for trial in trials],
+                          np.float64)
+
+        neighbor_count = self.neighbor_count or min(len(trials) - 1, 2 * len(names))
+        distances, neighbors = spatial.cKDTree(points).query(points, neighbor_count + 1)
+        neighbors = neighbors[:, 1:]
+
+        # Relative change of the count of each image, averaged over the neighbors and the images:
+        relative_changes = np.abs(counts[neighbors] - counts[:, None, :]) / np.maximum(counts[:, None, :], 1.0)
+        scores = 1.0 - relative_changes.mean(axis=(1, 2))
+
+        # Finding nothing is perfectly stable, but useless:
+        scores[counts.sum(axis=1) == 0] = 0.0
+        return list(scores)
+
+
+class ReferenceAgreementObjective:
+    """ Scores the agreement (F1 score) of the detected circles with annotated reference circles.
+
+        The reference circles of an image are read from a CSV file with x, y and r columns (eg. a
+        corrected circle list written by batch.py). A detection matches a reference circle if its center
+        is closer than the tolerance (relative to the reference radius) and its radius is within it too. """
+
+    def __init__(self, reference_circles, tolerance=0.5):
+        # List of Nx3 arrays of reference circles, in the order of the images:
+        self.reference_circles = reference_circles
+        self.tolerance = tolerance
+
+    @staticmethod
+    def get_name():
+        return 'reference'
+
+    def measure(self, image_index, circles, classification, crop_area):
+        reference = self.reference_circles[image_index]
+        circles = np.asarray(circles, np.float64)[:, :3] if len(circles) > 0 else np.zeros((0, 3))
+
+        matched = 0
+        if len(reference) > 0 and len(circles) > 0:
+            # Reference circles are in full image coordinates, detections relative to the crop area:
+            centers = circles[:, :2] + np.array(crop_area[:2], np.float64)
+            distances, indices = spatial.cKDTree(centers).query(reference[:, :2])
+            radius_tolerance = self.tolerance * reference[:, 2]
+            is_match = ((distances <= radius_tolerance) &
+                        (np.abs(circles[np.minimum(indices, len(circles) - 1), 2] - reference[:, 2]) <= radius_tolerance))
+            # Each detection can only match a single reference circle:
+            matched = len(np.unique(indices[is_match]))
+
+        return {'reference': len(reference), 'matched': matched}
+
+    def score_trials(self, trials):
+        scores = []
+        for trial in trials:
+            reference_count = sum(measurement['reference'] for measurement in trial.measurements)
+            detected_count = sum(measurement['circles'] for measurement in trial.measurements)
+            matched_count = sum(measurement['matched'] for measurement in trial.measurements)
+            scores.append(2.0 * matched_count / (reference_count + detected_count)
+                          if reference_count + detected_count > 0 else 0.0)
+        return scores
+
+
+OBJECTIVES = {
+    objective.get_name(): objective
+    for objective in [HexRatioObjective, CountStabilityObjective, ReferenceAgreementObjective]
+}
+
+
+def load_objective_class(name):
+    # Built-in objectives are selected by name, custom ones as "module.ClassName":
+    if name in OBJECTIVES:
+        return OBJECTIVES[name]
+    module_name, separator, class_name = name.rpartition('.')
+    if not separator:
+        raise ValueError('Unknown objective: ' + name)
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def read_reference_circles(filename):
+    with open(filename, 'r', newline='') as infile:
+        rows = list(csv.DictReader(infile))
+    return np.array([[float(row['x']), float(row['y']), float(row['r'])] for row in rows]).reshape(-1, 3)
+
+
+# State of the worker processes, set up once per process by init_worker:
+_worker_state = None
+
+# Number of preprocessed images kept per worker:
+PREPROCESSED_CACHE_SIZE = 16
+
+
+class WorkerState:
+    def __init__(self, image_paths, autodetect_crop_area, detector, processor, objective):
+        from image_processor import ImageProcessor
+
+        self.detector = detector
+        self.processor = processor
+        self.objective = objective
+
+        # Images are loaded and cropped once per worker and reused across the trials:
+        self.images = []
+        self.crop_areas = []
+        for image_path in image_paths:
+            image_processor = ImageProcessor(image_path)
+            if autodetect_crop_area:
+                image_processor.autodetect_crop_area()
+            x0, y0, x1, y1 = image_processor.active_crop_area
+            self.images.append(image_processor.grayscale_image[y0:y1, x0:x1].copy())
+            self.crop_areas.append(image_processor.active_crop_area)
+
+        # Preprocessed images, keyed by image index and preprocessing parameter values, most recently used last:
+        self.preprocessed_images = {}
+
+    def get_preprocessed_image(self, image_index, parameter_values):
+        key = (image_index,) + tuple(parameter_values[name] for name in self.detector.PREPROCESSING_PARAMETERS)
+        if key in self.preprocessed_images:
+            self.preprocessed_images[key] = self.preprocessed_images.pop(key)
+        else:
+            if len(self.preprocessed_images) >= PREPROCESSED_CACHE_SIZE:
+                del self.preprocessed_images[next(iter(self.preprocessed_images))]
+            self.preprocessed_images[key] = self.detector.preprocess(self.images[image_index], parameter_values)
+        return self.preprocessed_images[key]
+
+    def detect(self, image_index, parameter_values):
+        if hasattr(self.detector, 'preprocess') and hasattr(self.detector, 'PREPROCESSING_PARAMETERS'):
+            return self.detector.evaluate_preprocessed(
+                self.get_preprocessed_image(image_index, parameter_values), parameter_values)
+        return self.detector.evaluate(self.images[image_index], parameter_values)
+
+
+def init_worker(image_paths, autodetect_crop_area, detector, processor, objective):
+    global _worker_state
+    import cv2
+    # Parallelism comes from the process pool:
+    cv2.setNumThreads(1)
+    _worker_state = WorkerState(image_paths, autodetect_crop_area, detector, processor, objective)
+
+
+def evaluate_trial(trial):
+    from processors.classifiers.classification_common import calculate_coverage
+    from process import get_processor_results
+
+    state = _worker_state
+    start_time = time.perf_counter()
+    trial.measurements = []
+
+    try:
+        for image_index, img in enumerate(state.images):
+            circles = state.detect(image_index, trial.parameter_values)
+            classification = get_processor_results(state.processor.evaluate(img, circles, trial.parameter_values))[0]
+
+            measurement = {
+                'circles': len(circles),
+                'hex': int(np.sum(classification)) if len(classification) == len(circles) else 0,
+                'coverage': calculate_coverage(circles, img.shape[0] * img.shape[1]),
+            }
+            measurement.update(state.objective.measure(image_index, circles, classification, state.crop_areas[image_index]))
+            trial.measurements.append(measurement)
+    except Exception as exception:
+        trial.error = str(exception)
+
+    trial.seconds = time.perf_counter() - start_time
+    return trial
+
+
+class ParameterSweep:
+    """ Evaluates parameter points on a set of images in a process pool and ranks them by the objective. """
+
+    def __init__(self, image_paths, detector, processor, base_parameter_values, objective,
+                 worker_count=None, autodetect_crop_area=True, progress_stream=sys.stdout):
+        self.image_paths = image_paths
+        self.detector = detector
+        self.processor = processor
+        self.base_parameter_values = base_parameter_values
+        self.objective = objective
+        self.worker_count = worker_count or os.cpu_count()
+        self.autodetect_crop_area = autodetect_crop_area
+        self.progress_stream = progress_stream
+
+        # All evaluated trials, keyed by their parameter point:
+        self.trials = {}
+        self.executor = None
+
+    def __enter__(self):
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.worker_count,
+            initializer=init_worker,
+            initargs=(self.image_paths, self.autodetect_crop_area, self.detector, self.processor, self.objective))
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.executor.shutdown()
+        self.executor = None
+
+    @staticmethod
+    def point_key(point):
+        return tuple(sorted(point.items()))
+
+    def evaluate_points(self, points):
+        new_trials = []
+        for point in points:
+            if self.point_key(point) not in self.trials:
+                parameter_values = dict(self.base_parameter_values)
+                parameter_values.update(point)
+                trial = Trial(point, parameter_values)
+                self.trials[self.point_key(point)] = trial
+                new_trials.append(trial)
+
+        # Trials sharing preprocessing parameters are submitted next to each other, so the
+        # chunks sent to a worker mostly reuse the same preprocessed images:
+        preprocessing_parameters = getattr(self.detector, 'PREPROCESSING_PARAMETERS', [])
+        new_trials.sort(key=lambda trial: tuple(trial.parameter_values[name] for name in preprocessing_parameters))
+
+        chunk_size = max(1, min(16, len(new_trials) // (4 * self.worker_count)))
+        start_time = time.perf_counter()
+        for index, trial in enumerate(self.executor.map(evaluate_trial, new_trials, chunksize=chunk_size)):
+            self.trials[self.point_key(trial.point)] = trial
+            if self.progress_stream and ((index + 1) % max(1, len(new_trials) // 20) == 0 or index + 1 == len(new_trials)):
+                print(f'{index + 1}/{len(new_trials)} trials evaluated ({time.perf_counter() - start_time:.1f} s)',
+                      file=self.progress_stream, flush=True)
+
+        self.score_trials()
+
+    def score_trials(self):
+        trials = self.get_valid_trials()
+        for trial, score in zip(trials, self.objective.score_trials(trials)):
+            trial.score = float(score)
+
+    def get_valid_trials(self):
+        return [trial for trial in self.trials.values() if trial.error is None]
+
+    def get_ranked_trials(self):
+        return sorted(self.get_valid_trials(), key=lambda trial: -trial.score)
+
+    def run_grid(self, parameter_ranges):
+        self.evaluate_points(grid_points(parameter_ranges))
+
+    def run_random(self, parameter_ranges, count, seed=None):
+        self.evaluate_points(random_points(parameter_ranges, count, random.Random(seed)))
+
+    def run_coarse_to_fine(self, parameter_ranges, rounds, points_per_parameter):
+        for _ in range(rounds):
+            coarse_ranges = [ParameterRange(parameter_range.name,
+                                            parameter_range.start,
+                                            parameter_range.end,
+                                            math.ceil((parameter_range.end - parameter_range.start) /
+                                                      max(1, points_per_parameter - 1)))
+                             for parameter_range in parameter_ranges]
+            self.evaluate_points(grid_points(coarse_ranges))
+
+            ranked_trials = self.get_ranked_trials()
+            if len(ranked_trials) == 0 or all(parameter_range.step == 1 for parameter_range in coarse_ranges):
+                break
+            parameter_ranges = refine_ranges(coarse_ranges, ranked_trials[0].point, points_per_parameter)
+
+    def write_table(self, filename):
+        ranked_trials = self.get_ranked_trials()
+        swept_names = sorted(ranked_trials[0].point) if ranked_trials else []
+
+        with open(filename, 'w', newline='') as outfile:
+            writer = csv.writer(outfile)
+            writer.writerow(['rank', 'score'] + swept_names + ['circles', 'hex', 'coverage', 'seconds'])
+            for rank, trial in enumerate(ranked_trials, 1):
+                image_count = max(1, len(trial.measurements))
+                writer.writerow(
+                    [rank, trial.score] +
+                    [trial.point[name] for name in swept_names] +
+                    [sum(measurement['circles'] for measurement in trial.measurements) / image_count,
+                     sum(measurement['hex'] for measurement in trial.measurements) / image_count,
+                     sum(measurement['coverage'] for measurement in trial.measurements) / image_count,
+                     trial.seconds])
+
+    def write_best_parameters(self, filename):
+        ranked_trials = self.get_ranked_trials()
+        if ranked_trials:
+            write_parameter_file(filename, self.detector, self.processor, ranked_trials[0].parameter_values)
+
+
+def parse_arguments(arguments=None):
+    parser = argparse.ArgumentParser(
+        description='Search detector and processor parameters maximizing an objective on a set of images.')
+    parser.add_argument('images', nargs='+', help='image files')
+    parser.add_argument('-o', '--output', required=True, help='output directory for the ranked table and the best .par')
+    parser.add_argument('-p', '--parameters', help='parameter file with the detector, processor and fixed parameter values')
+    parser.add_argument('--detector', help='detector name (if not given in the parameter file)')
+    parser.add_argument('--processor', help='processor name (if not given in the parameter file)')
+    parser.add_argument('-s', '--sweep', action='append', required=True,
+                        help='swept parameter as "name", "name=start:end" or "name=start:end:step", can be repeated')
+    parser.add_argument('--strategy', choices=['grid', 'random', 'coarse-to-fine'], default='grid')
+    parser.add_argument('--trials', type=int, default=100, help='number of trials of the random strategy')
+    parser.add_argument('--rounds', type=int, default=3, help='number of refinement rounds of the coarse-to-fine strategy')
+    parser.add_argument('--points', type=int, default=5,
+                        help='grid points per parameter and round of the coarse-to-fine strategy')
+    parser.add_argument('--seed', type=int, help='random seed of the random strategy')
+    parser.add_argument('--objective', default='hex-ratio',
+                        help='objective: ' + ', '.join(OBJECTIVES) + ' or a custom objective class as "module.ClassName"')
+    parser.add_argument('--reference-suffix', default='.reference.csv',
+                        help='suffix of the reference circle files of the reference objective, '
+                             'next to the images (default: .reference.csv)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--no-autocrop', action='store_true',
+                        help="process the full images instead of detecting the SEM information panel")
+    return parser.parse_args(arguments)
+
+
+def main(arguments=None):
+    from image_processor import ImageProcessor
+
+    args = parse_arguments(arguments)
+
+    available_detectors = ImageProcessor.get_available_detectors()
+    available_processors = ImageProcessor.get_available_processors()
+
+    data = read_parameter_file(args.parameters) if args.parameters else {'parameters': {}}
+    if args.detector:
+        data['detector'] = args.detector
+    if args.processor:
+        data['processor'] = args.processor
+    data.setdefault('detector', available_detectors[0].get_name())
+    data.setdefault('processor', available_processors[0].get_name())
+    detector, processor, base_parameter_values = resolve_parameter_file(data, available_detectors, available_processors)
+
+    declared_ranges = get_declared_ranges(detector, processor)
+    parameter_ranges = [parse_parameter_range(text, declared_ranges) for text in args.sweep]
+
+    objective_class = load_objective_class(args.objective)
+    if objective_class is ReferenceAgreementObjective:
+        objective = ReferenceAgreementObjective(
+            [read_reference_circles(os.path.splitext(path)[0] + args.reference_suffix) for path in args.images])
+    else:
+        objective = objective_class()
+
+    os.makedirs(args.output, exist_ok=True)
+
+    with ParameterSweep(args.images, detector, processor, base_parameter_values, objective,
+                        max(1, args.jobs), not args.no_autocrop) as sweep:
+        if args.strategy == 'grid':
+            sweep.run_grid(parameter_ranges)
+        elif args.strategy == 'random':
+            sweep.run_random(parameter_ranges, args.trials, args.seed)
+        else:
+            sweep.run_coarse_to_fine(parameter_ranges, args.rounds, args.points)
+
+    sweep.write_table(os.path.join(args.output, 'sweep.csv'))
+    sweep.write_best_parameters(os.path.join(args.output, 'best.par'))
+
+    for trial in sweep.trials.values():
+        if trial.error is not None:
+            print('Trial ' + str(trial.point) + ' failed: ' + trial.error, file=sys.stderr)
+
+    ranked_trials = sweep.get_ranked_trials()
+    if not ranked_trials:
+        print('No successful trials.', file=sys.stderr)
+        return 1
+
+    print('Best (' + objective.get_name() + f' = {ranked_trials[0].score:.4f}): ' + str(ranked_trials[0].point))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,70 @@
+import json
+
+
+# Parameter files (.par) are JSON files of the following format:
+# {
+#     "detector": <detector name>,
+#     "processor": <processor name>,
+#     "parameters": {<parameter id>: <value>, ...}
+# }
+# Old versions of saved parameters call the processor "classifier".
+
+def read_parameter_file(filename):
+    with open(filename, 'r') as infile:
+        data = json.load(infile)
+
+    # Process old version of saved parameters where 'processors' were called 'classifiers':
+    if 'processor' not in data and 'classifier' in data:
+        data['processor'] = data['classifier']
+
+    if 'parameters' not in data:
+        data['parameters'] = {}
+
+    return data
+
+
+def write_parameter_file(filename, detector, processor, parameter_values):
+    with open(filename, 'w') as outfile:
+        data = {
+            'detector': detector.get_name(),
+            'processor': processor.get_name(),
+            'parameters': parameter_values
+        }
+        json.dump(data, outfile, indent=4)
+
+
+def find_algorithm(algorithms, name):
+    for algorithm in algorithms:
+        if algorithm.get_name() == name:
+            return algorithm
+    return None
+
+
+def get_default_parameter_values(detector, processor):
+    # Same merging as in the GUI: detector parameters first, processor parameters
+    # with an id already used by the detector share the value of the detector parameter.
+    parameter_values = {}
+    for parameter in detector.get_parameter_list() + processor.get_parameter_list():
+        if parameter[0] not in parameter_values:
+            parameter_values[parameter[0]] = parameter[3]
+    return parameter_values
+
+
+def resolve_parameter_file(data, available_detectors, available_processors):
+    """ Returns the detector, processor and complete parameter values described by the
+        (already read) parameter file data. Missing parameters are set to their defaults. """
+
+    detector = find_algorithm(available_detectors, data.get('detector'))
+    if detector is None:
+        raise ValueError('Unknown detector: ' + str(data.get('detector')))
+
+    processor = find_algorithm(available_processors, data.get('processor'))
+    if processor is None:
+        raise ValueError('Unknown processor: ' + str(data.get('processor')))
+
+    parameter_values = get_default_parameter_values(detector, processor)
+    for key in parameter_values:
+        if key in data['parameters']:
+            parameter_values[key] = data['parameters'][key]
+
+    return detector, processor, parameter_values
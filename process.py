@@ -1,11 +1,47 @@
 import cv2
+import numpy as np
+import tracing
+from detectors.circle_refinement import refine_circles
 
 
-def process_image(img, detector, detector_parameters, processor, processor_parameters):
-    circles = detector.evaluate(img, detector_parameters)
-    circle_classification = processor.evaluate(img, circles, processor_parameters)
+def get_processor_results(results):
+    """ Returns the classes (int array, empty if the circles are not classified) and the metrics (dict of
+        per-circle arrays) of the result of a processor's evaluate.
 
-    return circles, circle_classification
+        Processors return a (classes, metrics) tuple of arrays, processors written for the earlier
+        interface return a list of classes, which is converted here. """
+
+    if isinstance(results, tuple) and len(results) == 2 and isinstance(results[1], dict):
+        classes, metrics = results
+    else:
+        classes, metrics = results, {}
+    classes = np.asarray(classes, np.int64).reshape(-1)
+    return classes, {name: np.asarray(values) for name, values in metrics.items()}
+
+
+def process_image(img, detector, detector_parameters, processor, processor_parameters, is_cancelled=None, circles=None):
+    # Circles given by the caller (eg. updated from a previous detection) are only processed:
+    with tracing.span('process_image', width=img.shape[1], height=img.shape[0]):
+        if circles is None:
+            with tracing.span('detect', detector=detector.get_name()) as span:
+                circles = detector.evaluate(img, detector_parameters)
+                span.set(circles=len(circles))
+
+        # Optional refinement of the whole pixel circles to sub-pixel precision. Circles given by the caller
+        # are refined again, refining is stable, and the updated parts of a detection are whole pixels:
+        refinement_iterations = detector_parameters.get('Refinement iterations', 0)
+        if refinement_iterations > 0 and len(circles) > 0:
+            circles = refine_circles(img, circles, refinement_iterations)
+
+        # Skip the processor if the evaluation was superseded while detecting:
+        if is_cancelled and is_cancelled():
+            return None
+
+        with tracing.span('process', processor=processor.get_name(), circles=len(circles)):
+            circle_classification, circle_metrics = get_processor_results(
+                processor.evaluate(img, circles, processor_parameters))
+
+    return circles, circle_classification, circle_metrics
 
 
 def overlay_circles(img, circles, circle_classification, draw_perimeters):
@@ -26,7 +62,7 @@ def overlay_circles(img, circles, circle_classification, draw_perimeters):
 
 def process_image_and_show(image_path, edge_detect_threshold, circle_threshold, radius, loose_circle_threshold=1.2):
     img = cv2.imread(image_path, 0)
-    circles, circle_classification = process_image(
+    circles, circle_classification, circle_metrics = process_image(
         img, edge_detect_threshold, circle_threshold, radius, loose_circle_threshold)
     img_processed = overlay_circles(img, circles, circle_classification)
     cv2.imshow(image_path + ': circle classification', img_processed)
@@ -0,0 +1,264 @@
+import threading
+import weakref
+import numpy as np
+import cv2
+
+
+# Upper bound for the number of gathered pixel values held in memory at once
+# when calculating the minimum/maximum brightness of the circles:
+GATHER_CHUNK_SIZE = 1 << 22
+
+
+def disk_offsets(radius):
+    """ Returns the row offsets (dy) and half widths of the rows of a disk with the given radius.
+
+        Row dy of the disk covers the pixels cx - half_width[dy] ... cx + half_width[dy] (inclusive),
+        which are exactly the pixels with dx^2 + dy^2 <= radius^2. """
+
+    dy = np.arange(-radius, radius + 1)
+    half_widths = np.floor(np.sqrt(radius * radius - dy * dy)).astype(np.int64)
+    return dy, half_widths
+
+
+def disk_mask(radius):
+    """ Returns a boolean (2r+1)x(2r+1) mask of a disk with the given radius. """
+
+    dy, dx = np.ogrid[-radius:radius + 1, -radius:radius + 1]
+    return dx * dx + dy * dy <= radius * radius
+
+
+class CircleStatistics:
+    """ Brightness statistics of circles calculated over their true disk area.
+
+        Circles partially outside the image are evaluated over their visible part only,
+        pixel_count is zero (and every statistic NaN) for circles that are entirely outside. """
+
+    def __init__(self, pixel_count, mean, variance, img, centers, radii):
+        self.pixel_count = pixel_count
+        self.mean = mean
+        self.variance = variance
+
+        # Extrema can't be calculated from the summed-area tables, they are
+        # gathered from the image on first access:
+        self._img = img
+        self._centers = centers
+        self._radii = radii
+        self._minimum = None
+        self._maximum = None
+
+    def __len__(self):
+        return len(self.mean)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    @property
+    def minimum(self):
+        if self._minimum is None:
+            self._calculate_extrema()
+        return self._minimum
+
+    @property
+    def maximum(self):
+        if self._maximum is None:
+            self._calculate_extrema()
+        return self._maximum
+
+    def _calculate_extrema(self):
+        circle_count = len(self._radii)
+        self._minimum = np.full(circle_count, np.nan)
+        self._maximum = np.full(circle_count, np.nan)
+
+        height, width = self._img.shape[:2]
+
+        for radius in np.unique(self._radii):
+            indices = np.flatnonzero(self._radii == radius)
+            dy, dx = np.nonzero(disk_mask(radius))
+            dy = dy - radius
+            dx = dx - radius
+
+            chunk_size = max(1, GATHER_CHUNK_SIZE // len(dx))
+            for chunk_start in range(0, len(indices), chunk_size):
+                chunk = indices[chunk_start:chunk_start + chunk_size]
+                xs = self._centers[chunk, 0, None] + dx[None, :]
+                ys = self._centers[chunk, 1, None] + dy[None, :]
+                inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+                values = self._img[np.clip(ys, 0, height - 1), np.clip(xs, 0, width - 1)].astype(np.float64)
+
+                minimum = np.where(inside, values, np.inf).min(axis=1)
+                maximum = np.where(inside, values, -np.inf).max(axis=1)
+                has_pixels = np.isfinite(minimum)
+                self._minimum[chunk] = np.where(has_pixels, minimum, np.nan)
+                self._maximum[chunk] = np.where(has_pixels, maximum, np.nan)
+
+        # The image reference is no longer needed:
+        self._img = None
+
+
+class ImageStatistics:
+    """ Summed-area tables of an image, used to calculate the statistics of many circles at once. """
+
+    def __init__(self, img):
+        self.img = img
+        self.height, self.width = img.shape[:2]
+
+        # Integral images of the values and squared values, (height+1)x(width+1) each.
+        # Double precision is required to avoid overflowing on large images:
+        self.sum_table, self.square_sum_table = cv2.integral2(img, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+
+        # (size, table) of the summed-area table of the image padded for boxes of a size (the last size
+        # used) and (size, image) of the blurred image of a size (the last size displayed), created on
+        # first use. The image is shared by threads, each cache is replaced as a whole:
+        self.box_sum_table = None
+        self.background = None
+
+        # (key, statistics) of the last circles, reused while only the classification parameters change:
+        self.last_circle_statistics = None
+
+    def get_box_sum_table(self, size):
+        box_sum_table = self.box_sum_table
+        if box_sum_table is None or box_sum_table[0] != size:
+            # Padded like cv2.blur pads the image, so the boxes near the sides have the same means:
+            before = size // 2
+            after = size - 1 - before
+            padded_img = cv2.copyMakeBorder(self.img, before, after, before, after, cv2.BORDER_REFLECT_101)
+            box_sum_table = (size, cv2.integral(padded_img, sdepth=cv2.CV_64F))
+            self.box_sum_table = box_sum_table
+        return box_sum_table[1]
+
+    def local_means(self, points, size):
+        """ Returns the means of the size x size boxes around the (x, y) points, the same as cv2.blur
+            (without rounding) at the points, computed only at the points. Points are clamped into the image. """
+
+        points = np.asarray(points)
+        xs = np.clip(np.around(points[:, 0].astype(np.float64)).astype(np.int64), 0, self.width - 1)
+        ys = np.clip(np.around(points[:, 1].astype(np.float64)).astype(np.int64), 0, self.height - 1)
+
+        # Box of the point (x, y) in the padded image is [x, x + size) x [y, y + size):
+        table = self.get_box_sum_table(size)
+        box_sums = table[ys + size, xs + size] - table[ys, xs + size] - table[ys + size, xs] + table[ys, xs]
+        return box_sums / (size * size)
+
+    def get_background(self, size):
+        # The local means of every pixel (for display), the image blurred by size x size boxes:
+        background = self.background
+        if background is None or background[0] != size:
+            background = (size, cv2.blur(self.img, (size, size)))
+            self.background = background
+        return background[1]
+
+    def circle_statistics(self, circles):
+        circle_count = len(circles)
+        if circle_count == 0:
+            empty = np.zeros(0)
+            return CircleStatistics(empty.astype(np.int64), empty, empty, self.img, np.zeros((0, 2), np.int64), empty.astype(np.int64))
+
+        circles = np.asarray(circles)
+        circles_key = (circles.dtype.str, circles.shape, circles.tobytes())
+        last_circle_statistics = self.last_circle_statistics
+        if last_circle_statistics is not None and last_circle_statistics[0] == circles_key:
+            return last_circle_statistics[1]
+
+        centers = np.around(circles[:, :2].astype(np.float64)).astype(np.int64)
+        radii = np.maximum(np.around(circles[:, 2].astype(np.float64)).astype(np.int64), 0)
+
+        pixel_count = np.zeros(circle_count, np.int64)
+        sums = np.zeros(circle_count)
+        square_sums = np.zeros(circle_count)
+
+        # Circles of the same radius share the same row decomposition, so they are evaluated together:
+        for radius in np.unique(radii):
+            indices = np.flatnonzero(radii == radius)
+            dy, half_widths = disk_offsets(radius)
+
+            ys = centers[indices, 1, None] + dy[None, :]
+            x0 = centers[indices, 0, None] - half_widths[None, :]
+            x1 = centers[indices, 0, None] + half_widths[None, :] + 1
+
+            # Clip the rows to the image:
+            row_inside = (ys >= 0) & (ys < self.height)
+            ys = np.clip(ys, 0, self.height - 1)
+            x0 = np.clip(x0, 0, self.width)
+            x1 = np.clip(x1, 0, self.width)
+            row_widths = np.where(row_inside, x1 - x0, 0)
+
+            pixel_count[indices] = row_widths.sum(axis=1)
+            sums[indices] = self._row_span_sums(self.sum_table, ys, x0, x1, row_inside)
+            square_sums[indices] = self._row_span_sums(self.square_sum_table, ys, x0, x1, row_inside)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = sums / pixel_count
+            variance = np.maximum(square_sums / pixel_count - mean * mean, 0.0)
+
+        circle_statistics = CircleStatistics(pixel_count, mean, variance, self.img, centers, radii)
+        self.last_circle_statistics = (circles_key, circle_statistics)
+        return circle_statistics
+
+    @staticmethod
+    def _row_span_sums(table, ys, x0, x1, row_inside):
+        # Sum of the pixels [x0, x1) in row y from the summed-area table:
+        span_sums = table[ys + 1, x1] - table[ys, x1] - table[ys + 1, x0] + table[ys, x0]
+        return np.where(row_inside, span_sums, 0.0).sum(axis=1)
+
+
+# Summed-area tables of the most recently used (cropped) image of the recently used image buffers,
+# as (weak reference to the buffer, key of the image, statistics) by the id of the buffer. The
+# processors are called with the same image multiple times, eg. while tuning parameters, so the
+# tables are only rebuilt when the image changes. Images of several windows are evaluated in
+# parallel threads, each image keeps its own entry:
+IMAGE_STATISTICS_CACHE_SIZE = 8
+_image_statistics_cache = {}
+# Reentrant, the weak reference callbacks may run while the lock is held:
+_image_statistics_lock = threading.RLock()
+
+
+def _image_base(img):
+    base = img
+    while isinstance(base.base, np.ndarray):
+        base = base.base
+    return base
+
+
+def _image_key(img):
+    # Cropped images are new view objects on every evaluation, so they are identified
+    # by their position in the underlying buffer:
+    return (img.__array_interface__['data'][0], img.shape, img.strides, img.dtype.str)
+
+
+def _forget_image_statistics(base_id, reference):
+    # The buffer was freed, its address may be reused by a different image:
+    with _image_statistics_lock:
+        entry = _image_statistics_cache.get(base_id)
+        if entry is not None and entry[0] is reference:
+            del _image_statistics_cache[base_id]
+
+
+def get_image_statistics(img):
+    base = _image_base(img)
+    key = _image_key(img)
+
+    with _image_statistics_lock:
+        entry = _image_statistics_cache.get(id(base))
+        if entry is not None and entry[0]() is base and entry[1] == key:
+            # Most recently used last:
+            _image_statistics_cache[id(base)] = _image_statistics_cache.pop(id(base))
+            return entry[2]
+
+    image_statistics = ImageStatistics(img)
+    try:
+        reference = weakref.ref(base, lambda reference, base_id=id(base): _forget_image_statistics(base_id, reference))
+    except TypeError:
+        # Buffer can't be weakly referenced, don't cache:
+        return image_statistics
+
+    with _image_statistics_lock:
+        _image_statistics_cache.pop(id(base), None)
+        _image_statistics_cache[id(base)] = (reference, key, image_statistics)
+        while len(_image_statistics_cache) > IMAGE_STATISTICS_CACHE_SIZE:
+            del _image_statistics_cache[next(iter(_image_statistics_cache))]
+    return image_statistics
+
+
+def calculate_circle_statistics(img, circles):
+    return get_image_statistics(img).circle_statistics(circles)
@@ -1,75 +1,52 @@
-from matplotlib.pyplot import draw
 import numpy as np
-import cv2
 from .classification_common import update_result_image
+from .circle_statistics import calculate_circle_statistics, get_image_statistics
 
-def circle_avg_brightness(circle, img):
-    sum_brightness = 0
-    counter = 0
 
-    cx = int(circle[0])
-    cy = int(circle[1])
-    cr = int(circle[2])
-
-    if cx - cr < 0 or cx + cr >= len(img[0]) or cy - cr < 0 or cy + cr >= len(img):
-        return 0
-
-    for x in range(cx - cr, cx + cr):
-        for y in range(cy - cr, cy + cr):
-            sum_brightness += img[y, x]
-            counter += 1
-
-    return int(sum_brightness / counter)
-
-
-def classify_circle(circle, brightness_threshold):
-    """ Classify circle according to circle area brightness
+def calculate_circle_brightnesses(circles, img):
+    if len(circles) == 0:
+        return np.zeros(0)
+    return calculate_circle_statistics(img, circles).mean
 
-        Returns 1 if circle is "good", 0 if "loose" """
 
-    brightness = circle[3]
-    return 1 if brightness < brightness_threshold else 0
+def calculate_median_brightness(brightnesses):
+    if len(brightnesses) == 0 or np.all(np.isnan(brightnesses)):
+        return 0
+    return np.nanmedian(brightnesses)
 
 
-def calculate_circle_brightnesses(circles, img):
-    def f(c): return circle_avg_brightness(c, img)
-    brightnesses = np.array(list(map(f, circles)))
-    return np.c_[circles, brightnesses]
+def classify_by_brightness(brightnesses, brightness_thresholds):
+    """ Classify circles according to circle area brightness
 
+        Returns 1 for "good" circles, 0 for "loose" ones (and ones without brightness). """
 
-def calculate_median_brightness(circles):
-    if len(circles) == 0:
-        return 0
-    return np.median(circles[:, 3])
+    return (brightnesses < brightness_thresholds).astype(np.int64)
 
 
 def classify_circles_by_brightness(img, circles, loose_circle_threshold):
-    circles = calculate_circle_brightnesses(circles, img)
-    median_brightness = calculate_median_brightness(circles)
-    classification_threshold = median_brightness * loose_circle_threshold
-    classification = list(map(lambda circle: classify_circle(circle, classification_threshold), circles))
-    return classification
+    brightnesses = calculate_circle_brightnesses(circles, img)
+    classification_threshold = calculate_median_brightness(brightnesses) * loose_circle_threshold
+    return classify_by_brightness(brightnesses, classification_threshold), {'brightness': brightnesses}
 
 
 def classify_circles_by_brightness_adaptive(img, circles, loose_circle_threshold, averaging_area):
-    circles = calculate_circle_brightnesses(circles, img)
-
-    img_averages = cv2.blur(img, (averaging_area, averaging_area))
-
-    classification = []
-
-    for circle in circles:
-        circle_x = int(circle[0])
-        circle_y = int(circle[1])
-        circle_x = max(0, min(circle_x, len(img[0])-1))
-        circle_y = max(0, min(circle_y, len(img)-1))
+    if len(circles) == 0:
+        return np.zeros(0, np.int64), {'brightness': np.zeros(0), 'local_brightness': np.zeros(0)}
 
-        classification.append(classify_circle(circle, img_averages[circle_y, circle_x] * loose_circle_threshold))
+    # Local averages are only calculated at the centers, from a summed-area table cached with the image
+    # for the averaging area, so a changed tolerance doesn't recalculate anything but the comparisons:
+    image_statistics = get_image_statistics(img)
+    brightnesses = image_statistics.circle_statistics(circles).mean
+    local_brightnesses = image_statistics.local_means(np.asarray(circles)[:, :2], averaging_area)
 
-    return classification
+    classification = classify_by_brightness(brightnesses, local_brightnesses * loose_circle_threshold)
+    return classification, {'brightness': brightnesses, 'local_brightness': local_brightnesses}
 
 
 class BrightnessClassifier:
+    # Version of the results, increased when the same parameters give different results (see result_cache):
+    VERSION = 1
+
     def __init__(self):
         pass
 
@@ -88,11 +65,14 @@ class BrightnessClassifier:
         return classify_circles_by_brightness(img, circles, parameters['Loose circle tolerance'] / 50.0)
 
     @staticmethod
-    def update_result_image(img, active_image_area, circles, results : list[int], draw_parameters):
+    def update_result_image(img, active_image_area, circles, results : np.ndarray, draw_parameters):
         update_result_image(img, active_image_area, circles, results, draw_parameters)
 
 
 class BrightnessClassifierAdaptive:
+    # Version of the results, increased when the same parameters give different results (see result_cache):
+    VERSION = 1
+
     def __init__(self):
         pass
 
@@ -107,11 +87,22 @@ class BrightnessClassifierAdaptive:
             ['Averaging area', 5, 500, 100]
         ]
 
+    @staticmethod
+    def scale_parameters(parameters, scale):
+        scaled_parameters = dict(parameters)
+        scaled_parameters['Averaging area'] = max(1, round(parameters['Averaging area'] * scale))
+        return scaled_parameters
+
     @staticmethod
     def evaluate(img, circles, parameters):
         return classify_circles_by_brightness_adaptive(img, circles, parameters['Loose circle tolerance'] / 50.0, parameters['Averaging area'])
 
     @staticmethod
-    def update_result_image(img, active_image_area, circles, results : list[int], draw_parameters):
+    def get_background_image(img, parameters):
+        # The local averages the circles are compared to:
+        return get_image_statistics(img).get_background(parameters['Averaging area'])
+
+    @staticmethod
+    def update_result_image(img, active_image_area, circles, results : np.ndarray, draw_parameters):
         update_result_image(img, active_image_area, circles, results, draw_parameters)
         
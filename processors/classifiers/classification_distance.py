@@ -1,54 +1,42 @@
-import math
+import numpy as np
 from scipy import spatial
-from .classification_common import update_result_image
+from .classification_common import count_close_sides, update_result_image
 
-def point_distance_squared(point_1, point_2):
-    return (float(point_2[0]) - float(point_1[0]))**2 + (float(point_2[1]) - float(point_1[1]))**2
 
-
-# Returns the number of image "sides" the point is within distance of
-def count_close_sides(point, image_size, distance):
-    counter = 0
-    if point[0] < distance:
-        counter += 1
-    if point[1] < distance:
-        counter += 1
-    if point[0] + distance > image_size[0]:
-        counter += 1
-    if point[1] + distance > image_size[1]:
-        counter += 1
-    return counter
-
-
-def classify_by_neighbor_count(image_size, circle, neighbor_count, distance):
+def classify_by_neighbor_count(image_size, circles, neighbor_counts, distance):
     # Six neighbors in hexagonal pattern + 1 for itself
     required_neighbors = 7
 
     # Reduce the number of required neighbors if the circle is close to the side of the image:
-    close_sides_count = count_close_sides((circle[0], circle[1]), image_size, distance)
-    required_neighbors = required_neighbors - close_sides_count * 3
+    close_sides_counts = count_close_sides(circles[:, :2], image_size, distance)
+    required_neighbors = required_neighbors - close_sides_counts * 3
 
     # Classify
-    return 1 if neighbor_count >= required_neighbors else 0
+    return (neighbor_counts >= required_neighbors).astype(np.int64)
 
 
 def classify_circles_by_distance(img, circles, radius, loose_circle_threshold):
-    image_size = (len(img[0]), len(img))
-    classification = []
+    image_size = (img.shape[1], img.shape[0])
+
+    if len(circles) == 0:
+        return np.zeros(0, np.int64), {'neighbor_count': np.zeros(0, np.int64)}
 
     distance = radius * 2 * loose_circle_threshold
 
-    points = list((circle[0], circle[1]) for circle in circles)
+    circles = np.asarray(circles)
+    points = circles[:, :2].astype(np.float64)
     tree = spatial.cKDTree(points)
-    neighbors_count = tree.query_ball_point(points, distance, return_length=True)
+    neighbor_counts = tree.query_ball_point(points, distance, return_length=True)
 
-    for i in range(len(circles)):
-        classification.append(classify_by_neighbor_count(image_size, circles[i], neighbors_count[i], distance))
-
-    return classification
+    classification = classify_by_neighbor_count(image_size, points, neighbor_counts, distance)
+    # The circle itself is not its neighbor:
+    return classification, {'neighbor_count': neighbor_counts - 1}
 
 
 class DistanceClassifier:
+    # Version of the results, increased when the same parameters give different results (see result_cache):
+    VERSION = 1
+
     def __init__(self):
         pass
 
@@ -63,10 +51,16 @@ class DistanceClassifier:
             ['Radius', 0, 100, 10],
         ]
 
+    @staticmethod
+    def scale_parameters(parameters, scale):
+        scaled_parameters = dict(parameters)
+        scaled_parameters['Radius'] = parameters['Radius'] * scale
+        return scaled_parameters
+
     @staticmethod
     def evaluate(img, circles, parameters):
         return classify_circles_by_distance(img, circles, parameters['Radius'], (parameters['Loose circle tolerance'] + 49.0) / 50.0)
 
     @staticmethod
-    def update_result_image(img, active_image_area, circles, results : list[int], draw_parameters):
+    def update_result_image(img, active_image_area, circles, results : np.ndarray, draw_parameters):
         update_result_image(img, active_image_area, circles, results, draw_parameters)
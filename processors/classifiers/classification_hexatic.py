@@ -0,0 +1,110 @@
+import numpy as np
+from scipy import spatial
+from .classification_common import count_close_sides, update_result_image
+
+
+# Neighbors of a circle in a hexagonal pattern:
+HEXAGONAL_NEIGHBOR_COUNT = 6
+
+# Per-circle metrics of the classifier, in the order calculate_hexatic_order returns them:
+HEXATIC_METRICS = ['psi6', 'neighbor_count', 'neighbor_distance_mean', 'neighbor_distance_std']
+
+
+def calculate_hexatic_order(points, max_neighbor_distance):
+    """ Returns the local bond-orientational order |psi6| of every point, with the number, the mean
+        and the standard deviation of the distances of its neighbors.
+
+        The neighbors of a point are its (at most six) nearest points closer than max_neighbor_distance.
+        psi6 is the mean of exp(6i * bond angle) over the neighbors: 1 for a perfect hexagonal
+        neighborhood, close to 0 for a disordered one, nan for points without neighbors. """
+
+    points = np.asarray(points, np.float64).reshape(-1, 2)
+    count = len(points)
+    k = min(HEXAGONAL_NEIGHBOR_COUNT, count - 1)
+    if k < 1:
+        return np.full(count, np.nan), np.zeros(count, np.int64), np.full(count, np.nan), np.full(count, np.nan)
+
+    # A single query for all points, the first neighbor found is the point itself. The tree is only
+    # queried once, an unbalanced tree is faster to build than it is slower to query:
+    tree = spatial.cKDTree(points, balanced_tree=False, compact_nodes=False)
+    distances, indices = tree.query(points, k=k + 1, distance_upper_bound=max_neighbor_distance, workers=-1)
+    distances = distances[:, 1:]
+    indices = indices[:, 1:]
+
+    # Missing neighbors have infinite distance and the index count:
+    is_neighbor = np.isfinite(distances)
+    neighbor_counts = np.count_nonzero(is_neighbor, axis=1)
+    indices = np.where(is_neighbor, indices, 0)
+    distances = np.where(is_neighbor, distances, 0.0)
+
+    # exp(6i * angle) of the unit bond vectors, by raising them to the 6th power (single precision is plenty):
+    bonds = np.empty(indices.shape, np.complex64)
+    bonds.real = points[indices, 0] - points[:, 0, None]
+    bonds.imag = points[indices, 1] - points[:, 1, None]
+    bonds /= np.where(is_neighbor, distances, np.inf).astype(np.float32)
+    bonds *= bonds
+    bond_orders = bonds * bonds * bonds
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        order = np.abs(np.sum(bond_orders, axis=1)) / neighbor_counts
+        mean_distances = np.sum(distances, axis=1) / neighbor_counts
+        distance_deviations = np.sqrt(
+            np.sum(np.where(is_neighbor, (distances - mean_distances[:, None]) ** 2, 0.0), axis=1) / neighbor_counts)
+
+    return order, neighbor_counts, mean_distances, distance_deviations
+
+
+def classify_circles_by_hexatic_order(img, circles, radius, neighbor_distance_factor, order_threshold):
+    if len(circles) == 0:
+        return np.zeros(0, np.int64), {name: np.zeros(0) for name in HEXATIC_METRICS}
+
+    # Only the first shell of neighbors should count (in a close packed pattern the second is at sqrt(3) diameters):
+    distance = radius * 2 * neighbor_distance_factor
+    points = np.asarray(circles)[:, :2].astype(np.float64)
+    metrics = dict(zip(HEXATIC_METRICS, calculate_hexatic_order(points, distance)))
+    order = metrics['psi6']
+    neighbor_counts = metrics['neighbor_count']
+
+    # Hexagonal circles have a (nearly) six-fold symmetric neighborhood, with all their neighbors present.
+    # Circles close to the sides of the image have neighbors only inside it (3 less per side):
+    close_sides_counts = count_close_sides(points, (img.shape[1], img.shape[0]), distance)
+    required_neighbor_counts = np.maximum(HEXAGONAL_NEIGHBOR_COUNT - 3 * close_sides_counts, 1)
+    is_hexagonal = (neighbor_counts >= required_neighbor_counts) & (order >= order_threshold)
+    return is_hexagonal.astype(np.int64), metrics
+
+
+class HexaticOrderClassifier:
+    # Version of the results, increased when the same parameters give different results (see result_cache):
+    VERSION = 1
+
+    def __init__(self):
+        pass
+
+    @staticmethod
+    def get_name():
+        return "Hexatic order"
+
+    @staticmethod
+    def get_parameter_list():
+        return [
+            # Minimal |psi6| of a hexagonal circle:
+            ['Order threshold %', 1, 100, 70],
+            [r'Neighbor distance (% of Diameter)', 100, 400, 130],
+            ['Radius', 0, 100, 10],
+        ]
+
+    @staticmethod
+    def scale_parameters(parameters, scale):
+        scaled_parameters = dict(parameters)
+        scaled_parameters['Radius'] = parameters['Radius'] * scale
+        return scaled_parameters
+
+    @staticmethod
+    def evaluate(img, circles, parameters):
+        return classify_circles_by_hexatic_order(
+            img, circles, parameters['Radius'], parameters[r'Neighbor distance (% of Diameter)'] / 100.0,
+            parameters['Order threshold %'] / 100.0)
+
+    @staticmethod
+    def update_result_image(img, active_image_area, circles, results : np.ndarray, draw_parameters):
+        update_result_image(img, active_image_area, circles, results, draw_parameters)
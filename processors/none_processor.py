@@ -1,4 +1,10 @@
+import numpy as np
+
+
 class NoneProcessor:
+    # Version of the results, increased when the same parameters give different results (see result_cache):
+    VERSION = 1
+
     def __init__(self):
         pass
 
@@ -12,8 +18,9 @@ class NoneProcessor:
 
     @staticmethod
     def evaluate(img, circles, parameters):
-        return []
+        # Circles are not classified:
+        return np.zeros(0, np.int64), {}
 
     # @staticmethod
-    # def update_result_image(img, active_image_area, circles, results : list[int], draw_parameters):
+    # def update_result_image(img, active_image_area, circles, results : np.ndarray, draw_parameters):
     #     pass
@@ -0,0 +1,211 @@
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import numpy as np
+import tracing
+
+
+# Changed when the format of the entries or of the keys changes, older entries are never found again:
+CACHE_FORMAT_VERSION = 1
+
+DEFAULT_MAX_BYTES = 256 * 2 ** 20
+
+# Temporary files of interrupted writes older than this are removed by the eviction:
+STALE_TEMPORARY_FILE_SECONDS = 3600
+
+ENTRY_EXTENSION = '.npz'
+
+HASH_CHUNK_SIZE = 2 ** 20
+
+# The entries are only scanned when the bytes written since the last scan may exceed max_bytes, and
+# after this many writes (other processes sharing the directory write entries too):
+EVICTION_SCAN_INTERVAL = 256
+
+# Full caches are evicted down to this fraction of max_bytes, so the writes after an eviction don't
+# scan again right away:
+EVICTION_TARGET_FRACTION = 0.9
+
+# Content hashes of the files hashed in this process, by (path, size, modification time):
+_file_hashes = {}
+_file_hashes_lock = threading.Lock()
+
+
+def get_default_cache_directory():
+    base_directory = os.environ.get('LOCALAPPDATA') or os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base_directory, 'hexi', 'results')
+
+
+def hash_file(path):
+    """ Returns the hex digest of the content of the file, files are hashed only once per process
+        while they don't change. """
+
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _file_hashes_lock:
+        if memo_key in _file_hashes:
+            return _file_hashes[memo_key]
+
+    with tracing.span('hash_file', bytes=stat.st_size):
+        digest = hashlib.blake2b(digest_size=20)
+        with open(path, 'rb') as infile:
+            for chunk in iter(lambda: infile.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+
+    with _file_hashes_lock:
+        _file_hashes[memo_key] = digest.hexdigest()
+    return _file_hashes[memo_key]
+
+
+def get_algorithm_id(algorithm):
+    # Algorithms without a version are at version 1:
+    return [algorithm.get_name(), getattr(algorithm, 'VERSION', 1)]
+
+
+def compact_classes(classes):
+    # Classes are small numbers, stored in the smallest integer type holding them:
+    if len(classes) == 0:
+        return classes.astype(np.int8)
+    return classes.astype(np.promote_types(np.min_scalar_type(int(classes.min())), np.min_scalar_type(int(classes.max()))))
+
+
+class ResultCache:
+    """ Circles, classes and metrics of evaluations, stored on disk by a hash of everything they depend on.
+
+        Every entry is a .npz file named by its key. Entries are written to a temporary file and renamed,
+        so processes sharing the cache directory never see partial entries. Reading an entry marks it as
+        used (by its modification time), the least recently used entries are removed when the entries
+        take more than max_bytes. The cache is best effort: entries which can't be read or written are
+        treated as missing.
+
+        The size of the entries is estimated from the last scan and the entries written since, so writes
+        don't scan all entries. """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        # Bytes of the entries at the last scan plus the bytes written since (None before the first
+        # scan), and the writes since:
+        self.estimated_bytes = None
+        self.puts_since_scan = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(image_hash, crop_area, detector, processor, parameters):
+        key_data = {
+            'format': CACHE_FORMAT_VERSION,
+            'image': image_hash,
+            'crop_area': [int(coordinate) for coordinate in crop_area],
+            'detector': get_algorithm_id(detector),
+            'processor': get_algorithm_id(processor),
+            'parameters': parameters,
+        }
+        return hashlib.sha256(json.dumps(key_data, sort_keys=True, default=str).encode()).hexdigest()
+
+    def get_entry_path(self, key):
+        return os.path.join(self.directory, key[:2], key + ENTRY_EXTENSION)
+
+    def get(self, key):
+        """ Returns the (circles, classes, metrics) of the key, or None if they are not in the cache. """
+
+        path = self.get_entry_path(key)
+        with tracing.span('result_cache_get') as span:
+            try:
+                with open(path, 'rb') as infile:
+                    data = infile.read()
+                with np.load(io.BytesIO(data), allow_pickle=False) as entry:
+                    circles = entry['circles']
+                    classes = entry['classes'].astype(np.int64)
+                    metrics = {name[len('metric.'):]: entry[name] for name in entry.files if name.startswith('metric.')}
+            except (OSError, ValueError, KeyError, EOFError):
+                span.set(hit=False)
+                return None
+
+            span.set(hit=True)
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            return circles, classes, metrics
+
+    def put(self, key, circles, classes, metrics):
+        path = self.get_entry_path(key)
+        arrays = {'circles': np.asarray(circles), 'classes': compact_classes(np.asarray(classes, np.int64))}
+        for name, values in metrics.items():
+            arrays['metric.' + name] = np.asarray(values)
+
+        with tracing.span('result_cache_put'):
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                file_descriptor, temporary_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+                try:
+                    with os.fdopen(file_descriptor, 'wb') as outfile:
+                        np.savez(outfile, **arrays)
+                        written_bytes = outfile.tell()
+                    os.replace(temporary_path, path)
+                except BaseException:
+                    os.remove(temporary_path)
+                    raise
+            except OSError:
+                return
+
+            with self.lock:
+                self.puts_since_scan += 1
+                if self.estimated_bytes is not None:
+                    self.estimated_bytes += written_bytes
+                is_scan_due = (self.estimated_bytes is None or self.estimated_bytes > self.max_bytes or
+                               self.puts_since_scan >= EVICTION_SCAN_INTERVAL)
+            if is_scan_due:
+                self.evict()
+
+    def evict(self):
+        """ Removes the least recently used entries when the entries take more than max_bytes, down to
+            EVICTION_TARGET_FRACTION of it. """
+
+        entries = []
+        now = time.time()
+        try:
+            subdirectories = [entry.path for entry in os.scandir(self.directory) if entry.is_dir()]
+        except OSError:
+            return
+        for subdirectory in subdirectories:
+            try:
+                files = list(os.scandir(subdirectory))
+            except OSError:
+                continue
+            for entry in files:
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                if entry.name.endswith(ENTRY_EXTENSION):
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                elif entry.name.endswith('.tmp') and now - stat.st_mtime > STALE_TEMPORARY_FILE_SECONDS:
+                    self.remove_file(entry.path)
+
+        total_bytes = sum(size for mtime, size, path in entries)
+        if total_bytes > self.max_bytes:
+            with tracing.span('result_cache_evict', entries=len(entries), bytes=total_bytes):
+                entries.sort()
+                for mtime, size, path in entries:
+                    if total_bytes <= self.max_bytes * EVICTION_TARGET_FRACTION:
+                        break
+                    # Another process may have removed the entry already:
+                    self.remove_file(path)
+                    total_bytes -= size
+
+        with self.lock:
+            self.estimated_bytes = total_bytes
+            self.puts_since_scan = 0
+
+    @staticmethod
+    def remove_file(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
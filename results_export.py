@@ -0,0 +1,302 @@
+import csv
+import os
+import shutil
+import tempfile
+import zipfile
+import numpy as np
+from scipy import spatial
+
+from processors.classifiers.circle_statistics import calculate_circle_statistics
+from processors.classifiers.classification_common import calculate_coverage
+
+
+# Circles closer than this multiple of their diameter (center to center) are counted as neighbors:
+NEIGHBOR_DISTANCE_FACTOR = 1.2
+
+# Columns of the per-circle and the per-image tables, str columns are stored as unicode arrays in .npz files:
+CIRCLE_COLUMNS = [
+    ('image_index', np.int64),
+    ('x', np.float64),
+    ('y', np.float64),
+    ('r', np.float64),
+    ('diameter_nm', np.float64),
+    ('class', np.int16),
+    ('band', np.int16),
+    ('brightness', np.float64),
+    ('neighbor_count', np.int32),
+    ('nearest_neighbor_distance', np.float64),
+]
+
+IMAGE_COLUMNS = [
+    ('image', str),
+    ('detector', str),
+    ('processor', str),
+    ('x0', np.int64),
+    ('y0', np.int64),
+    ('x1', np.int64),
+    ('y1', np.int64),
+    ('nm_per_pixel', np.float64),
+    ('circles', np.int64),
+    ('hex', np.int64),
+    ('non_hex', np.int64),
+    ('ratio', np.float64),
+    ('coverage', np.float64),
+    ('mean_diameter_nm', np.float64),
+]
+
+
+def calculate_circle_records(img, crop_area, circles, classification, nm_per_pixel=1.0, image_index=0):
+    """ Returns the per-circle table (dict of column arrays) of the circles detected on the crop area of the
+        grayscale image. Coordinates are image coordinates, the class is -1 for unclassified circles.
+        The band is the radius band of multi-band detectors, 0 for other detectors. """
+
+    x0, y0, x1, y1 = crop_area
+    circles = np.asarray(circles, np.float64).reshape(len(circles), -1) if len(circles) > 0 else np.zeros((0, 3))
+    count = len(circles)
+    bands = circles[:, 3].astype(np.int16) if circles.shape[1] > 3 else np.zeros(count, np.int16)
+    circles = circles[:, :3]
+
+    circle_classes = np.full(count, -1, np.int16)
+    if len(classification) == count:
+        circle_classes[:] = classification
+
+    brightness = np.full(count, np.nan)
+    neighbor_count = np.zeros(count, np.int32)
+    nearest_neighbor_distance = np.full(count, np.nan)
+    if count > 0:
+        brightness = calculate_circle_statistics(img[y0:y1, x0:x1], circles).mean
+
+        tree = spatial.cKDTree(circles[:, :2])
+        neighbor_count = tree.query_ball_point(
+            circles[:, :2], 2 * NEIGHBOR_DISTANCE_FACTOR * circles[:, 2], return_length=True).astype(np.int32) - 1
+        if count > 1:
+            nearest_neighbor_distance = tree.query(circles[:, :2], k=2)[0][:, 1]
+
+    return {
+        'image_index': np.full(count, image_index, np.int64),
+        'x': circles[:, 0] + x0,
+        'y': circles[:, 1] + y0,
+        'r': circles[:, 2],
+        'diameter_nm': 2 * circles[:, 2] * nm_per_pixel,
+        'class': circle_classes,
+        'band': bands,
+        'brightness': brightness,
+        'neighbor_count': neighbor_count,
+        'nearest_neighbor_distance': nearest_neighbor_distance,
+    }
+
+
+def calculate_image_summary(image_path, detector_name, processor_name, crop_area, circles, classification,
+                            nm_per_pixel=1.0):
+    """ Returns the per-image summary (the numbers of the info text) as a dict of column values. """
+
+    x0, y0, x1, y1 = crop_area
+    circle_count = len(circles)
+    good_count = int(np.sum(classification)) if len(classification) == circle_count and circle_count > 0 else -1
+    radii = np.array([circle[2] for circle in circles], np.float64)
+
+    return {
+        'image': image_path,
+        'detector': detector_name,
+        'processor': processor_name,
+        'x0': x0,
+        'y0': y0,
+        'x1': x1,
+        'y1': y1,
+        'nm_per_pixel': nm_per_pixel,
+        'circles': circle_count,
+        'hex': good_count,
+        'non_hex': circle_count - good_count if good_count >= 0 else -1,
+        'ratio': float(good_count) / circle_count if good_count >= 0 else np.nan,
+        'coverage': calculate_coverage(circles, (x1 - x0) * (y1 - y0)),
+        'mean_diameter_nm': 2 * float(np.mean(radii)) * nm_per_pixel if circle_count > 0 else np.nan,
+    }
+
+
+def get_results(image_processor, nm_per_pixel=1.0):
+    """ Returns the summary and the circle records of the last evaluation of the image processor. """
+
+    crop_area = tuple(int(coordinate) for coordinate in image_processor.active_crop_area)
+    circles = image_processor.circles
+    classification = image_processor.processor_results
+    summary = calculate_image_summary(
+        image_processor.image_path, image_processor.detector.get_name(), image_processor.processor.get_name(),
+        crop_area, circles, classification, nm_per_pixel)
+    records = calculate_circle_records(image_processor.grayscale_image, crop_area, circles, classification, nm_per_pixel)
+    return summary, records
+
+
+def write_csv_rows(writer, columns, table):
+    # table is a dict of equally long column arrays:
+    writer.writerows(zip(*(np.asarray(table[name]).tolist() for name, dtype in columns)))
+
+
+def write_csv_table(outfile, columns, table):
+    writer = csv.writer(outfile)
+    writer.writerow([name for name, dtype in columns])
+    write_csv_rows(writer, columns, table)
+
+
+class CsvTableWriter:
+    """ Appends rows of a table to a CSV file, the rows are written as they are added. """
+
+    def __init__(self, path, columns):
+        self.columns = columns
+        self.outfile = open(path, 'w', newline='')
+        self.writer = csv.writer(self.outfile)
+        self.writer.writerow([name for name, dtype in columns])
+
+    def append(self, table):
+        write_csv_rows(self.writer, self.columns, table)
+        self.outfile.flush()
+
+    def close(self):
+        self.outfile.close()
+
+
+class NpzTableWriter:
+    """ Appends rows of a table to a .npz file of column arrays.
+
+        The columns are appended to temporary files, the .npz file is assembled from them on close,
+        so the memory use doesn't depend on the length of the table. """
+
+    def __init__(self, path, columns, prefix=''):
+        self.path = path
+        self.columns = columns
+        self.prefix = prefix
+        self.row_count = 0
+        self.temporary_dir = tempfile.mkdtemp(prefix='.export_', dir=os.path.dirname(os.path.abspath(path)))
+        self.column_files = {name: open(os.path.join(self.temporary_dir, name), 'wb' if dtype is not str else 'w')
+                             for name, dtype in columns}
+
+    def append(self, table):
+        for name, dtype in self.columns:
+            if dtype is str:
+                # One value per line, the width of the unicode array is known only at the end:
+                values = np.atleast_1d(table[name])
+                self.column_files[name].writelines(str(value).replace('\n', ' ') + '\n' for value in values)
+            else:
+                values = np.atleast_1d(np.asarray(table[name], dtype))
+                self.column_files[name].write(values.tobytes())
+        self.row_count += len(values)
+
+    def write_to(self, archive):
+        for name, dtype in self.columns:
+            column_path = os.path.join(self.temporary_dir, name)
+            if dtype is str:
+                with open(column_path, 'r') as infile:
+                    width = max((len(line) - 1 for line in infile), default=1)
+                dtype = np.dtype(('U', max(1, width)))
+
+            dtype = np.dtype(dtype)
+            header = {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (self.row_count,)}
+            with archive.open(self.prefix + name + '.npy', 'w', force_zip64=True) as member:
+                np.lib.format.write_array_header_2_0(member, header)
+                if dtype.kind == 'U':
+                    with open(column_path, 'r') as infile:
+                        for line in infile:
+                            member.write(np.array(line[:-1], dtype).tobytes())
+                else:
+                    with open(column_path, 'rb') as infile:
+                        shutil.copyfileobj(infile, member)
+
+    def close(self):
+        for column_file in self.column_files.values():
+            column_file.close()
+
+    def remove_temporary_files(self):
+        shutil.rmtree(self.temporary_dir, ignore_errors=True)
+
+
+class ResultWriter:
+    """ Writes the results of images one by one, as a table of images and a table of circles.
+
+        The tables are written to <base>_images.csv and <base>_circles.csv and/or to <base>.npz, where
+        the columns are named images.<column> and circles.<column>. Use as a context manager:
+
+            with ResultWriter('results', ['npz', 'csv']) as writer:
+                writer.add(summary, records)
+    """
+
+    def __init__(self, base_path, formats=('npz', 'csv')):
+        self.base_path = base_path
+        self.image_count = 0
+        self.csv_writers = []
+        self.npz_writers = []
+        if 'csv' in formats:
+            self.csv_writers = [CsvTableWriter(base_path + '_images.csv', IMAGE_COLUMNS),
+                                CsvTableWriter(base_path + '_circles.csv', CIRCLE_COLUMNS)]
+        if 'npz' in formats:
+            self.npz_writers = [NpzTableWriter(base_path + '.npz', IMAGE_COLUMNS, 'images.'),
+                                NpzTableWriter(base_path + '.npz', CIRCLE_COLUMNS, 'circles.')]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+        return False
+
+    def add(self, summary, records):
+        """ Adds the summary of an image and its circle records, the image index of the records is set here. """
+
+        records = dict(records)
+        records['image_index'] = np.full(len(records['x']), self.image_count, np.int64)
+        image_table = {name: [summary[name]] for name, dtype in IMAGE_COLUMNS}
+        for writers in (self.csv_writers, self.npz_writers):
+            if writers:
+                image_writer, circle_writer = writers
+                image_writer.append(image_table)
+                circle_writer.append(records)
+        self.image_count += 1
+
+    def close(self):
+        for writer in self.csv_writers + self.npz_writers:
+            writer.close()
+        if self.npz_writers:
+            temporary_path = self.base_path + '.npz.tmp'
+            try:
+                with zipfile.ZipFile(temporary_path, 'w', zipfile.ZIP_STORED, allowZip64=True) as archive:
+                    for writer in self.npz_writers:
+                        writer.write_to(archive)
+                os.replace(temporary_path, self.base_path + '.npz')
+            finally:
+                for writer in self.npz_writers:
+                    writer.remove_temporary_files()
+        self.csv_writers = []
+        self.npz_writers = []
+
+
+def read_csv_table(path, columns):
+    """ Reads a table written by CsvTableWriter as a dict of column arrays. """
+
+    with open(path, 'r', newline='') as infile:
+        reader = csv.reader(infile)
+        header = next(reader)
+        values = list(zip(*reader))
+
+    table = {}
+    for name, dtype in columns:
+        if name not in header:
+            continue
+        column = values[header.index(name)] if values else ()
+        if dtype is str:
+            table[name] = np.array(column, str)
+        else:
+            table[name] = np.array([float(value) if value != '' else np.nan for value in column]).astype(dtype)
+    return table
+
+
+def read_results(path):
+    """ Returns the image table and the circle table (dicts of column arrays) of results written by
+        ResultWriter, from the .npz file or from the CSV files of the base path. """
+
+    if path.endswith('.npz'):
+        with np.load(path) as data:
+            images = {key[len('images.'):]: data[key] for key in data.files if key.startswith('images.')}
+            circles = {key[len('circles.'):]: data[key] for key in data.files if key.startswith('circles.')}
+        return images, circles
+
+    base_path = path[:-len('_images.csv')] if path.endswith('_images.csv') else path
+    return (read_csv_table(base_path + '_images.csv', IMAGE_COLUMNS),
+            read_csv_table(base_path + '_circles.csv', CIRCLE_COLUMNS))
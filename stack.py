@@ -0,0 +1,227 @@
+import argparse
+import collections
+import concurrent.futures
+import json
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+import tracing
+from aggregates import ResultAggregate
+from calibration import calibrate_image
+from batch import find_images, find_parameter_file, format_duration
+from frame_source import open_frame_source
+from parameters import read_parameter_file, resolve_parameter_file
+from process import process_image
+from results_export import CsvTableWriter, ResultWriter, calculate_circle_records, calculate_image_summary
+
+
+# Columns of the time series table, one row per frame:
+TIME_SERIES_COLUMNS = [
+    ('frame', np.int64),
+    ('time', np.float64),
+    ('image', str),
+    ('circles', np.int64),
+    ('hex', np.int64),
+    ('non_hex', np.int64),
+    ('ratio', np.float64),
+    ('coverage', np.float64),
+    ('mean_diameter_nm', np.float64),
+    ('seconds', np.float64),
+]
+
+
+class FrameResult:
+    def __init__(self, index, summary, records, seconds):
+        self.index = index
+
+        # Per-image summary and per-circle records of the frame, as exported by results_export:
+        self.summary = summary
+        self.records = records
+
+        # Duration of reading and processing the frame:
+        self.seconds = seconds
+
+    def get_time_series_row(self, frame_interval=1.0):
+        row = {name: [self.summary[name]] for name, dtype in TIME_SERIES_COLUMNS if name in self.summary}
+        row['frame'] = [self.index]
+        row['time'] = [self.index * frame_interval]
+        row['seconds'] = [self.seconds]
+        return row
+
+
+def process_frame(source, index, detector, processor, parameters, crop_area, nm_per_pixel):
+    with tracing.span('process_frame', frame=index):
+        start_time = time.perf_counter()
+        img = source.read_frame(index)
+        x0, y0, x1, y1 = crop_area if crop_area is not None else (0, 0, img.shape[1], img.shape[0])
+
+        circles, classes, metrics = process_image(img[y0:y1, x0:x1], detector, parameters, processor, parameters)
+
+        summary = calculate_image_summary(
+            source.get_frame_name(index), detector.get_name(), processor.get_name(), (x0, y0, x1, y1), circles,
+            classes, nm_per_pixel)
+        records = calculate_circle_records(img, (x0, y0, x1, y1), circles, classes, nm_per_pixel, index)
+        return FrameResult(index, summary, records, time.perf_counter() - start_time)
+
+
+def process_frames(source, detector, processor, parameters, crop_area=None, nm_per_pixel=1.0, worker_count=None,
+                   prefetch=2):
+    """ Processes the frames of the source in worker threads, yields the FrameResult of every frame in
+        frame order.
+
+        At most worker_count + prefetch frames are read or processed at a time, and a frame is dropped
+        as soon as its results are calculated, so the memory use doesn't depend on the number of frames.
+        The crop area (None for the whole frame) is the same for all frames.
+
+        The detector and the processor are shared by the worker threads. This relies on their methods
+        being static and on the image statistics cache of the classifiers being thread safe (see
+        circle_statistics.get_image_statistics), every frame gets its own cache entry. """
+
+    worker_count = worker_count or os.cpu_count()
+    frame_indices = iter(range(len(source)))
+
+    # cv2 releases the GIL while detecting, so the frames are processed in parallel threads:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=worker_count) as executor:
+        pending = collections.deque()
+
+        def submit_next_frame():
+            index = next(frame_indices, None)
+            if index is not None:
+                pending.append(executor.submit(
+                    process_frame, source, index, detector, processor, parameters, crop_area, nm_per_pixel))
+
+        for _ in range(worker_count + max(0, prefetch)):
+            submit_next_frame()
+
+        try:
+            while pending:
+                result = pending.popleft().result()
+                submit_next_frame()
+                yield result
+        finally:
+            # Stopped early (by the consumer or an error), frames not started yet are skipped:
+            for future in pending:
+                future.cancel()
+
+
+def parse_arguments(arguments=None):
+    parser = argparse.ArgumentParser(
+        description='Process the frames of a multi-frame TIFF file or of a numbered image sequence one by one, '
+                    'and write the results of every frame and a time series of their summaries.')
+    parser.add_argument('inputs', nargs='+',
+                        help='a multi-frame TIFF file, or the image files, directories or glob patterns of a sequence')
+    parser.add_argument('-o', '--output', required=True,
+                        help='output base path, the time series is written to <output>_time_series.csv')
+    parser.add_argument('-p', '--parameters',
+                        help='parameter file (default: the sibling .par file of the first image)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='number of worker threads (default: number of CPUs)')
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help='number of frames read ahead of the workers (default: 2)')
+    parser.add_argument('--no-autocrop', action='store_true',
+                        help="process the full frames instead of detecting the SEM information panel on the first frame")
+    parser.add_argument('--nm-per-pixel', type=float, default=1.0,
+                        help='scale of the images, used for the physical diameters (default: 1.0)')
+    parser.add_argument('--scale-bar', metavar='NM', type=float,
+                        help='length of the scale bar in the SEM information panel in nm, the scale of the frames '
+                             'is calibrated from the measured length of the scale bar of the first frame '
+                             'instead of --nm-per-pixel')
+    parser.add_argument('--frame-interval', type=float, default=1.0,
+                        help='time between frames, used for the time column (default: 1.0)')
+    parser.add_argument('--export', action='append', choices=['npz', 'csv'],
+                        help='also write the circles and summaries of all frames to <output>.npz '
+                             'or <output>_circles.csv and <output>_images.csv (can be repeated)')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='trace the processing stages, write a Chrome trace to FILE and print a summary')
+    return parser.parse_args(arguments)
+
+
+def main(arguments=None):
+    from image_processor import ImageProcessor
+
+    args = parse_arguments(arguments)
+
+    image_paths = find_images(args.inputs, False)
+    if len(image_paths) == 0:
+        print('No images found.', file=sys.stderr)
+        return 1
+
+    parameter_file = find_parameter_file(image_paths[0], args.parameters)
+    if parameter_file is None:
+        print('No parameter file for ' + image_paths[0], file=sys.stderr)
+        return 1
+
+    detector, processor, parameter_values = resolve_parameter_file(
+        read_parameter_file(parameter_file),
+        ImageProcessor.get_available_detectors(),
+        ImageProcessor.get_available_processors())
+
+    if args.trace:
+        tracing.enable()
+
+    # Parallelism comes from the worker threads, OpenCV's own threads would only compete for the same cores:
+    if args.jobs > 1:
+        cv2.setNumThreads(1)
+
+    source = open_frame_source(image_paths)
+    if len(source) == 0:
+        print('No frames found.', file=sys.stderr)
+        return 1
+
+    # The information panel and the scale bar are at the same place in every frame:
+    crop_area = None
+    nm_per_pixel = args.nm_per_pixel
+    if not args.no_autocrop or args.scale_bar:
+        calibration = calibrate_image(source.read_frame(0))
+        if not args.no_autocrop:
+            crop_area = calibration.crop_area
+        if args.scale_bar:
+            if calibration.scale_bar is None:
+                print('No scale bar found in the information panel.', file=sys.stderr)
+                source.close()
+                return 1
+            nm_per_pixel = calibration.get_nm_per_pixel(args.scale_bar)
+            print(f'Scale bar of {calibration.scale_bar.length} pixels: {nm_per_pixel:.4g} nm/px')
+
+    output_dir = os.path.dirname(os.path.abspath(args.output))
+    os.makedirs(output_dir, exist_ok=True)
+
+    start_time = time.perf_counter()
+    aggregate = ResultAggregate()
+    time_series_writer = CsvTableWriter(args.output + '_time_series.csv', TIME_SERIES_COLUMNS)
+    try:
+        with ResultWriter(args.output, args.export or ()) as result_writer:
+            for result in process_frames(source, detector, processor, parameter_values, crop_area, nm_per_pixel,
+                                         max(1, args.jobs), args.prefetch):
+                time_series_writer.append(result.get_time_series_row(args.frame_interval))
+                aggregate.add_image(result.summary, result.records)
+                if args.export:
+                    result_writer.add(result.summary, result.records)
+
+                frame_count = result.index + 1
+                elapsed_time = time.perf_counter() - start_time
+                remaining_time = elapsed_time / frame_count * (len(source) - frame_count)
+                print(f'[{frame_count:>{len(str(len(source)))}}/{len(source)}] '
+                      f'ETA {format_duration(remaining_time)} {result.summary["image"]}: '
+                      f'{result.summary["circles"]} circles ({result.seconds:.2f} s)', flush=True)
+    finally:
+        time_series_writer.close()
+        source.close()
+
+    with open(args.output + '_aggregate.json', 'w') as outfile:
+        json.dump(aggregate.to_dict(), outfile, indent=4)
+    print(aggregate.get_description())
+
+    if args.trace:
+        tracing.export_chrome_trace(args.trace)
+        print(tracing.format_summary())
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,65 @@
+import os
+import cv2
+import pytest
+
+from calibration import LayoutCache, detect_crop_area, find_scale_bar
+
+
+EXAMPLES_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'examples')
+EXAMPLE_PATH = os.path.join(EXAMPLES_DIRECTORY, 'typical_defects', 'typical_defects.tiff')
+
+# Crop area and scale bar length of the bundled examples, the images of an instrument have the panel at
+# the same place:
+EXAMPLE_CALIBRATIONS = [
+    ('holes/holes.jpg', (0, 0, 716, 717), 191),
+    ('island/Island.jpg', (0, 0, 716, 716), 191),
+    ('perfect_hcp/hcp.jpg', (0, 0, 716, 716), 153),
+    ('non_circular_etched/necks.jpg', (0, 0, 1280, 960), 43),
+    ('non_circular_etched/triangular.jpg', (0, 0, 1280, 960), 43),
+    ('non_circular_etched/A_non_circular.tif', (0, 0, 768, 768), 164),
+    ('non_circular_etched/B_non_circular.tif', (0, 0, 768, 768), 164),
+    ('non_closed_packed_simple/A_etched.tif', (0, 0, 768, 768), 164),
+    ('non_closed_packed_simple/B_etched.tif', (0, 0, 768, 768), 205),
+    ('typical_defects/typical_defects.tiff', (0, 0, 768, 768), 205),
+    ('unevenly_lit_area/unevenly_lit_area.tif', (0, 0, 768, 768), 205),
+]
+
+
+@pytest.mark.parametrize('image_path, expected_crop_area, expected_length', EXAMPLE_CALIBRATIONS)
+def test_examples_are_calibrated(image_path, expected_crop_area, expected_length):
+    img = cv2.imread(os.path.join(EXAMPLES_DIRECTORY, image_path), cv2.IMREAD_GRAYSCALE)
+    crop_area = detect_crop_area(img)
+    assert crop_area == expected_crop_area
+
+    scale_bar = find_scale_bar(img, crop_area)
+    assert scale_bar is not None and scale_bar.length == expected_length
+
+
+def test_glyph_strokes_are_not_scale_bars():
+    # Only the "mm" of the label of the scale bar is left in the panel of triangular.jpg:
+    img = cv2.imread(os.path.join(EXAMPLES_DIRECTORY, 'non_circular_etched', 'triangular.jpg'),
+                     cv2.IMREAD_GRAYSCALE)
+    crop_area = detect_crop_area(img)
+    img[crop_area[3]:, :1000] = img[-1, -1]
+    assert find_scale_bar(img, crop_area) is None
+
+
+def test_layout_without_panel_is_not_reused_for_images_with_panel():
+    img = cv2.imread(EXAMPLE_PATH, cv2.IMREAD_GRAYSCALE)
+    crop_area = detect_crop_area(img)
+    scale_bar = find_scale_bar(img, crop_area)
+
+    # An image of the same size without a panel, the micrograph stretched over the whole image:
+    x0, y0, x1, y1 = crop_area
+    panel_less_img = cv2.resize(img[y0:y1, x0:x1], (img.shape[1], img.shape[0]))
+
+    layout_cache = LayoutCache()
+    assert layout_cache.calibrate(panel_less_img).crop_area == (0, 0, img.shape[1], img.shape[0])
+
+    calibration = layout_cache.calibrate(img)
+    assert calibration.crop_area == crop_area
+    assert calibration.scale_bar is not None and calibration.scale_bar.length == scale_bar.length
+
+    # Images of a known layout are calibrated from the cached layout:
+    calibration = layout_cache.calibrate(img)
+    assert calibration.crop_area == crop_area and calibration.scale_bar.length == scale_bar.length
@@ -0,0 +1,21 @@
+import concurrent.futures
+import numpy as np
+
+from processors.classifiers.circle_statistics import ImageStatistics, get_image_statistics
+
+
+def test_image_statistics_of_images_used_in_parallel_threads():
+    random = np.random.default_rng(0)
+    images = [random.integers(0, 256, (200, 300), np.uint8) for _ in range(4)]
+    circles = np.c_[random.uniform(0, 300, 50), random.uniform(0, 200, 50), random.uniform(2, 10, 50)]
+    expected = [ImageStatistics(img).circle_statistics(circles).mean for img in images]
+
+    def get_means(index):
+        return get_image_statistics(images[index % len(images)]).circle_statistics(circles).mean
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        for index, means in enumerate(executor.map(get_means, range(64))):
+            np.testing.assert_array_equal(means, expected[index % len(images)])
+
+    # Every image keeps its own tables:
+    assert all(get_image_statistics(img) is get_image_statistics(img) for img in images)
@@ -0,0 +1,63 @@
+import os
+import numpy as np
+import pytest
+
+from image_processor import ImageProcessor
+from parameters import read_parameter_file, resolve_parameter_file
+from result_cache import ResultCache
+
+
+EXAMPLE_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'examples', 'typical_defects')
+
+
+def load_example():
+    detector, processor, parameters = resolve_parameter_file(
+        read_parameter_file(os.path.join(EXAMPLE_DIRECTORY, 'typical_defects.par')),
+        ImageProcessor.get_available_detectors(),
+        ImageProcessor.get_available_processors())
+    return os.path.join(EXAMPLE_DIRECTORY, 'typical_defects.tiff'), detector, processor, parameters
+
+
+def sort_circles(circles):
+    circles = np.asarray(circles, np.float64).reshape(-1, 3)
+    return circles[np.lexsort((circles[:, 2], circles[:, 1], circles[:, 0]))]
+
+
+@pytest.mark.parametrize('growth', [10, 30])
+def test_update_detection_matches_full_detection_when_crop_area_grows(growth):
+    image_path, detector, processor, parameters = load_example()
+    crop_area = (100, 100, 500, 500)
+    grown_crop_area = (100 - growth, 100 - growth, 500 + growth, 500 + growth)
+
+    # The second evaluation updates the detection of the first:
+    image_processor = ImageProcessor(image_path)
+    image_processor.set_active_crop_area(crop_area)
+    image_processor.evaluate(detector, processor, parameters)
+    image_processor.set_active_crop_area(grown_crop_area)
+    image_processor.evaluate(detector, processor, parameters)
+    assert image_processor.detection.crop_area == grown_crop_area
+
+    full_image_processor = ImageProcessor(image_path)
+    full_image_processor.set_active_crop_area(grown_crop_area)
+    full_image_processor.evaluate(detector, processor, parameters)
+
+    np.testing.assert_array_equal(sort_circles(image_processor.circles), sort_circles(full_image_processor.circles))
+
+
+def test_updated_detection_is_not_stored_in_result_cache(tmp_path):
+    image_path, detector, processor, parameters = load_example()
+    crop_area = (100, 100, 500, 500)
+    shrunk_crop_area = (137, 141, 447, 471)
+
+    image_processor = ImageProcessor(image_path)
+    image_processor.result_cache = ResultCache(str(tmp_path))
+    image_processor.set_active_crop_area(crop_area)
+    image_processor.evaluate(detector, processor, parameters)
+    image_processor.set_active_crop_area(shrunk_crop_area)
+    image_processor.evaluate(detector, processor, parameters)
+
+    # Only the detection from scratch of the first evaluation is stored:
+    cache = ResultCache(str(tmp_path))
+    image_hash = image_processor.get_image_hash()
+    assert cache.get(cache.make_key(image_hash, crop_area, detector, processor, parameters)) is not None
+    assert cache.get(cache.make_key(image_hash, shrunk_crop_area, detector, processor, parameters)) is None
@@ -0,0 +1,23 @@
+import os
+import numpy as np
+
+from result_cache import ResultCache
+
+
+def get_directory_bytes(directory):
+    return sum(os.path.getsize(os.path.join(path, name)) for path, _, names in os.walk(directory) for name in names)
+
+
+def test_entries_are_evicted_down_to_max_bytes(tmp_path):
+    circles = np.zeros((100, 3), np.uint16)
+    classes = np.zeros(100, np.int64)
+    cache = ResultCache(str(tmp_path), max_bytes=64 * 2 ** 10)
+    keys = ['%040x' % index for index in range(500)]
+    for key in keys:
+        cache.put(key, circles, classes, {})
+        # The entries are scanned as soon as the writes since the last scan may exceed max_bytes:
+        assert get_directory_bytes(str(tmp_path)) <= cache.max_bytes
+
+    # The most recently written entries are kept:
+    assert cache.get(keys[-1]) is not None
+    assert cache.get(keys[0]) is None
@@ -0,0 +1,160 @@
+import json
+import os
+import threading
+import time
+
+
+# Lightweight tracing of the processing pipeline. Spans are recorded only while tracing is
+# enabled, when disabled span() returns a shared no-op object:
+#
+#     with tracing.span('detect', detector=detector.get_name()) as span:
+#         circles = ...
+#         span.set(circles=len(circles))
+#
+# Recorded spans can be exported as a Chrome trace (chrome://tracing, ui.perfetto.dev)
+# or summarized as a table.
+
+_enabled = False
+_events = []
+_events_lock = threading.Lock()
+_thread_state = threading.local()
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.depth = getattr(_thread_state, 'depth', 0)
+        _thread_state.depth = self.depth + 1
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        duration = time.perf_counter_ns() - self.start
+        _thread_state.depth = self.depth
+        event = {
+            'name': self.name,
+            'start_ns': self.start,
+            'duration_ns': duration,
+            'pid': os.getpid(),
+            'tid': threading.get_native_id(),
+            'depth': self.depth,
+            'args': self.args,
+        }
+        with _events_lock:
+            _events.append(event)
+        return False
+
+    def set(self, **args):
+        self.args.update(args)
+
+
+def span(name, **args):
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, args)
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def clear():
+    with _events_lock:
+        _events.clear()
+
+
+def get_events():
+    with _events_lock:
+        return list(_events)
+
+
+def add_events(events):
+    # Merges spans recorded elsewhere, eg. in worker processes:
+    with _events_lock:
+        _events.extend(events)
+
+
+def to_chrome_trace(events):
+    trace_events = []
+    for event in events:
+        trace_events.append({
+            'name': event['name'],
+            'ph': 'X',
+            'ts': event['start_ns'] / 1000.0,
+            'dur': event['duration_ns'] / 1000.0,
+            'pid': event['pid'],
+            'tid': event['tid'],
+            'args': {key: _json_value(value) for key, value in event['args'].items()},
+        })
+    return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+
+def _json_value(value):
+    if isinstance(value, (bool, int, float, str)) or value is None:
+        return value
+    if isinstance(value, (tuple, list)):
+        return [_json_value(item) for item in value]
+    try:
+        return value.item()
+    except AttributeError:
+        return str(value)
+
+
+def export_chrome_trace(filename, events=None):
+    with open(filename, 'w') as outfile:
+        json.dump(to_chrome_trace(get_events() if events is None else events), outfile)
+
+
+def summarize(events=None):
+    """ Returns the summary rows (name, depth, count, total ms, mean ms, max ms) of the spans,
+        grouped by name, in order of their first occurrence. """
+
+    events = get_events() if events is None else events
+    rows = {}
+    for event in sorted(events, key=lambda event: event['start_ns']):
+        row = rows.get(event['name'])
+        if row is None:
+            row = rows[event['name']] = [event['name'], event['depth'], 0, 0.0, 0.0, 0.0]
+        duration = event['duration_ns'] / 1e6
+        row[1] = min(row[1], event['depth'])
+        row[2] += 1
+        row[3] += duration
+        row[5] = max(row[5], duration)
+    for row in rows.values():
+        row[4] = row[3] / row[2]
+    return [tuple(row) for row in rows.values()]
+
+
+def format_summary(events=None):
+    lines = [f"{'span':<36} {'count':>7} {'total ms':>11} {'mean ms':>10} {'max ms':>10}"]
+    for name, depth, count, total, mean, maximum in summarize(events):
+        label = '  ' * depth + name
+        lines.append(f'{label:<36} {count:>7} {total:>11.2f} {mean:>10.2f} {maximum:>10.2f}')
+    return '\n'.join(lines)